@@ -11,9 +11,9 @@ from celery.utils.log import get_task_logger
 logger = get_task_logger(__name__)
 
 
-@celery.task
+@celery.task(bind=True)
 @close_connection
-def merge_podcasts(podcast_ids, num_groups):
+def merge_podcasts(self, podcast_ids, num_groups):
     """ Task to merge some podcasts"""
 
     logger.info("merging podcast ids %s", podcast_ids)
@@ -24,7 +24,10 @@ def merge_podcasts(podcast_ids, num_groups):
 
     actions = Counter()
 
-    pm = PodcastMerger(podcasts, actions, num_groups)
+    def progress(actions):
+        self.update_state(state="PROGRESS", meta={"actions": dict(actions)})
+
+    pm = PodcastMerger(podcasts, actions, num_groups, progress)
     podcast = pm.merge()
 
     logger.info("merging result: %s", actions)
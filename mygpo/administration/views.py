@@ -1,5 +1,6 @@
 import re
 import socket
+from math import ceil
 from itertools import count, chain
 from collections import Counter
 from datetime import datetime
@@ -31,6 +32,7 @@ from mygpo.users.views.registration import send_activation_email
 from mygpo.administration.tasks import merge_podcasts
 from mygpo.utils import get_git_head
 from mygpo.data.models import PodcastUpdateResult
+from mygpo.search.tasks import BATCH_SIZE as SEARCH_INDEX_BATCH_SIZE
 from mygpo.users.models import UserProxy
 from mygpo.publisher.models import PublishedPodcast
 from mygpo.api.httpresponse import JsonResponse
@@ -64,6 +66,7 @@ class HostInfo(AdminView):
 
         feed_queue_status = self._get_feed_queue_status()
         num_index_outdated = self._get_num_outdated_search_index()
+        num_index_batches = ceil(num_index_outdated / SEARCH_INDEX_BATCH_SIZE)
         avg_podcast_update_duration = self._get_avg_podcast_update_duration()
 
         return self.render_to_response(
@@ -77,6 +80,7 @@ class HostInfo(AdminView):
                 "avg_podcast_update_duration": avg_podcast_update_duration,
                 "feed_queue_status": feed_queue_status,
                 "num_index_outdated": num_index_outdated,
+                "num_index_batches": num_index_batches,
             }
         )
 
@@ -212,7 +216,9 @@ class MergeStatus(AdminView):
         result = merge_podcasts.AsyncResult(task_id)
 
         if not result.ready():
-            return self.render_to_response({"ready": False})
+            info = result.info if result.state == "PROGRESS" else {}
+            actions = (info or {}).get("actions", {})
+            return self.render_to_response({"ready": False, "actions": actions.items()})
 
         # clear cache to make merge result visible
         # TODO: what to do with multiple frontends?
@@ -1,3 +1,4 @@
+import base64
 from functools import partial
 
 from collections import defaultdict
@@ -17,12 +18,13 @@ from django.contrib.sites.requests import RequestSite
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.cache import never_cache
 from django.conf import settings as dsettings
+from django.db.models import Q
 from django.shortcuts import get_object_or_404
 
 from mygpo.podcasts.models import Podcast, Episode
 from mygpo.subscriptions.models import Subscription
 from mygpo.api.constants import EPISODE_ACTION_TYPES
-from mygpo.api.httpresponse import JsonResponse
+from mygpo.api.httpresponse import JsonResponse, StreamingJsonResponse
 from mygpo.api.advanced.directory import episode_data
 from mygpo.api.backend import get_device
 from mygpo.utils import (
@@ -132,6 +134,7 @@ def episodes(request, username, version=1):
         device_uid = request.GET.get("device", None)
         since_ = request.GET.get("since", None)
         aggregated = parse_bool(request.GET.get("aggregated", False))
+        cursor_ = request.GET.get("cursor", None)
 
         try:
             since = int(since_) if since_ else None
@@ -140,6 +143,11 @@ def episodes(request, username, version=1):
         except ValueError:
             return HttpResponseBadRequest("since-value is not a valid timestamp")
 
+        try:
+            cursor = decode_cursor(cursor_) if cursor_ else None
+        except ValueError:
+            return HttpResponseBadRequest("cursor is not valid")
+
         if podcast_url:
             podcast = get_object_or_404(Podcast, urls__url=podcast_url)
         else:
@@ -157,10 +165,10 @@ def episodes(request, username, version=1):
             device = None
 
         changes = get_episode_changes(
-            request.user, podcast, device, since, now, aggregated, version
+            request.user, podcast, device, since, now, aggregated, version, cursor
         )
 
-        return JsonResponse(changes)
+        return StreamingJsonResponse(changes)
 
 
 def convert_position(action):
@@ -171,12 +179,17 @@ def convert_position(action):
     return action
 
 
-def get_episode_changes(user, podcast, device, since, until, aggregated, version):
+def get_episode_changes(
+    user, podcast, device, since, until, aggregated, version, cursor=None
+):
+    """Returns the episode actions of a user, the earliest first
 
-    history = EpisodeHistoryEntry.objects.filter(user=user, timestamp__lt=until)
+    At most MAX_EPISODE_ACTIONS actions are returned. If there are more, the
+    returned cursor can be passed to get the next ones. The actions are
+    generated lazily; timestamp and cursor are callables that can only be
+    evaluated after all actions have been consumed."""
 
-    # return the earlier entries first
-    history = history.order_by("timestamp")
+    history = EpisodeHistoryEntry.objects.filter(user=user, timestamp__lt=until)
 
     if since:
         history = history.filter(timestamp__gte=since)
@@ -187,27 +200,84 @@ def get_episode_changes(user, podcast, device, since, until, aggregated, version
     if device is not None:
         history = history.filter(client=device)
 
-    if version == 1:
-        history = map(convert_position, history)
+    if aggregated:
+        # only the latest action of each episode
+        latest = history.order_by("episode_id", "-timestamp", "-id")
+        latest = latest.distinct("episode_id")
+        history = EpisodeHistoryEntry.objects.filter(id__in=latest.values("id"))
 
     # Limit number of returned episode actions
     max_actions = dsettings.MAX_EPISODE_ACTIONS
-    history = history[:max_actions]
+    state = {"last": None, "more": False}
 
-    # evaluate query and turn into list, for negative indexing
-    history = list(history)
+    def _actions():
+        entries = _iter_history(history, cursor, max_actions + 1)
+        for n, entry in enumerate(entries):
+            if n == max_actions:
+                state["more"] = True
+                break
 
-    actions = [episode_action_json(a, user) for a in history]
+            state["last"] = entry
 
-    if aggregated:
-        actions = list(dict((a["episode"], a) for a in actions).values())
+            if version == 1:
+                entry = convert_position(entry)
 
-    if history:
-        ts = get_timestamp(history[-1].timestamp)
-    else:
-        ts = get_timestamp(until)
+            yield episode_action_json(entry, user)
+
+    def _timestamp():
+        if state["last"]:
+            return get_timestamp(state["last"].timestamp)
+        else:
+            return get_timestamp(until)
+
+    def _cursor():
+        if state["more"]:
+            return encode_cursor(state["last"])
+
+    return {"actions": _actions(), "timestamp": _timestamp, "cursor": _cursor}
+
+
+def _iter_history(history, cursor, limit, chunk_size=200):
+    """ Yields up to limit entries of history that follow cursor """
+
+    while limit > 0:
+        entries = history.order_by("timestamp", "id")
+
+        if cursor is not None:
+            timestamp, pk = cursor
+            entries = entries.filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
+            )
+
+        entries = entries.select_related("client", "episode__podcast")
+        entries = entries.prefetch_related("episode__urls", "episode__podcast__urls")
+        entries = list(entries[: min(limit, chunk_size)])
 
-    return {"actions": actions, "timestamp": ts}
+        yield from entries
+
+        if len(entries) < chunk_size:
+            return
+
+        limit -= len(entries)
+        cursor = (entries[-1].timestamp, entries[-1].id)
+
+
+def encode_cursor(entry):
+    """ Returns an opaque cursor pointing after the history entry """
+    cursor = "{} {}".format(entry.timestamp.isoformat(), entry.id)
+    return base64.urlsafe_b64encode(cursor.encode("ascii")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """ Parses a cursor into a (timestamp, id) tuple; raises ValueError """
+    # invalid base64 and unicode errors are ValueErrors as well
+    cursor = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii")
+    timestamp, pk = cursor.split(" ")
+
+    try:
+        return dateutil.parser.parse(timestamp), int(pk)
+    except OverflowError as e:
+        raise ValueError(str(e))
 
 
 def episode_action_json(history, user):
@@ -231,9 +301,16 @@ def episode_action_json(history, user):
 
 
 def update_episodes(user, actions, now, ua_string):
+    """Stores the uploaded episode actions of a user
+
+    Podcasts, episodes and devices are resolved once per distinct URL / ID,
+    and the history entries are inserted in bulk, so that the number of
+    queries does not grow with the number of actions."""
     update_urls = []
 
-    # group all actions by their episode
+    # parse all actions and collect the URLs they reference
+    parsed = []
+    clients = {}
     for action in actions:
 
         podcast_url = action.get("podcast", "")
@@ -246,29 +323,39 @@ def update_episodes(user, actions, now, ua_string):
         if not episode_url:
             continue
 
-        podcast = Podcast.objects.get_or_create_for_url(podcast_url).object
-        episode = Episode.objects.get_or_create_for_url(podcast, episode_url).object
-
         # parse_episode_action returns a EpisodeHistoryEntry obj
-        history = parse_episode_action(action, user, update_urls, now, ua_string)
-
-        EpisodeHistoryEntry.create_entry(
-            user,
-            episode,
-            history.action,
-            history.client,
-            history.timestamp,
-            history.started,
-            history.stopped,
-            history.total,
-            podcast_url,
-            episode_url,
+        history = parse_episode_action(
+            action, user, update_urls, now, ua_string, clients
         )
+        parsed.append((podcast_url, episode_url, history))
+
+    podcasts = Podcast.objects.get_or_create_for_urls(
+        podcast_url for podcast_url, _episode_url, _history in parsed
+    )
+
+    episodes = Episode.objects.get_or_create_for_podcast_urls(
+        (podcasts[podcast_url].object, episode_url)
+        for podcast_url, episode_url, _history in parsed
+    )
+
+    entries = []
+    for podcast_url, episode_url, history in parsed:
+        podcast = podcasts[podcast_url].object
+        history.user = user
+        history.episode = episodes[(podcast, episode_url)].object
+        history.podcast_ref_url = podcast_url
+        history.episode_ref_url = episode_url
+        entries.append(history)
+
+    EpisodeHistoryEntry.create_entries(entries)
 
     return update_urls
 
 
-def parse_episode_action(action, user, update_urls, now, ua_string):
+def parse_episode_action(action, user, update_urls, now, ua_string, clients=None):
+    """Parses an uploaded episode action into an EpisodeHistoryEntry
+
+    ``clients`` can be a dict in which devices are cached by their uid"""
     action_str = action.get("action", None)
     if not valid_episodeaction(action_str):
         raise Exception("invalid action %s" % action_str)
@@ -278,8 +365,11 @@ def parse_episode_action(action, user, update_urls, now, ua_string):
     history.action = action["action"]
 
     if action.get("device", False):
-        client = get_device(user, action["device"], ua_string)
-        history.client = client
+        clients = {} if clients is None else clients
+        uid = action["device"]
+        if uid not in clients:
+            clients[uid] = get_device(user, uid, ua_string)
+        history.client = clients[uid]
 
     if action.get("timestamp", False):
         history.timestamp = dateutil.parser.parse(action["timestamp"])
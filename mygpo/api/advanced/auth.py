@@ -1,11 +1,14 @@
 from datetime import datetime, timedelta
 
+from django.conf import settings
 from django.contrib import auth
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseForbidden
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.cache import never_cache
 
 from mygpo.api.basic_auth import require_valid_user, check_username
+from mygpo.api.backend import get_device
+from mygpo.api.httpresponse import JsonResponse
 from mygpo.decorators import allowed_methods, cors_origin
 
 
@@ -20,6 +23,13 @@ def login(request, username):
     authenticates the user with regular http basic auth
     """
 
+    # a session would give the client access to the whole account
+    if request.auth_client is not None:
+        return HttpResponseForbidden("API tokens can not be used to log in")
+
+    # other API requests don't create sessions
+    backend = getattr(request.user, "backend", settings.AUTHENTICATION_BACKENDS[0])
+    auth.login(request, request.user, backend=backend)
     request.session.set_expiry(datetime.utcnow() + timedelta(days=365))
     return HttpResponse()
 
@@ -36,3 +46,30 @@ def logout(request, username):
 
     auth.logout(request)
     return HttpResponse()
+
+
+@csrf_exempt
+@require_valid_user
+@check_username
+@allowed_methods(["POST", "DELETE"])
+@never_cache
+@cors_origin()
+def device_token(request, username, device_uid):
+    """
+    creates a new API token for the device, or revokes its token
+    """
+
+    # otherwise a leaked token could be used to replace all other tokens
+    if request.auth_client is not None:
+        return HttpResponseForbidden("API tokens can not be used to manage tokens")
+
+    device = get_device(
+        request.user, device_uid, request.META.get("HTTP_USER_AGENT", "")
+    )
+
+    if request.method == "DELETE":
+        device.auth_token = None
+        device.save(update_fields=["auth_token"])
+        return HttpResponse()
+
+    return JsonResponse({"token": device.create_auth_token()})
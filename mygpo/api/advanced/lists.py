@@ -139,6 +139,7 @@ def get_list(request, plist, owner, format):
     )
 
 
+@require_valid_user
 @list_decorator(must_own=True)
 @cors_origin()
 def update_list(request, plist, owner, format):
@@ -150,6 +151,7 @@ def update_list(request, plist, owner, format):
     return HttpResponse(status=204)
 
 
+@require_valid_user
 @list_decorator(must_own=True)
 @cors_origin()
 def delete_list(request, plist, owner, format):
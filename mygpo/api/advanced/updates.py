@@ -80,9 +80,14 @@ class DeviceUpdates(View):
         """ gets new, removed and current subscriptions """
 
         history = get_subscription_history(user, device, since, now)
+        history = history.select_related("podcast").prefetch_related(
+            "podcast__slugs", "podcast__urls"
+        )
         add, rem = subscription_diff(history)
 
-        subscriptions = device.get_subscribed_podcasts()
+        subscriptions = device.get_subscribed_podcasts().prefetch_related(
+            "slugs", "urls"
+        )
 
         add = [podcast_data(p, domain) for p in add]
         rem = [p.url for p in rem]
@@ -93,9 +98,9 @@ class DeviceUpdates(View):
         devices = {dev.id.hex: dev.uid for dev in user.client_set.all()}
 
         # index subscribed podcasts by their Id for fast access
-        podcasts = {p.get_id(): p for p in subscriptions}
+        podcasts = {p.id: p for p in subscriptions}
 
-        episode_updates = self.get_episode_updates(user, subscriptions, since)
+        episode_updates = self.get_episode_updates(user, podcasts.keys(), since)
 
         return [
             self.get_episode_data(
@@ -104,15 +109,16 @@ class DeviceUpdates(View):
             for status in episode_updates
         ]
 
-    def get_episode_updates(self, user, subscribed_podcasts, since, max_per_podcast=5):
+    def get_episode_updates(self, user, podcast_ids, since, max_per_podcast=5):
         """ Returns the episode updates since the timestamp """
 
-        episodes = []
-        for podcast in subscribed_podcasts:
-            eps = Episode.objects.filter(podcast=podcast, released__gt=since).order_by(
-                "-order", "-released"
-            )
-            episodes.extend(eps[:max_per_podcast])
+        episodes = (
+            Episode.objects.filter(podcast__in=list(podcast_ids), released__gt=since)
+            .latest_per_podcast(max_per_podcast)
+            .order_by("podcast", "-order", "-released")
+            .prefetch_related("slugs", "urls")
+        )
+        episodes = list(episodes)
 
         states = EpisodeState.dict_for_user(user, episodes)
 
@@ -124,8 +130,7 @@ class DeviceUpdates(View):
     ):
         """ Get episode data for an episode status object """
 
-        # TODO: shouldn't the podcast_id be in the episode status?
-        podcast_id = episode_status.episode.podcast
+        podcast_id = episode_status.episode.podcast_id
         podcast = podcasts.get(podcast_id, None)
         t = episode_data(episode_status.episode, domain, podcast)
         t["status"] = episode_status.status
@@ -1,9 +1,14 @@
 import base64
 import binascii
+import hashlib
+import hmac
+import re
 from functools import wraps
 
+from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse, HttpResponseBadRequest
-from django.contrib.auth import authenticate, login
+from django.contrib.auth import authenticate, get_user_model
 
 import logging
 
@@ -19,6 +24,9 @@ def view_or_basicauth(view, request, test_func, realm="", *args, **kwargs):
     are already logged in or if they have provided proper http-authorization
     and returning the view if all goes well, otherwise responding with a 401.
     """
+    # the client whose API token authenticated the request, if any
+    request.auth_client = None
+
     if test_func(request.user):
         # Already logged in, just return the view.
         return view(request, *args, **kwargs)
@@ -53,9 +61,16 @@ def view_or_basicauth(view, request, test_func, realm="", *args, **kwargs):
 
             if len(credentials) == 2:
                 uname, passwd = credentials
-                user = authenticate(username=uname, password=passwd)
-                if user is not None and user.is_active:
-                    login(request, user)
+
+                client = authenticate_token(uname, passwd)
+                if client is not None:
+                    request.user = client.user
+                    request.auth_client = client
+                    return view(request, *args, **kwargs)
+
+                user = authenticate_credentials(uname, passwd)
+                if user is not None:
+                    # API clients are stateless, so no session is created
                     request.user = user
 
                     return view(request, *args, **kwargs)
@@ -63,6 +78,79 @@ def view_or_basicauth(view, request, test_func, realm="", *args, **kwargs):
     return auth_request()
 
 
+# API tokens of clients, see Client.create_auth_token()
+RE_AUTH_TOKEN = re.compile(r"^([0-9a-f]{32})\.(.+)$")
+
+
+def authenticate_credentials(username, password):
+    """Returns the active user for the credentials, or None
+
+    Verified passwords are cached for API_AUTH_CACHE_TIMEOUT seconds, so
+    that they don't have to be hashed again on every request. The user's
+    last_login is updated whenever the password is verified."""
+
+    key = "api-auth-" + _keyed_hash(username + ":" + password)
+    cached = cache.get(key)
+    if cached is not None:
+        user_pk, fingerprint = cached
+        User = get_user_model()
+        user = User.objects.filter(pk=user_pk, is_active=True).first()
+
+        # the fingerprint changes with the password
+        if user is not None and hmac.compare_digest(
+            fingerprint, _keyed_hash(user.password)
+        ):
+            return user
+
+    user = authenticate(username=username, password=password)
+    if user is None or not user.is_active:
+        return None
+
+    # login() isn't called for API requests, but last_login is used to
+    # pick between accounts whose usernames only differ in case
+    from django.contrib.auth.models import update_last_login
+
+    update_last_login(None, user)
+
+    if settings.API_AUTH_CACHE_TIMEOUT:
+        cached = (user.pk, _keyed_hash(user.password))
+        cache.set(key, cached, settings.API_AUTH_CACHE_TIMEOUT)
+
+    return user
+
+
+def authenticate_token(username, password):
+    """Returns the client whose API token is given as password, or None
+
+    The token authenticates its client's user for all API requests, but
+    can't be used to create tokens or sessions."""
+
+    match = RE_AUTH_TOKEN.match(password)
+    if not match:
+        return None
+
+    client_id, secret = match.groups()
+
+    from mygpo.users.models import Client
+
+    client = Client.objects.select_related("user").filter(id=client_id).first()
+    if client is None or client.deleted or not client.user.is_active:
+        return None
+
+    if client.user.username.lower() != username.lower():
+        return None
+
+    if not client.check_auth_token(secret):
+        return None
+
+    return client
+
+
+def _keyed_hash(value):
+    key = settings.SECRET_KEY.encode("utf-8")
+    return hmac.new(key, value.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
 def auth_request(realm=""):
     # Either they did not provide an authorization header or
     # something in the authorization attempt failed. Send a 401
@@ -81,7 +169,7 @@ def require_valid_user(protected_view):
     logged in the request is examined for a 'authorization' header.
 
     If the header is present it is tested for basic authentication and
-    the user is logged in with the provided credentials.
+    the user is authenticated with the provided credentials.
 
     If the header is not present a http 401 is sent back to the
     requestor to provide credentials.
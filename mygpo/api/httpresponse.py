@@ -1,17 +1,68 @@
-import json
+import types
 
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+
+from mygpo.api.serialization import get_serializer, iter_array
 
 
 class JsonResponse(HttpResponse):
     def __init__(self, object, jsonp_padding=None):
-        content = json.dumps(object, ensure_ascii=True)
+        content = get_serializer().dumps(object)
 
         if jsonp_padding:
-            content = "%(func)s(%(obj)s)" % {"func": jsonp_padding, "obj": content}
+            content = b"%(func)s(%(obj)s)" % {
+                b"func": jsonp_padding.encode("ascii"),
+                b"obj": content,
+            }
             content_type = "application/json-p"
 
         else:
             content_type = "application/json"
 
         super(JsonResponse, self).__init__(content, content_type=content_type)
+
+
+class StreamingJsonResponse(StreamingHttpResponse):
+    """Streams a JSON array or object
+
+    A generator is sent as JSON array while it is consumed. The same holds
+    for generators among the values of an object; callable values are called
+    after all preceding values have been sent."""
+
+    def __init__(self, object, jsonp_padding=None):
+        content = _stream(object, get_serializer())
+
+        if jsonp_padding:
+            content = _pad(content, jsonp_padding)
+            content_type = "application/json-p"
+
+        else:
+            content_type = "application/json"
+
+        super(StreamingJsonResponse, self).__init__(content, content_type=content_type)
+
+
+def _stream(obj, serializer):
+    if isinstance(obj, types.GeneratorType):
+        yield from iter_array(obj, serializer)
+        return
+
+    yield b"{"
+    for n, (key, value) in enumerate(obj.items()):
+        if n:
+            yield b", "
+        yield serializer.dumps(key) + b": "
+
+        if isinstance(value, types.GeneratorType):
+            yield from iter_array(value, serializer)
+        else:
+            if callable(value):
+                value = value()
+            yield serializer.dumps(value)
+    yield b"}"
+
+
+def _pad(content, jsonp_padding):
+    yield jsonp_padding.encode("ascii") + b"("
+    yield from content
+    yield b")"
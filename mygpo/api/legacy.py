@@ -1,4 +1,4 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.datastructures import MultiValueDictKeyError
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.cache import never_cache
@@ -27,7 +27,7 @@ def upload(request):
         password = request.POST["password"]
         action = request.POST["action"]
         protocol = request.POST["protocol"]
-        opml = request.FILES["opml"].read()
+        opml = request.FILES["opml"]
     except MultiValueDictKeyError:
         return HttpResponse("@PROTOERROR", content_type="text/plain")
 
@@ -41,7 +41,7 @@ def upload(request):
 
     i = Importer(opml)
 
-    podcast_urls = [p["url"] for p in i.items]
+    podcast_urls = [p["url"] for p in i]
     podcast_urls = map(normalize_feed_url, podcast_urls)
     podcast_urls = list(filter(None, podcast_urls))
 
@@ -81,9 +81,9 @@ def getlist(request):
     title = "{username}'s subscriptions".format(username=user.username)
     exporter = Exporter(title)
 
-    opml = exporter.generate(podcasts)
+    opml = exporter.stream(podcasts)
 
-    return HttpResponse(opml, content_type="text/xml")
+    return StreamingHttpResponse(opml, content_type="text/xml")
 
 
 def auth(emailaddr, password):
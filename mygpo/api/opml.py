@@ -4,12 +4,15 @@
 
 This module contains helper classes to import subscriptions from OPML files on
 the web and to export a list of podcast objects to valid OPML 2.0 files.
+
+Both work incrementally, so that large documents don't have to be held in
+memory completely.
 """
 
+import io
 import os
-
-import xml.dom.minidom
-from xml.parsers.expat import ExpatError
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
 import email.utils
 
 
@@ -18,41 +21,83 @@ class Importer(object):
 
     def __init__(self, content):
         """
-        Parses the OPML feed from the given URL into a local data structure
-        containing podcast metadata.
+        Prepares to parse the OPML document in content, which can be a
+        string, bytes or a file-like object.
+
+        The podcast metadata is available by iterating over the importer or,
+        as a list, in the items attribute. ValueError is raised if the
+        document is not valid.
         """
-        self.items = []
+        if isinstance(content, str):
+            content = io.StringIO(content)
+        elif isinstance(content, bytes):
+            content = io.BytesIO(content)
+
+        self.content = content
+        self._items = None
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = list(self)
+        return self._items
+
+    def __iter__(self):
+        """ Parses the document incrementally and yields its podcasts """
+
+        # elements are removed from their parent once they have been parsed
+        parents = []
 
         try:
-            doc = xml.dom.minidom.parseString(content)
-        except ExpatError as e:
+            for event, elem in ElementTree.iterparse(
+                self.content, events=("start", "end")
+            ):
+                if event == "end":
+                    parents.pop()
+                    if parents:
+                        parents[-1].remove(elem)
+                    continue
+
+                parents.append(elem)
+
+                # ignore namespaces
+                if elem.tag.rsplit("}", 1)[-1] != "outline":
+                    continue
+
+                channel = self.parse_outline(elem)
+                if channel:
+                    yield channel
+
+        except ElementTree.ParseError as e:
             raise ValueError from e
 
-        for outline in doc.getElementsByTagName("outline"):
-            if (
-                outline.getAttribute("type") in self.VALID_TYPES
-                and outline.getAttribute("xmlUrl")
-                or outline.getAttribute("url")
-            ):
-                channel = {
-                    "url": outline.getAttribute("xmlUrl")
-                    or outline.getAttribute("url"),
-                    "title": outline.getAttribute("title")
-                    or outline.getAttribute("text")
-                    or outline.getAttribute("xmlUrl")
-                    or outline.getAttribute("url"),
-                    "description": outline.getAttribute("text")
-                    or outline.getAttribute("xmlUrl")
-                    or outline.getAttribute("url"),
-                }
+    def parse_outline(self, outline):
+        """ Returns podcast metadata of an outline element, or None """
+        attrs = outline.attrib
+
+        if not (
+            attrs.get("type") in self.VALID_TYPES
+            and attrs.get("xmlUrl")
+            or attrs.get("url")
+        ):
+            return None
 
-                if channel["description"] == channel["title"]:
-                    channel["description"] = channel["url"]
+        channel = {
+            "url": attrs.get("xmlUrl") or attrs.get("url"),
+            "title": attrs.get("title")
+            or attrs.get("text")
+            or attrs.get("xmlUrl")
+            or attrs.get("url"),
+            "description": attrs.get("text") or attrs.get("xmlUrl") or attrs.get("url"),
+        }
 
-                for attr in ("url", "title", "description"):
-                    channel[attr] = channel[attr].strip()
+        if channel["description"] == channel["title"]:
+            channel["description"] = channel["url"]
 
-                self.items.append(channel)
+        for attr in ("url", "title", "description"):
+            channel[attr] = channel[attr].strip()
+
+        return channel
 
 
 class Exporter(object):
@@ -72,52 +117,64 @@ class Exporter(object):
 
         Returns: An OPML document as string
         """
-        doc = xml.dom.minidom.Document()
-
-        opml = doc.createElement("opml")
-        opml.setAttribute("version", "2.0")
-        doc.appendChild(opml)
-
-        def create_node(name, content):
-            node = doc.createElement(name)
-            node.appendChild(doc.createTextNode(content))
-            return node
-
-        head = doc.createElement("head")
-        head.appendChild(create_node("title", self.title or ""))
-        head.appendChild(create_node("dateCreated", self.created))
-        opml.appendChild(head)
-
-        def create_outline(channel):
-            from mygpo.subscriptions.models import SubscribedPodcast
-            from mygpo.podcasts.models import PodcastGroup
-
-            outline = doc.createElement("outline")
-
-            if isinstance(channel, SubscribedPodcast):
-                title = channel.podcast.title
-                outline.setAttribute("xmlUrl", channel.ref_url)
-                outline.setAttribute("description", channel.podcast.description or "")
-                outline.setAttribute("type", "rss")
-                outline.setAttribute("htmlUrl", channel.podcast.link or "")
-            elif isinstance(channel, PodcastGroup):
-                title = channel.title
-                for subchannel in channel.podcast_set.all():
-                    outline.appendChild(create_outline(subchannel))
-            else:
-                title = channel.title
-                outline.setAttribute("xmlUrl", channel.url)
-                outline.setAttribute("description", channel.description or "")
-                outline.setAttribute("type", "rss")
-                outline.setAttribute("htmlUrl", channel.link or "")
-
-            outline.setAttribute("title", title or "")
-            outline.setAttribute("text", title or "")
-            return outline
-
-        body = doc.createElement("body")
+        return b"".join(self.stream(channels))
+
+    def stream(self, channels):
+        """ Yields the OPML document for channels in UTF-8 encoded chunks """
+        lines = self._lines(channels)
+        return (line.encode("utf-8") + os.linesep.encode("ascii") for line in lines)
+
+    def _lines(self, channels):
+        yield '<?xml version="1.0" encoding="utf-8"?>'
+        yield '<opml version="2.0">'
+        yield "  <head>"
+        yield "    <title>%s</title>" % escape(self.title or "")
+        yield "    <dateCreated>%s</dateCreated>" % escape(self.created)
+        yield "  </head>"
+        yield "  <body>"
         for channel in channels:
-            body.appendChild(create_outline(channel))
-        opml.appendChild(body)
-
-        return doc.toprettyxml(encoding="utf-8", indent="  ", newl=os.linesep)
+            yield from self._outline(channel, "    ")
+        yield "  </body>"
+        yield "</opml>"
+
+    def _outline(self, channel, indent):
+        from mygpo.subscriptions.models import SubscribedPodcast
+        from mygpo.podcasts.models import PodcastGroup
+
+        subchannels = []
+
+        if isinstance(channel, SubscribedPodcast):
+            title = channel.podcast.title
+            attrs = [
+                ("xmlUrl", channel.ref_url),
+                ("description", channel.podcast.description or ""),
+                ("type", "rss"),
+                ("htmlUrl", channel.podcast.link or ""),
+            ]
+        elif isinstance(channel, PodcastGroup):
+            title = channel.title
+            attrs = []
+            subchannels = channel.podcast_set.all()
+        else:
+            title = channel.title
+            attrs = [
+                ("xmlUrl", channel.url),
+                ("description", channel.description or ""),
+                ("type", "rss"),
+                ("htmlUrl", channel.link or ""),
+            ]
+
+        attrs += [("title", title or ""), ("text", title or "")]
+        attrs = " ".join(
+            '%s="%s"' % (name, escape(value or "", {'"': "&quot;"}))
+            for name, value in attrs
+        )
+
+        if not subchannels:
+            yield "%s<outline %s/>" % (indent, attrs)
+            return
+
+        yield "%s<outline %s>" % (indent, attrs)
+        for subchannel in subchannels:
+            yield from self._outline(subchannel, indent + "  ")
+        yield "%s</outline>" % (indent,)
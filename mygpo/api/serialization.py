@@ -0,0 +1,55 @@
+""" Serialization of API responses
+
+The JSON backend is configured in the setting JSON_SERIALIZER.
+"""
+
+import functools
+import json
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class StdlibSerializer(object):
+    """ Serializes with the json module of the standard library """
+
+    def dumps(self, obj):
+        return json.dumps(obj, ensure_ascii=True).encode("ascii")
+
+
+class OrjsonSerializer(object):
+    """Serializes with orjson, which has to be installed
+
+    Non-ASCII characters are written as UTF-8 instead of being escaped."""
+
+    def __init__(self):
+        import orjson
+
+        self.orjson = orjson
+
+    def dumps(self, obj):
+        return self.orjson.dumps(obj)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_serializer(path):
+    return import_string(path)()
+
+
+def get_serializer():
+    """ Returns an instance of the configured serializer """
+    return _get_serializer(settings.JSON_SERIALIZER)
+
+
+def dumps(obj):
+    """ Serializes obj to JSON bytes """
+    return get_serializer().dumps(obj)
+
+
+def iter_array(items, serializer=None):
+    """ Yields a JSON array of items in chunks, while items are consumed """
+    serializer = serializer or get_serializer()
+    yield b"["
+    for n, item in enumerate(items):
+        yield (b", " if n else b"") + serializer.dumps(item)
+    yield b"]"
@@ -4,7 +4,7 @@ from functools import wraps
 
 from django.shortcuts import render
 from django.core.cache import cache
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.views.decorators.cache import cache_page
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.cache import never_cache
@@ -15,12 +15,14 @@ from mygpo.api.basic_auth import require_valid_user, check_username
 from mygpo.api.backend import get_device
 from mygpo.podcasts.models import Podcast
 from mygpo.api.opml import Exporter, Importer
-from mygpo.api.httpresponse import JsonResponse
+from mygpo.api.httpresponse import JsonResponse, StreamingJsonResponse
 from mygpo.directory.models import ExamplePodcast
 from mygpo.api.advanced.directory import podcast_data
 from mygpo.subscriptions import get_subscribed_podcasts
-from mygpo.subscriptions.tasks import subscribe, unsubscribe
+from mygpo.directory.toplist import get_toplist
+from mygpo.subscriptions.tasks import subscribe_many, unsubscribe_many
 from mygpo.directory.search import search_podcasts
+from mygpo.search.index import autocomplete_podcasts
 from mygpo.decorators import allowed_methods, cors_origin
 from mygpo.utils import parse_range, normalize_feed_url
 
@@ -113,6 +115,7 @@ def format_podcast_list(
     xml_template=None,
     request=None,
     template_args={},
+    stream=True,
 ):
     """
     Formats a list of podcasts for use in a API response
@@ -124,6 +127,8 @@ def format_podcast_list(
       function used to get the podcast out of the each of these objects
     json_map is a function returning the contents of an object (from obj_list)
       that should be contained in the result (only used for format='json')
+    stream sends OPML and JSON documents while they are generated; streamed
+      responses are not cached by cache_page
     """
 
     def default_get_podcast(p):
@@ -139,10 +144,17 @@ def format_podcast_list(
     elif format == "opml":
         podcasts = map(get_podcast, obj_list)
         exporter = Exporter(title)
+        if stream:
+            opml = exporter.stream(podcasts)
+            return StreamingHttpResponse(opml, content_type="text/xml")
+
         opml = exporter.generate(podcasts)
         return HttpResponse(opml, content_type="text/xml")
 
     elif format == "json":
+        if stream:
+            return StreamingJsonResponse(json_map(obj) for obj in obj_list)
+
         objs = list(map(json_map, obj_list))
         return JsonResponse(objs)
 
@@ -160,6 +172,10 @@ def format_podcast_list(
                 % {"char": ALLOWED_FUNCNAME}
             )
 
+        if stream:
+            objs = (json_map(obj) for obj in obj_list)
+            return StreamingJsonResponse(objs, jsonp_padding=jsonp_padding)
+
         objs = list(map(json_map, obj_list))
         return JsonResponse(objs, jsonp_padding=jsonp_padding)
 
@@ -192,7 +208,7 @@ def parse_subscription(raw_post_data, format):
         begin = raw_post_data.find("<?xml")
         end = raw_post_data.find("</opml>") + 7
         i = Importer(content=raw_post_data[begin:end])
-        urls = [p["url"] for p in i.items]
+        urls = [p["url"] for p in i]
 
     elif format == "json":
         begin = raw_post_data.find("[")
@@ -221,13 +237,11 @@ def set_subscriptions(urls, user, device_uid, user_agent):
     new = [p for p in urls if p not in subscriptions.keys()]
     rem = [p for p in subscriptions.keys() if p not in urls]
 
-    remove_podcasts = Podcast.objects.filter(urls__url__in=rem)
-    for podcast in remove_podcasts:
-        unsubscribe(podcast.pk, user.pk, device.uid)
+    remove_podcasts = Podcast.objects.filter(urls__url__in=rem).distinct()
+    unsubscribe_many(remove_podcasts, user, device)
 
-    for url in new:
-        podcast = Podcast.objects.get_or_create_for_url(url).object
-        subscribe(podcast.pk, user.pk, device.uid, url)
+    podcasts = Podcast.objects.get_or_create_for_urls(new)
+    subscribe_many([(podcasts[url].object, url) for url in new], user, device)
 
     # Only an empty response is a successful response
     return HttpResponse("", content_type="text/plain")
@@ -240,7 +254,9 @@ def set_subscriptions(urls, user, device_uid, user_agent):
 def toplist(request, count, format):
     count = parse_range(count, 1, 100, 100)
 
-    entries = Podcast.objects.all().toplist()[:count]
+    entries = get_toplist(
+        num=count, queryset=Podcast.objects.prefetch_related("urls", "slugs")
+    )
     domain = RequestSite(request).domain
 
     try:
@@ -266,6 +282,7 @@ def toplist(request, count, format):
         jsonp_padding=request.GET.get("jsonp", ""),
         xml_template="podcasts.xml",
         request=request,
+        stream=False,
     )
 
 
@@ -303,6 +320,44 @@ def search(request, format):
         jsonp_padding=request.GET.get("jsonp", ""),
         xml_template="podcasts.xml",
         request=request,
+        stream=False,
+    )
+
+
+@check_format
+@cache_page(60 * 5)
+@allowed_methods(["GET"])
+@cors_origin()
+def autocomplete(request, format):
+    """ Suggests podcasts while the user types a search query """
+
+    query = request.GET.get("q", "")
+
+    try:
+        scale = int(request.GET.get("scale_logo", 64))
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest("scale_logo has to be a numeric value")
+
+    if scale not in range(1, 257):
+        return HttpResponseBadRequest("scale_logo has to be a number from 1 to 256")
+
+    if not query:
+        return HttpResponseBadRequest("/search/autocomplete.opml|txt|json?q={query}")
+
+    results = autocomplete_podcasts(query)[:]
+
+    title = _("gpodder.net - Search")
+    domain = RequestSite(request).domain
+    p_data = lambda p: podcast_data(p, domain, scale)
+    return format_podcast_list(
+        results,
+        format,
+        title,
+        json_map=p_data,
+        jsonp_padding=request.GET.get("jsonp", ""),
+        xml_template="podcasts.xml",
+        request=request,
+        stream=False,
     )
 
 
@@ -364,4 +419,5 @@ def example_podcasts(request, format):
         json_map=p_data,
         xml_template="podcasts.xml",
         request=request,
+        stream=False,
     )
@@ -8,8 +8,8 @@ from mygpo.api.httpresponse import JsonResponse
 from mygpo.api.backend import get_device
 from mygpo.utils import get_timestamp, normalize_feed_url, intersect
 from mygpo.users.models import Client
-from mygpo.subscriptions.tasks import subscribe, unsubscribe
-from mygpo.subscriptions import get_subscription_history, subscription_diff
+from mygpo.subscriptions.models import SubscriptionChange
+from mygpo.subscriptions.tasks import subscribe_many, unsubscribe_many
 from mygpo.api.basic_auth import require_valid_user, check_username
 
 import logging
@@ -76,38 +76,33 @@ class SubscriptionsAPI(APIView):
         pairs = zip(add + remove, add_s + rem_s)
         updated_urls = list(filter(lambda pair: pair[0] != pair[1], pairs))
 
-        add_s = filter(None, add_s)
-        rem_s = filter(None, rem_s)
+        add_s = list(filter(None, add_s))
+        rem_s = list(filter(None, rem_s))
 
         # If two different URLs (in add and remove) have
         # been sanitized to the same, we ignore the removal
-        rem_s = filter(lambda x: x not in add_s, rem_s)
+        rem_s = [x for x in rem_s if x not in add_s]
 
-        for add_url in add_s:
-            podcast = Podcast.objects.get_or_create_for_url(add_url).object
-            subscribe(podcast.pk, user.pk, device.uid, add_url)
+        podcasts = Podcast.objects.get_or_create_for_urls(add_s)
+        add_podcasts = [(podcasts[add_url].object, add_url) for add_url in add_s]
+        subscribe_many(add_podcasts, user, device)
 
-        remove_podcasts = Podcast.objects.filter(urls__url__in=rem_s)
-        for podcast in remove_podcasts:
-            unsubscribe(podcast.pk, user.pk, device.uid)
+        remove_podcasts = Podcast.objects.filter(urls__url__in=rem_s).distinct()
+        unsubscribe_many(remove_podcasts, user, device)
 
         return updated_urls
 
     def get_changes(self, user, device, since, until):
         """ Returns subscription changes for the given device """
-        history = get_subscription_history(user, device, since, until)
-        logger.info("Subscription History: {num}".format(num=len(history)))
+        changes = SubscriptionChange.objects.changes_since(device, since, until)
 
-        add, rem = subscription_diff(history)
+        add_urls = [ref_url for ref_url, subscribed in changes if subscribed]
+        rem_urls = [ref_url for ref_url, subscribed in changes if not subscribed]
         logger.info(
-            "Subscription Diff: +{num_add}/-{num_remove}".format(
-                num_add=len(add), num_remove=len(rem)
+            "Subscription Changes: +{num_add}/-{num_remove}".format(
+                num_add=len(add_urls), num_remove=len(rem_urls)
             )
         )
 
         until_ = get_timestamp(until)
-
-        # TODO: we'd need to get the ref_urls here somehow
-        add_urls = [p.url for p in add]
-        rem_urls = [p.url for p in rem]
         return (add_urls, rem_urls, until_)
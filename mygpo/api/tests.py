@@ -1,26 +1,36 @@
 import copy
+import io
 from datetime import datetime, timedelta
 import json
 import unittest
 import os
+from types import SimpleNamespace
+import uuid
 import unittest.mock
 from urllib.parse import urlencode
 
+from django.core.cache import cache
+from django.db import connection
 from django.test.client import Client
 from django.test import TestCase
 from django.urls import reverse
-from django.contrib.auth import get_user_model
-from django.test.utils import override_settings
+from django.contrib.auth import authenticate, get_user_model
+from django.test.utils import override_settings, CaptureQueriesContext
 
 from openapi_spec_validator import validate_spec_url
 from jsonschema import ValidationError
 
 from mygpo.podcasts.models import Podcast, Episode
+from mygpo.api import basic_auth
 from mygpo.api.advanced import episodes
 from mygpo.api.opml import Exporter, Importer
 from mygpo.api.simple import format_podcast_list
+from mygpo.api.httpresponse import StreamingJsonResponse
+from mygpo.api.serialization import StdlibSerializer
 from mygpo.history.models import EpisodeHistoryEntry
-from mygpo.test import create_auth_string
+from mygpo.subscriptions.tasks import subscribe_many
+from mygpo.test import create_auth_string, create_user
+from mygpo.users.models import Client as UserClient
 from mygpo.utils import get_timestamp
 
 
@@ -66,11 +76,58 @@ class AdvancedAPITests(unittest.TestCase):
 
         url = reverse(episodes, kwargs={"version": "2", "username": self.user.username})
         response = self.client.get(url, {"since": "0"}, **self.extra)
-        self.assertEqual(response.status_code, 200, response.content)
-        response_obj = json.loads(response.content.decode("utf-8"))
+        content = response.getvalue()
+        self.assertEqual(response.status_code, 200, content)
+        response_obj = json.loads(content.decode("utf-8"))
         actions = response_obj["actions"]
         self.assertTrue(self.compare_action_list(self.action_data, actions))
 
+    def test_upload_duplicate_actions(self):
+        """ Re-uploaded actions are only stored once """
+        for _ in range(2):
+            response = self._upload_episode_actions(
+                self.user, self.action_data, self.extra
+            )
+            self.assertEqual(response.status_code, 200, response.content)
+
+        entries = EpisodeHistoryEntry.objects.filter(user=self.user)
+        self.assertEqual(entries.count(), len(self.action_data))
+
+    def test_upload_many_actions(self):
+        """ The number of queries does not depend on the number of actions """
+
+        def _actions(name, n):
+            return [
+                {
+                    "podcast": "http://example.com/feed-%d.rss" % (i % 3),
+                    "episode": "http://example.com/files/%s-%d.mp3" % (name, i),
+                    "device": "gpodder_abcdef123",
+                    "action": "play",
+                    "position": i,
+                    "timestamp": "2009-12-12T09:00:00",
+                }
+                for i in range(n)
+            ]
+
+        # the first upload creates the device and podcasts
+        self._upload_episode_actions(self.user, _actions("first", 3), self.extra)
+
+        with CaptureQueriesContext(connection) as few:
+            response = self._upload_episode_actions(
+                self.user, _actions("few", 5), self.extra
+            )
+            self.assertEqual(response.status_code, 200, response.content)
+
+        with CaptureQueriesContext(connection) as many:
+            response = self._upload_episode_actions(
+                self.user, _actions("many", 50), self.extra
+            )
+            self.assertEqual(response.status_code, 200, response.content)
+
+        self.assertEqual(len(few), len(many))
+        entries = EpisodeHistoryEntry.objects.filter(user=self.user)
+        self.assertEqual(entries.count(), 3 + 5 + 50)
+
     def test_invalid_client_id(self):
         """ Invalid Client ID should return 400 """
         action_data = copy.deepcopy(self.action_data)
@@ -157,6 +214,35 @@ class SubscriptionAPITests(unittest.TestCase):
         self.assertEqual(self.action_data["add"], response_obj["add"])
         self.assertEqual([], response_obj.get("remove", []))
 
+    def test_remove_subscription(self):
+        """ Tests that a removed subscription is only returned if known """
+        self._post(self.action_data)
+        response = self.client.get(self.url, {"since": "0"}, **self.extra)
+        since = json.loads(response.content.decode("utf-8"))["timestamp"]
+
+        self._post({"remove": self.action_data["add"]})
+
+        response = self.client.get(self.url, {"since": since}, **self.extra)
+        self.assertEqual(response.status_code, 200, response.content)
+        response_obj = json.loads(response.content.decode("utf-8"))
+        self.assertEqual([], response_obj["add"])
+        self.assertEqual(self.action_data["add"], response_obj["remove"])
+
+        # a new client has never seen the subscription
+        response = self.client.get(self.url, {"since": "0"}, **self.extra)
+        response_obj = json.loads(response.content.decode("utf-8"))
+        self.assertEqual([], response_obj["add"])
+        self.assertEqual([], response_obj["remove"])
+
+    def _post(self, action_data):
+        response = self.client.post(
+            self.url,
+            json.dumps(action_data),
+            content_type="application/json",
+            **self.extra,
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+
     def test_unauth_request(self):
         """ Tests that an unauthenticated request gives a 401 response """
         response = self.client.get(self.url, {"since": "0"})
@@ -235,8 +321,9 @@ class EpisodeActionTests(TestCase):
 
         url = reverse(episodes, kwargs={"version": "2", "username": self.user.username})
         response = self.client.get(url, {"since": "0"}, **self.extra)
-        self.assertEqual(response.status_code, 200, response.content)
-        response_obj = json.loads(response.content.decode("utf-8"))
+        content = response.getvalue()
+        self.assertEqual(response.status_code, 200, content)
+        response_obj = json.loads(content.decode("utf-8"))
         actions = response_obj["actions"]
 
         # 10 actions should be returned
@@ -252,6 +339,67 @@ class EpisodeActionTests(TestCase):
         # last returned action
         self.assertEqual(get_timestamp(timestamps[9]), response_obj["timestamp"])
 
+    @override_settings(MAX_EPISODE_ACTIONS=10)
+    def test_cursor(self):
+        """ Test that all actions can be retrieved with cursors """
+
+        t = datetime(2020, 1, 1)
+        for n in range(15):
+            EpisodeHistoryEntry.objects.create(
+                # some actions have the same timestamp
+                timestamp=t + timedelta(seconds=n // 2),
+                episode=self.episode,
+                user=self.user,
+                action=EpisodeHistoryEntry.DOWNLOAD,
+            )
+
+        url = reverse(episodes, kwargs={"version": "2", "username": self.user.username})
+        response = self.client.get(url, {"since": "0"}, **self.extra)
+        content = response.getvalue()
+        self.assertEqual(response.status_code, 200, content)
+        page1 = json.loads(content.decode("utf-8"))
+        self.assertEqual(len(page1["actions"]), 10)
+        self.assertTrue(page1["cursor"])
+
+        params = {"since": "0", "cursor": page1["cursor"]}
+        response = self.client.get(url, params, **self.extra)
+        content = response.getvalue()
+        self.assertEqual(response.status_code, 200, content)
+        page2 = json.loads(content.decode("utf-8"))
+        self.assertEqual(len(page2["actions"]), 5)
+        self.assertIsNone(page2["cursor"])
+
+        timestamps = [a["timestamp"] for a in page1["actions"] + page2["actions"]]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(timestamps[-1], (t + timedelta(seconds=7)).isoformat())
+
+    def test_invalid_cursor(self):
+        url = reverse(episodes, kwargs={"version": "2", "username": self.user.username})
+        response = self.client.get(url, {"cursor": "invalid"}, **self.extra)
+        self.assertEqual(response.status_code, 400, response.content)
+
+    def test_aggregated(self):
+        """ Test that only the latest action of each episode is returned """
+
+        t = datetime(2020, 1, 1)
+        for n, action in enumerate(
+            [EpisodeHistoryEntry.DOWNLOAD, EpisodeHistoryEntry.PLAY]
+        ):
+            EpisodeHistoryEntry.objects.create(
+                timestamp=t + timedelta(seconds=n),
+                episode=self.episode,
+                user=self.user,
+                action=action,
+            )
+
+        url = reverse(episodes, kwargs={"version": "2", "username": self.user.username})
+        params = {"since": "0", "aggregated": "true"}
+        response = self.client.get(url, params, **self.extra)
+        content = response.getvalue()
+        self.assertEqual(response.status_code, 200, content)
+        actions = json.loads(content.decode("utf-8"))["actions"]
+        self.assertEqual([a["action"] for a in actions], ["play"])
+
     def test_no_actions(self):
         """ Test when there are no actions to return """
 
@@ -259,8 +407,9 @@ class EpisodeActionTests(TestCase):
 
         url = reverse(episodes, kwargs={"version": "2", "username": self.user.username})
         response = self.client.get(url, {"since": "0"}, **self.extra)
-        self.assertEqual(response.status_code, 200, response.content)
-        response_obj = json.loads(response.content.decode("utf-8"))
+        content = response.getvalue()
+        self.assertEqual(response.status_code, 200, content)
+        response_obj = json.loads(content.decode("utf-8"))
         actions = response_obj["actions"]
 
         # 10 actions should be returned
@@ -274,6 +423,264 @@ class EpisodeActionTests(TestCase):
         self.assertGreaterEqual(t2, returned)
 
 
+class DeviceUpdatesTests(TestCase):
+    def setUp(self):
+        self.user, password = create_user()
+        self.device = UserClient.objects.create(
+            user=self.user, uid="updates-dev", id=uuid.uuid1()
+        )
+        self.client = Client()
+        self.extra = {
+            "HTTP_AUTHORIZATION": create_auth_string(self.user.username, password)
+        }
+        self.url = "/api/2/updates/%s/%s.json" % (self.user.username, self.device.uid)
+
+    def _add_podcast(self, n):
+        podcast = Podcast.objects.get_or_create_for_url(
+            "http://example.com/updates-podcast-%d.xml" % n,
+            defaults={"title": "Podcast %d" % n},
+        ).object
+        for m in range(7):
+            Episode.objects.get_or_create_for_url(
+                podcast,
+                "http://example.com/updates-podcast-%d/%d.mp3" % (n, m),
+                defaults={"released": datetime(2020, 1, m + 1), "order": m},
+            )
+        subscribe_many([(podcast, podcast.url)], self.user, self.device)
+        return podcast
+
+    def _get_updates(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {"since": "0"}, **self.extra)
+        self.assertEqual(response.status_code, 200, response.content)
+        return json.loads(response.content.decode("utf-8")), len(queries)
+
+    def test_latest_episodes(self):
+        podcast = self._add_podcast(0)
+        updates, num_queries = self._get_updates()
+
+        # the latest 5 episodes of the podcast are returned
+        self.assertEqual(
+            [episode["url"] for episode in updates["updates"]],
+            [
+                "http://example.com/updates-podcast-0/%d.mp3" % m
+                for m in range(6, 1, -1)
+            ],
+        )
+        self.assertEqual(updates["updates"][0]["podcast_url"], podcast.url)
+
+        # the number of queries doesn't depend on the number of podcasts;
+        # the first request also populates some caches
+        updates, num_queries = self._get_updates()
+        for n in range(1, 4):
+            self._add_podcast(n)
+        updates, num_queries2 = self._get_updates()
+        self.assertEqual(len(updates["updates"]), 20)
+        self.assertEqual(num_queries, num_queries2)
+
+
+class BasicAuthTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user, self.password = create_user()
+        self.client = Client()
+        self.url = "/api/2/devices/%s.json" % self.user.username
+        self.token_url = "/api/2/auth/%s/token-dev/token.json" % self.user.username
+
+    def _get(self, password, url=None):
+        auth = create_auth_string(self.user.username, password)
+        return self.client.get(url or self.url, HTTP_AUTHORIZATION=auth)
+
+    def test_cached_credentials(self):
+        with unittest.mock.patch.object(
+            basic_auth, "authenticate", wraps=authenticate
+        ) as mock_auth:
+            self.assertEqual(self._get(self.password).status_code, 200)
+            self.assertEqual(self._get(self.password).status_code, 200)
+            self.assertEqual(self._get("wrong").status_code, 401)
+
+        # only the first request and the wrong password are verified
+        self.assertEqual(mock_auth.call_count, 2)
+
+        # no session is created
+        self.assertNotIn("sessionid", self.client.cookies)
+
+    def test_last_login(self):
+        """ Verifying the password updates last_login """
+        User = get_user_model()
+        User.objects.filter(pk=self.user.pk).update(last_login=None)
+
+        self.assertEqual(self._get(self.password).status_code, 200)
+        last_login = User.objects.get(pk=self.user.pk).last_login
+        self.assertIsNotNone(last_login)
+
+        # cached credentials are not verified again
+        self.assertEqual(self._get(self.password).status_code, 200)
+        self.assertEqual(User.objects.get(pk=self.user.pk).last_login, last_login)
+
+    def test_password_change(self):
+        self.assertEqual(self._get(self.password).status_code, 200)
+
+        self.user.set_password("new-password")
+        self.user.save()
+
+        self.assertEqual(self._get(self.password).status_code, 401)
+        self.assertEqual(self._get("new-password").status_code, 200)
+
+    def test_device_token(self):
+        auth = create_auth_string(self.user.username, self.password)
+        response = self.client.post(self.token_url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 200, response.content)
+        token = json.loads(response.content.decode("utf-8"))["token"]
+
+        self.assertEqual(self._get(token).status_code, 200)
+        self.assertEqual(self._get(token + "x").status_code, 401)
+
+        # the token can't be used for other users
+        other, _ = create_user()
+        url = "/api/2/devices/%s.json" % other.username
+        auth = create_auth_string(other.username, token)
+        response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 401)
+
+        response = self.client.delete(self.token_url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 401)
+        response = self.client.delete(
+            self.token_url,
+            HTTP_AUTHORIZATION=create_auth_string(self.user.username, self.password),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._get(token).status_code, 401)
+
+    def test_token_scope(self):
+        """ Tokens give access to the account, but not to tokens or sessions """
+        auth = create_auth_string(self.user.username, self.password)
+        response = self.client.post(self.token_url, HTTP_AUTHORIZATION=auth)
+        token = json.loads(response.content.decode("utf-8"))["token"]
+        auth = create_auth_string(self.user.username, token)
+
+        # requests for other devices and for the account
+        url = "/api/2/devices/%s/other-dev.json" % self.user.username
+        response = self.client.post(
+            url, "{}", content_type="application/json", HTTP_AUTHORIZATION=auth
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._get(token).status_code, 200)
+
+        # other devices' tokens can't be replaced or revoked
+        other_url = "/api/2/auth/%s/other-dev/token.json" % self.user.username
+        response = self.client.post(other_url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 403)
+        response = self.client.delete(other_url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(self.token_url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 403)
+
+        url = "/api/2/auth/%s/login.json" % self.user.username
+        response = self.client.post(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 403)
+        self.assertNotIn("sessionid", self.client.cookies)
+
+        # the token is still valid
+        self.assertEqual(self._get(token).status_code, 200)
+
+    def test_login_session(self):
+        url = "/api/2/auth/%s/login.json" % self.user.username
+        auth = create_auth_string(self.user.username, self.password)
+        response = self.client.post(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("sessionid", self.client.cookies)
+
+        # the session authenticates subsequent requests
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+
+class OPMLTests(unittest.TestCase):
+    def test_export_import(self):
+        channels = [
+            SimpleNamespace(
+                title='Tom & Jerry\'s "Podcast" <1>',
+                url="http://example.com/feed.xml?a=1&b=2",
+                description="Description",
+                link="http://example.com/",
+            ),
+            SimpleNamespace(
+                title="Äöü", url="http://example.com/2.xml", description="", link=""
+            ),
+        ]
+        chunks = list(Exporter("Subscriptions").stream(channels))
+        self.assertGreater(len(chunks), 1)
+
+        items = Importer(b"".join(chunks)).items
+        self.assertEqual([i["url"] for i in items], [c.url for c in channels])
+        self.assertEqual([i["title"] for i in items], [c.title for c in channels])
+
+    def test_import_file(self):
+        opml = io.BytesIO(
+            b"""<?xml version="1.0" encoding="utf-8"?>
+            <opml version="1.1" xmlns="http://example.com/ns">
+              <body>
+                <outline text="Group">
+                  <outline type="rss" text="Podcast" xmlUrl=" http://a.com/1 "/>
+                  <outline type="link" url="http://a.com/2"/>
+                </outline>
+                <outline text="No feed" htmlUrl="http://a.com/"/>
+              </body>
+            </opml>"""
+        )
+        items = list(Importer(opml))
+        self.assertEqual(
+            items,
+            [
+                {
+                    "url": "http://a.com/1",
+                    "title": "Podcast",
+                    "description": "http://a.com/1",
+                },
+                {
+                    "url": "http://a.com/2",
+                    "title": "http://a.com/2",
+                    "description": "http://a.com/2",
+                },
+            ],
+        )
+
+    def test_import_invalid(self):
+        with self.assertRaises(ValueError):
+            Importer("<opml><body><outline></body></opml>").items
+
+
+class UpperCaseSerializer(StdlibSerializer):
+    def dumps(self, obj):
+        return super().dumps(obj).upper()
+
+
+class SerializationTests(TestCase):
+    def setUp(self):
+        self.podcast = Podcast.objects.get_or_create_for_url(
+            "http://example.com/serialization-podcast.xml",
+            defaults={
+                "title": "My Podcast",
+                "logo_url": "http://example.com/serialization-logo.png",
+            },
+        ).object
+
+    def test_streaming_array(self):
+        items = [{"a": 1}, {"b": "ä"}]
+        response = StreamingJsonResponse(item for item in items)
+        self.assertEqual(json.loads(response.getvalue().decode("utf-8")), items)
+
+        response = StreamingJsonResponse(item for item in [])
+        self.assertEqual(response.getvalue(), b"[]")
+
+    @override_settings(JSON_SERIALIZER="mygpo.api.tests.UpperCaseSerializer")
+    def test_serializer_setting(self):
+        response = format_podcast_list([self.podcast], "json", "title")
+        self.assertEqual(
+            response.getvalue(), b'["HTTP://EXAMPLE.COM/SERIALIZATION-PODCAST.XML"]'
+        )
+
+
 class SimpleAPITests(unittest.TestCase):
     def setUp(self):
         User = get_user_model()
@@ -340,8 +747,9 @@ class SimpleAPITests(unittest.TestCase):
         for fmt in self.formats:
             url = self.subscriptions_urls[fmt]
             response = self.client.get(url, data={"jsonp": "test"}, **self.extra)
-            self.assertEqual(response.status_code, 200, response.content)
-            testers[fmt](response.content)
+            content = response.getvalue()
+            self.assertEqual(response.status_code, 200, content)
+            testers[fmt](content)
 
     def test_get_subscriptions_invalid_jsonp(self):
         url = self.subscriptions_urls["jsonp"]
@@ -375,7 +783,7 @@ class SimpleAPITests(unittest.TestCase):
             "opml": Exporter("Subscriptions").generate([podcast]),
         }
         payloads = dict(
-            (fmt, format_podcast_list([podcast], fmt, "test title").content)
+            (fmt, format_podcast_list([podcast], fmt, "test title").getvalue())
             for fmt in self.formats
         )
         for fmt in self.formats:
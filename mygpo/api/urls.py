@@ -28,6 +28,11 @@ urlpatterns = [
         simple.search,
         name="api-simple-search",
     ),
+    path(
+        "search/autocomplete.<str:format>",
+        simple.autocomplete,
+        name="api-simple-autocomplete",
+    ),
     path(
         "suggestions/<int:count>.<str:format>",
         simple.suggestions,
@@ -61,6 +66,10 @@ urlpatterns = [
     path("api/<int:version>/devices/<username:username>.json", advanced.devices),
     path("api/2/auth/<username:username>/login.json", auth.login),
     path("api/2/auth/<username:username>/logout.json", auth.logout),
+    path(
+        "api/2/auth/<username:username>/<client-uid:device_uid>/token.json",
+        auth.device_token,
+    ),
     path("api/2/tags/<int:count>.json", advanced.directory.top_tags),
     path("api/2/tag/<str:tag>/<int:count>.json", advanced.directory.tag_podcasts),
     path(
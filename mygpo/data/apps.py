@@ -8,10 +8,10 @@ logger = logging.getLogger(__name__)
 
 def update_podcast(sender, **kwargs):
     """ update podcast in background when receiving pubsub-notification """
-    from mygpo.data.tasks import update_podcasts
+    from mygpo.data.tasks import schedule_push_update
 
     logger.info('updating podcast for "%s" after pubsub notification', sender)
-    update_podcasts.delay([sender])
+    schedule_push_update(sender)
 
 
 class DataAppConfig(AppConfig):
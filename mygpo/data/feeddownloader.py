@@ -2,28 +2,32 @@
 # -*- coding: utf-8 -*-
 
 import os.path
+import json
 import urllib.request
 import urllib.error
 from urllib.parse import urljoin
 import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from itertools import chain, islice
 import requests
 
-from django.db import transaction
+from django.db import transaction, connection
+from django.db.models import Count, Min, Max, Q
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 
-from mygpo.podcasts.models import Podcast, Episode
+from mygpo.podcasts.models import Podcast, Episode, URL
 from mygpo.core.slugs import PodcastSlugs, EpisodeSlugs
 from mygpo.podcasts.models import (
     DEFAULT_UPDATE_INTERVAL,
     MIN_UPDATE_INTERVAL,
     MAX_UPDATE_INTERVAL,
 )
-from mygpo.utils import to_maxlength
+from mygpo.utils import to_maxlength, get_domain
 from mygpo.web.logo import CoverArt
 from mygpo.data.podcast import subscribe_at_hub
-from mygpo.data.tasks import update_related_podcasts
 from mygpo.pubsub.models import SubscriptionError
 from mygpo.directory.tags import update_category
 from mygpo.search import get_index_fields
@@ -49,18 +53,20 @@ class NoEpisodesException(Exception):
     """ raised when parsing something that doesn't contain any episodes """
 
 
-def update_podcasts(queue):
-    """ Fetch data for the URLs supplied as the queue iterable """
+def update_podcasts(queue, max_workers=None, max_per_host=None):
+    """Fetch data for the URLs supplied as the queue iterable
 
-    for n, podcast_url in enumerate(queue, 1):
-        logger.info("Update %d - %s", n, podcast_url)
-        if not podcast_url:
-            logger.warning("Podcast URL empty, skipping")
-            continue
+    Feeds are fetched from the feed-service concurrently, while the results
+    are written to the database in the calling thread, in the order in which
+    the fetches complete."""
+
+    fetched = fetch_feeds(queue, max_workers, max_per_host)
+
+    for updater, future in fetched:
+        podcast_url = updater.podcast_url
 
         try:
-            updater = PodcastUpdater(podcast_url)
-            yield updater.update_podcast()
+            yield updater.update_podcast(future)
 
         except NoPodcastCreated as npc:
             logger.info("No podcast created: %s", npc)
@@ -77,6 +83,84 @@ def update_podcasts(queue):
             raise
 
 
+def fetch_feeds(queue, max_workers=None, max_per_host=None):
+    """Fetch the feeds for the URLs in queue concurrently
+
+    Yields (updater, future) pairs in the order in which the fetches complete;
+    the future can be passed to ``updater.update_podcast()``.
+    At most ``max_workers`` feeds are fetched at the same time, and at most
+    ``max_per_host`` of them are hosted on the same domain. Feeds that would
+    exceed the per-host limit are held back until a slot is available."""
+
+    max_workers = max_workers or settings.FEED_UPDATE_WORKERS
+    max_per_host = max_per_host or settings.FEED_UPDATE_MAX_PER_HOST
+
+    # upper bound of feeds that are held back because of their host
+    max_deferred = max_workers * 10
+
+    queue = iter(enumerate(queue, 1))
+    deferred = collections.deque()
+    hosts = collections.Counter()
+    pending = {}
+
+    def next_updater():
+        for n, podcast_url in queue:
+            logger.info("Update %d - %s", n, podcast_url)
+            if not podcast_url:
+                logger.warning("Podcast URL empty, skipping")
+                continue
+
+            return PodcastUpdater(podcast_url)
+
+        return None
+
+    def submit(executor, updater):
+        host = get_domain(updater.podcast_url)
+        hosts[host] += 1
+        future = executor.submit(updater.fetch)
+        pending[future] = (updater, host)
+
+    def fill(executor):
+        # feeds that have been held back are considered first
+        for _ in range(len(deferred)):
+            if len(pending) >= max_workers:
+                return
+
+            updater = deferred.popleft()
+            if hosts[get_domain(updater.podcast_url)] < max_per_host:
+                submit(executor, updater)
+            else:
+                deferred.append(updater)
+
+        while len(pending) < max_workers and len(deferred) < max_deferred:
+            updater = next_updater()
+            if updater is None:
+                return
+
+            if hosts[get_domain(updater.podcast_url)] < max_per_host:
+                submit(executor, updater)
+            else:
+                deferred.append(updater)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fill(executor)
+
+        while pending:
+            done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+
+            finished = []
+            for future in done:
+                updater, host = pending.pop(future)
+                hosts[host] -= 1
+                finished.append((updater, future))
+
+            # start the next fetches before handing out the finished ones, so
+            # that the network is kept busy while the results are processed
+            fill(executor)
+
+            yield from finished
+
+
 class PodcastUpdater(object):
     """ Updates the podcast specified by the podcast_url """
 
@@ -85,12 +169,16 @@ class PodcastUpdater(object):
             (podcast_url[:2046] + "..") if len(podcast_url) > 2048 else podcast_url
         )
 
-    def update_podcast(self):
-        """ Update the podcast """
+    def update_podcast(self, fetched=None):
+        """Update the podcast
+
+        ``fetched`` can be a future of a call to :meth:`fetch`; the feed is
+        fetched if it is not given. Exceptions raised while fetching are
+        recorded in the update result."""
 
         with models.PodcastUpdateResult(podcast_url=self.podcast_url) as res:
 
-            parsed, podcast, created = self.parse_feed()
+            parsed, podcast, created = self.parse_feed(fetched)
 
             if not podcast:
                 res.podcast_created = False
@@ -102,6 +190,12 @@ class PodcastUpdater(object):
             res.podcast_created = created
 
             res.episodes_added = 0
+
+            feed_hash = get_content_hash(parsed) if parsed else None
+            if feed_hash and not created and feed_hash == podcast.feed_hash:
+                self._update_unchanged(podcast)
+                return podcast
+
             episode_updater = MultiEpisodeUpdater(podcast, res)
 
             if not parsed:
@@ -115,22 +209,33 @@ class PodcastUpdater(object):
 
             podcast.refresh_from_db()
             podcast.episode_count = episode_updater.count_episodes()
-            podcast.save()
+            podcast.save(update_fields=["episode_count"])
 
             episode_updater.order_episodes()
 
-            self._update_podcast(podcast, parsed, episode_updater, res)
+            self._update_podcast(podcast, parsed, episode_updater, res, feed_hash)
 
         return podcast
 
-    def parse_feed(self):
+    def fetch(self):
+        """Fetch and validate the feed without accessing the database
+
+        Returns a tuple of the parsed feed and the exception that occured
+        while fetching / validating it; one of them is always None. This
+        can be run in a separate thread (see :func:`fetch_feeds`)."""
         try:
             parsed = self._fetch_feed()
             self._validate_parsed(parsed)
+            return (parsed, None)
 
         except (requests.exceptions.RequestException, NoEpisodesException) as ex:
-            logger.warn("Error while fetching/parsing feed", exc_info=True)
+            logger.warning("Error while fetching/parsing feed", exc_info=True)
+            return (None, ex)
 
+    def parse_feed(self, fetched=None):
+        parsed, ex = fetched.result() if fetched is not None else self.fetch()
+
+        if ex is not None:
             # if we fail to parse the URL, we don't even create the
             # podcast object
             try:
@@ -176,8 +281,13 @@ class PodcastUpdater(object):
         if not parsed or not parsed.get("episodes", []):
             raise NoEpisodesException("no episodes found")
 
-    def _update_podcast(self, podcast, parsed, episode_updater, update_result):
-        """ updates a podcast according to new parser results """
+    def _update_podcast(
+        self, podcast, parsed, episode_updater, update_result, feed_hash=None
+    ):
+        """updates a podcast according to new parser results
+
+        The feed_hash is stored only once the rest of the update has
+        succeeded; otherwise the next update of the feed would be skipped."""
 
         # we need that later to decide if we can "bump" a category
         prev_latest_episode_timestamp = podcast.latest_episode_timestamp
@@ -272,12 +382,6 @@ class PodcastUpdater(object):
         if list(old_index_fields.items()) != list(new_index_fields.items()):
             podcast.search_index_uptodate = False
 
-        # The podcast is always saved (not just when there are changes) because
-        # we need to record the last update
-        logger.info("Saving podcast.")
-        podcast.last_update = datetime.utcnow()
-        podcast.save()
-
         try:
             subscribe_at_hub(podcast)
         except SubscriptionError as se:
@@ -285,7 +389,13 @@ class PodcastUpdater(object):
 
         self.assign_slug(podcast)
         episode_updater.assign_missing_episode_slugs()
-        update_related_podcasts.delay(podcast.pk)
+
+        # The podcast is always saved (not just when there are changes) because
+        # we need to record the last update
+        logger.info("Saving podcast.")
+        podcast.feed_hash = feed_hash
+        podcast.last_update = datetime.utcnow()
+        podcast.save()
 
     def assign_slug(self, podcast):
         if podcast.slug:
@@ -323,9 +433,22 @@ class PodcastUpdater(object):
 
         update_category(podcast)
 
+    def _update_unchanged(self, podcast):
+        """Records an update that returned the same feed as the previous one
+
+        Nothing but the time of the update and the update interval factor
+        can change, so the rest of the update is skipped."""
+        logger.info("Feed unchanged, recording update only")
+
+        # no new episodes, so the factor is increased; never above 1000
+        podcast.update_interval_factor = min(1000, podcast.update_interval_factor * 1.2)
+        podcast.last_update = datetime.utcnow()
+        podcast.save(update_fields=["update_interval_factor", "last_update"])
+
     def _mark_outdated(self, podcast, msg, episode_updater):
         logger.info("marking podcast outdated: %s", msg)
         podcast.outdated = True
+        podcast.feed_hash = None
         podcast.last_update = datetime.utcnow()
         podcast.save()
         episode_updater.update_episodes([])
@@ -338,16 +461,23 @@ class MultiEpisodeUpdater(object):
         self.updated_episodes = []
         self.max_episode_order = None
 
+        # indicates if the release timestamp of an existing episode has been
+        # changed, which requires all episodes to be reordered
+        self.released_changed = True
+
     def update_episodes(self, parsed_episodes):
+        """Create / update the podcast's episodes from the parser results
 
-        pid = self.podcast.get_id()
+        Episodes are fetched, created and updated in bulk, so that the number
+        of queries does not depend on the number of episodes."""
 
         episodes_to_update = list(islice(parsed_episodes, 0, MAX_EPISODES_UPDATE))
         logger.info(
             "Parsed %d (%d) episodes", len(parsed_episodes), len(episodes_to_update)
         )
 
-        logger.info("Updating %d episodes", len(episodes_to_update))
+        # if an URL occurs multiple times, the last episode wins
+        parsed_by_url = {}
         for n, parsed in enumerate(episodes_to_update, 1):
 
             url = self.get_episode_url(parsed)
@@ -355,28 +485,101 @@ class MultiEpisodeUpdater(object):
                 logger.info("Skipping episode %d for missing URL", n)
                 continue
 
-            logger.info("Updating episode %d / %d", n, len(parsed_episodes))
+            parsed_by_url.pop(url, None)
+            parsed_by_url[url] = parsed
+
+        logger.info("Updating %d episodes", len(parsed_by_url))
+        results = Episode.objects.get_or_create_for_urls(
+            self.podcast, list(parsed_by_url)
+        )
 
-            episode, created = Episode.objects.get_or_create_for_url(self.podcast, url)
+        updaters = []
+        self.released_changed = False
+        for url, parsed in parsed_by_url.items():
+            episode, created = results[url]
 
             if created:
                 self.update_result.episodes_added += 1
 
             updater = EpisodeUpdater(episode, self.podcast)
-            updater.update_episode(parsed)
+            updaters.append(updater)
+
+            if not created and episode.content_hash == get_content_hash(parsed):
+                # unchanged since the last update
+                self.updated_episodes.append(episode)
+                continue
+
+            released = episode.released
+            updater.set_fields(parsed)
+
+            if not created and episode.released != released:
+                self.released_changed = True
 
             self.updated_episodes.append(episode)
 
+        EpisodeUpdater.save_bulk(updaters)
+        self._add_missing_urls(updaters)
+
         # and mark the remaining ones outdated
-        current_episodes = Episode.objects.filter(podcast=self.podcast, outdated=False)[
-            :500
-        ]
-        outdated_episodes = set(current_episodes) - set(self.updated_episodes)
+        current_episodes = Episode.objects.filter(
+            podcast=self.podcast, outdated=False
+        ).values_list("id", flat=True)[:500]
+        updated_ids = {episode.id for episode in self.updated_episodes}
+        outdated_ids = set(current_episodes) - updated_ids
+
+        logger.info("Marking %d episodes as outdated", len(outdated_ids))
+        if outdated_ids:
+            Episode.objects.filter(id__in=outdated_ids).update(
+                outdated=True, last_update=datetime.utcnow()
+            )
 
-        logger.info("Marking %d episodes as outdated", len(outdated_episodes))
-        for episode in outdated_episodes:
-            updater = EpisodeUpdater(episode, self.podcast)
-            updater.mark_outdated()
+    def _add_missing_urls(self, updaters):
+        """Adds the URLs of all files to the updated episodes
+
+        This is the bulk version of ``UrlsMixin.add_missing_urls``"""
+
+        if not updaters:
+            return
+
+        existing = collections.defaultdict(list)
+        urls = URL.objects.filter(
+            content_type=ContentType.objects.get_for_model(Episode),
+            object_id__in=[
+                updater.episode.id for updater in updaters if updater.parsed_urls
+            ],
+        )
+        for url in urls:
+            existing[url.object_id].append(url)
+
+        max_length = URL._meta.get_field("url").max_length
+        new_urls = []
+        for updater in updaters:
+            episode = updater.episode
+            episode_urls = existing[episode.id]
+            next_order = max([-1] + [u.order for u in episode_urls]) + 1
+            known = {u.url for u in episode_urls}
+
+            for url in updater.parsed_urls:
+                if url in known:
+                    continue
+
+                if len(url) > max_length:
+                    logger.warning("Could not add URL: exceeds max length")
+                    continue
+
+                new_urls.append(
+                    URL(
+                        url=url,
+                        order=next_order,
+                        scope=episode.scope,
+                        content_object=episode,
+                    )
+                )
+                known.add(url)
+                next_order += 1
+
+        # URLs that already belong to some other episode are skipped
+        URL.objects.bulk_create(new_urls, ignore_conflicts=True)
 
     @transaction.atomic
     def order_episodes(self):
@@ -389,27 +592,107 @@ class MultiEpisodeUpdater(object):
         if not num_episodes:
             return 0
 
-        episodes = (
-            self.podcast.episode_set.all()
-            .extra(select={"has_released": "released IS NOT NULL"})
-            .order_by("-has_released", "-released", "pk")
-            .only("pk")
-        )
+        if self._can_order_new_episodes(num_episodes):
+            logger.info("Assigning order to new episodes only")
+            self._order_new_episodes()
 
-        for n, episode in enumerate(episodes.iterator(), 1):
-            # assign ``order`` from higher (most recent) to 0 (oldest)
-            # None means "unknown"
-            new_order = num_episodes - n
+        else:
+            logger.info("Reordering all episodes")
+            self._order_all_episodes(num_episodes)
 
-            # optimize for new episodes that are newer than all existing
-            if episode.order == new_order:
-                continue
+        self.max_episode_order = num_episodes - 1
 
-            logger.info("Updating order from {} to {}".format(episode.order, new_order))
-            episode.order = new_order
-            episode.save()
+    def _can_order_new_episodes(self, num_episodes):
+        """Checks if only new episodes need to be ordered
+
+        This is the case if the existing episodes are already numbered
+        0..n-1 and all unordered episodes have been released after them, ie
+        new episodes have been added to the top of the feed."""
+
+        if self.released_changed:
+            return False
+
+        stats = self.podcast.episode_set.aggregate(
+            num_ordered=Count("order"),
+            min_order=Min("order"),
+            max_order=Max("order"),
+            max_ordered_released=Max("released", filter=Q(order__isnull=False)),
+            num_unordered=Count("id", filter=Q(order__isnull=True)),
+            num_unordered_unreleased=Count(
+                "id", filter=Q(order__isnull=True, released__isnull=True)
+            ),
+            min_unordered_released=Min("released", filter=Q(order__isnull=True)),
+        )
 
-        self.max_episode_order = num_episodes - 1
+        if stats["num_ordered"] + stats["num_unordered"] != num_episodes:
+            return False
+
+        if stats["num_unordered_unreleased"]:
+            return False
+
+        if not stats["num_ordered"]:
+            return True
+
+        if stats["min_order"] != 0 or stats["max_order"] != stats["num_ordered"] - 1:
+            return False
+
+        if stats["max_ordered_released"] is None or not stats["num_unordered"]:
+            return True
+
+        return stats["min_unordered_released"] > stats["max_ordered_released"]
+
+    def _order_new_episodes(self):
+        """ Assigns order values to unordered episodes, above existing ones """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE {table} AS e
+                SET "order" = o.new_order
+                FROM (
+                    SELECT id,
+                           (SELECT COUNT("order") FROM {table}
+                            WHERE podcast_id = %(podcast_id)s) - 1 +
+                           ROW_NUMBER() OVER (ORDER BY released, id DESC)
+                           AS new_order
+                    FROM {table}
+                    WHERE podcast_id = %(podcast_id)s AND "order" IS NULL
+                ) AS o
+                WHERE e.id = o.id
+                """.format(
+                    table=Episode._meta.db_table
+                ),
+                {"podcast_id": self.podcast.id},
+            )
+            logger.info("Assigned order to %d episodes", cursor.rowcount)
+
+    def _order_all_episodes(self, num_episodes):
+        """Assigns order values to all episodes in a single statement
+
+        Order values go from num_episodes - 1 (most recent) down to 0
+        (oldest); episodes w/o release timestamp are considered oldest. Only
+        rows with changed order values are written."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE {table} AS e
+                SET "order" = o.new_order
+                FROM (
+                    SELECT id,
+                           %(num_episodes)s - ROW_NUMBER() OVER (
+                               ORDER BY released IS NOT NULL DESC,
+                                        released DESC,
+                                        id
+                           ) AS new_order
+                    FROM {table}
+                    WHERE podcast_id = %(podcast_id)s
+                ) AS o
+                WHERE e.id = o.id AND e."order" IS DISTINCT FROM o.new_order
+                """.format(
+                    table=Episode._meta.db_table
+                ),
+                {"podcast_id": self.podcast.id, "num_episodes": num_episodes},
+            )
+            logger.info("Updated order of %d episodes", cursor.rowcount)
 
     def get_episode_url(self, parsed_episode):
         """ returns the URL of a parsed episode """
@@ -472,11 +755,50 @@ class EpisodeUpdater(object):
         self.episode = episode
         self.podcast = podcast
 
+        # set by set_fields()
+        self.parsed_urls = []
+        self.changed = False
+
+    # fields that are taken from the parsed episode
+    UPDATE_FIELDS = [
+        "guid",
+        "description",
+        "subtitle",
+        "content",
+        "link",
+        "released",
+        "author",
+        "duration",
+        "filesize",
+        "language",
+        "mimetypes",
+        "flattr_url",
+        "license",
+        "title",
+        "content_hash",
+    ]
+
     def update_episode(self, parsed_episode):
         """ updates "episode" with the data from "parsed_episode" """
+        self.set_fields(parsed_episode)
+        self.episode.save()
+        self.episode.add_missing_urls(self.parsed_urls)
+
+    def set_fields(self, parsed_episode):
+        """Sets the episode's fields from "parsed_episode" without saving
+
+        Returns True if any of the values have changed"""
+
+        old_values = [getattr(self.episode, f) for f in self.UPDATE_FIELDS]
+
+        self.episode.content_hash = get_content_hash(parsed_episode)
+
+        self.parsed_urls = list(
+            chain.from_iterable(
+                f.get("urls", []) for f in parsed_episode.get("files", [])
+            )
+        )
 
-        # TODO: check if there have been any changes, to
-        # avoid unnecessary updates
         self.episode.guid = to_maxlength(
             Episode, "guid", parsed_episode.get("guid") or self.episode.guid
         )
@@ -517,8 +839,9 @@ class EpisodeUpdater(object):
             or self.podcast.language
         )
 
+        # sorted, so that unchanged mimetypes are not detected as a change
         mimetypes = [f["mimetype"] for f in parsed_episode.get("files", [])]
-        self.episode.mimetypes = ",".join(list(set(filter(None, mimetypes))))
+        self.episode.mimetypes = ",".join(sorted(set(filter(None, mimetypes))))
 
         self.episode.flattr_url = to_maxlength(
             Episode,
@@ -533,18 +856,40 @@ class EpisodeUpdater(object):
             "title",
             parsed_episode.get("title")
             or self.episode.title
-            or file_basename_no_extension(self.episode.url),
+            or file_basename_no_extension(
+                # avoids a query for the URLs of the episode
+                self.parsed_urls[0]
+                if self.parsed_urls
+                else self.episode.url
+            ),
         )
 
         self.episode.last_update = datetime.utcnow()
-        self.episode.save()
 
-        parsed_urls = list(
-            chain.from_iterable(
-                f.get("urls", []) for f in parsed_episode.get("files", [])
-            )
+        new_values = [getattr(self.episode, f) for f in self.UPDATE_FIELDS]
+        self.changed = old_values != new_values
+        return self.changed
+
+    @classmethod
+    def save_bulk(cls, updaters):
+        """Saves the episodes of multiple updaters after set_fields()
+
+        Only changed episodes are written completely; for the others only
+        the time of the last update is recorded."""
+
+        now = datetime.utcnow()
+
+        changed = [updater.episode for updater in updaters if updater.changed]
+        for episode in changed:
+            episode.modified = now
+
+        Episode.objects.bulk_update(
+            changed, cls.UPDATE_FIELDS + ["last_update", "modified"], batch_size=100
         )
-        self.episode.add_missing_urls(parsed_urls)
+
+        unchanged = [updater.episode.id for updater in updaters if not updater.changed]
+        if unchanged:
+            Episode.objects.filter(id__in=unchanged).update(last_update=now)
 
     def mark_outdated(self):
         """ marks the episode outdated if its not already """
@@ -556,6 +901,12 @@ class EpisodeUpdater(object):
         self.episode.save()
 
 
+def get_content_hash(parsed):
+    """ Returns a fingerprint of (a part of) a parsed feed """
+    content = json.dumps(parsed, sort_keys=True).encode("utf-8")
+    return hashlib.md5(content).hexdigest()
+
+
 def file_basename_no_extension(filename):
     """Returns filename without extension
 
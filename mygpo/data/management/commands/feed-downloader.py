@@ -26,6 +26,15 @@ class Command(PodcastCommand):
             help="Don't update anything, just list podcasts ",
         ),
 
+        parser.add_argument(
+            "--workers",
+            action="store",
+            dest="workers",
+            type=int,
+            default=0,
+            help="Number of feeds that are fetched concurrently",
+        ),
+
     def handle(self, *args, **options):
 
         queue = self.get_podcasts(*args, **options)
@@ -41,5 +50,6 @@ class Command(PodcastCommand):
         else:
             logger.info("Updating podcasts...")
 
-            for podcast in update_podcasts(queue):
+            workers = options.get("workers")
+            for podcast in update_podcasts(queue, max_workers=workers):
                 logger.info("Updated podcast %s", podcast)
@@ -1,8 +1,8 @@
-from collections import Counter
-import random
+from collections import defaultdict
 import logging
 
 from django.conf import settings
+from django.db import connection, transaction
 
 from mygpo.podcasts.models import Podcast
 from mygpo.subscriptions.models import Subscription
@@ -11,49 +11,86 @@ from mygpo.pubsub import utils
 logger = logging.getLogger(__name__)
 
 
-def calc_similar_podcasts(podcast, num=20, user_sample=100):
-    """Get a list of podcasts that seem to be similar to the given one.
+def calc_similar_podcasts_batch(podcast_ids, num=20, user_sample=100):
+    """Calculates similar podcasts for many podcasts with a single query
+
+    For a random sample of ``user_sample`` subscribers of each podcast, the
+    podcasts they subscribe to are counted (ie the co-subscription counts of
+    the sparse user/podcast subscription matrix). Returns a dict that maps
+    each podcast ID to a list of up to ``num`` (podcast ID, score) pairs."""
+
+    podcast_ids = list(podcast_ids)
+    if not podcast_ids:
+        return {}
+
+    query = """
+        WITH subscribers AS (
+            SELECT podcast_id, user_id, ROW_NUMBER() OVER (
+                PARTITION BY podcast_id ORDER BY random()
+            ) AS n
+            FROM (
+                SELECT DISTINCT podcast_id, user_id
+                FROM {subscription_table}
+                WHERE podcast_id = ANY(%s::uuid[])
+            ) AS s
+        ), scores AS (
+            SELECT s.podcast_id, o.podcast_id AS related_id,
+                COUNT(DISTINCT o.user_id) AS score
+            FROM subscribers s
+            JOIN {subscription_table} o
+                ON o.user_id = s.user_id AND o.podcast_id <> s.podcast_id
+            WHERE s.n <= %s
+            GROUP BY s.podcast_id, o.podcast_id
+        ), ranked AS (
+            SELECT podcast_id, related_id, score, ROW_NUMBER() OVER (
+                PARTITION BY podcast_id ORDER BY score DESC, related_id
+            ) AS rank
+            FROM scores
+        )
+        SELECT podcast_id, related_id, score
+        FROM ranked
+        WHERE rank <= %s
+        ORDER BY podcast_id, rank
+    """.format(
+        subscription_table=Subscription._meta.db_table
+    )
 
-    The similarity is based on similar subscriptions; for performance
-    reasons, only a sample of subscribers is considered"""
+    with connection.cursor() as cursor:
+        cursor.execute(query, [[str(pk) for pk in podcast_ids], user_sample, num])
+        rows = cursor.fetchall()
 
-    logger.info("Calculating podcasts similar to {podcast}".format(podcast=podcast))
+    similar = defaultdict(list)
+    for podcast_id, related_id, score in rows:
+        similar[podcast_id].append((related_id, score))
 
-    # get all users that subscribe to this podcast
-    user_ids = (
-        Subscription.objects.filter(podcast=podcast)
-        .order_by("user")
-        .distinct("user")
-        .values_list("user", flat=True)
-    )
     logger.info(
-        "Found {num_subscribers} subscribers, taking a sample "
-        "of {sample_size}".format(
-            num_subscribers=len(user_ids), sample_size=user_sample
+        "Calculated similar podcasts for {num_podcasts} podcasts".format(
+            num_podcasts=len(podcast_ids)
         )
     )
+    return dict(similar)
 
-    # take a random sample of ``user_sample`` subscribers
-    user_ids = list(user_ids)  # evaluate ValuesQuerySet
-    random.shuffle(user_ids)
-    user_ids = user_ids[:user_sample]
-
-    # get other podcasts that the user sample subscribes to
-    podcasts = Counter()
-    for user_id in user_ids:
-        subscriptions = (
-            Podcast.objects.filter(subscription__user__id__in=user_ids)
-            .distinct("pk")
-            .exclude(pk=podcast.pk)
-        )
-        podcasts.update(Counter(subscriptions))
-    logger.info(
-        "Found {num_podcasts}, returning top {num_results}".format(
-            num_podcasts=len(podcasts), num_results=num
-        )
-    )
 
-    return podcasts.most_common(num)
+@transaction.atomic
+def set_related_podcasts(similar):
+    """Replaces the related podcasts of many podcasts in bulk
+
+    ``similar`` is a dict as returned by :func:`calc_similar_podcasts_batch`.
+    Only the podcasts' own side of the (symmetrical) relation is written, so
+    that each podcast keeps its own most similar podcasts."""
+
+    Related = Podcast.related_podcasts.through
+
+    Related.objects.filter(from_podcast__in=list(similar.keys())).delete()
+
+    Related.objects.bulk_create(
+        [
+            Related(from_podcast_id=podcast_id, to_podcast_id=related_id)
+            for podcast_id, scores in similar.items()
+            for related_id, score in scores
+        ],
+        ignore_conflicts=True,
+    )
 
 
 def subscribe_at_hub(podcast):
@@ -1,12 +1,14 @@
-from operator import itemgetter
-from datetime import datetime, timedelta
+import hashlib
+from datetime import timedelta
 
-from django.db import IntegrityError
 
 from celery.decorators import periodic_task
 from django_db_geventpool.utils import close_connection
 
-from mygpo.data.podcast import calc_similar_podcasts
+from django.conf import settings
+from django.core.cache import cache
+
+from mygpo.data.podcast import calc_similar_podcasts_batch, set_related_podcasts
 from mygpo.celery import celery
 from mygpo.podcasts.models import Podcast
 
@@ -29,65 +31,97 @@ def update_podcasts(podcast_urls):
 @celery.task
 @close_connection
 def update_related_podcasts(podcast_pk, max_related=20):
-    get_podcast = itemgetter(0)
-
-    podcast = Podcast.objects.get(pk=podcast_pk)
-
-    related = calc_similar_podcasts(podcast)[:max_related]
-    related = map(get_podcast, related)
+    """ Updates the related podcasts of a single podcast """
 
-    for p in related:
-        try:
-            podcast.related_podcasts.add(p)
-        except IntegrityError:
-            logger.warning(
-                "Integrity error while adding related podcast", exc_info=True
-            )
+    # related podcasts are now updated by update_all_related_podcasts; as
+    # there can still be tasks like this in the queue, we should still be
+    # able to handle them
+    similar = calc_similar_podcasts_batch([podcast_pk], max_related)
+    set_related_podcasts({podcast_pk: similar.get(podcast_pk, [])})
 
 
-# interval in which podcast updates are scheduled
-UPDATE_INTERVAL = timedelta(hours=1)
+# number of podcasts for which related podcasts are calculated in one query
+RELATED_PODCASTS_BATCH_SIZE = 500
 
 
-@periodic_task(run_every=UPDATE_INTERVAL)
+@periodic_task(run_every=timedelta(days=1))
 @close_connection
-def schedule_updates(interval=UPDATE_INTERVAL):
-    """ Schedules podcast updates that are due within ``interval`` """
-    now = datetime.utcnow()
-
-    # max number of updates to schedule (one every 10s)
-    max_updates = UPDATE_INTERVAL.total_seconds() / 10
-
-    # fetch podcasts for which an update is due within the next hour
-    podcasts = (
-        Podcast.objects.all()
-        .next_update_between(now, now + interval)
-        .prefetch_related("urls")
-        .only("pk")[:max_updates]
+def update_all_related_podcasts(max_related=20):
+    """ Updates the related podcasts of all subscribed podcasts in batches """
+    podcast_ids = (
+        Podcast.objects.filter(subscribers__gt=0)
+        .order_by("pk")
+        .values_list("pk", flat=True)
     )
 
-    _schedule_updates(podcasts)
+    last_id = None
+    while True:
+        batch = podcast_ids
+        if last_id is not None:
+            batch = batch.filter(pk__gt=last_id)
+        batch = list(batch[:RELATED_PODCASTS_BATCH_SIZE])
 
+        if not batch:
+            break
+
+        similar = calc_similar_podcasts_batch(batch, max_related)
+        set_related_podcasts({pk: similar.get(pk, []) for pk in batch})
+        last_id = batch[-1]
 
-@periodic_task(run_every=UPDATE_INTERVAL)
-@close_connection
-def schedule_updates_longest_no_update():
-    """ Schedule podcasts for update that have not been updated for longest """
 
-    # max number of updates to schedule (one every 20s)
-    max_updates = UPDATE_INTERVAL.total_seconds() / 10
+# interval in which podcast updates are dispatched
+SCHEDULE_INTERVAL = timedelta(minutes=1)
+
+# time after which the update of a podcast is dispatched again if it has not
+# finished
+UPDATE_LEASE = timedelta(hours=1)
+
+
+@periodic_task(run_every=SCHEDULE_INTERVAL)
+@close_connection
+def schedule_updates(num=None):
+    """Dispatches updates for the podcasts that are next in line
 
-    podcasts = Podcast.objects.order_by("last_update")[:max_updates]
-    _schedule_updates(podcasts)
+    Podcasts are taken from a priority queue ordered by their next_update,
+    at a rate of FEED_UPDATE_RATE podcasts per SCHEDULE_INTERVAL. Podcasts
+    that are overdue come first; if there is capacity left, the podcasts
+    that are due next are updated early."""
 
+    num = num or settings.FEED_UPDATE_RATE
+    pks = Podcast.objects.claim_next_updates(num, UPDATE_LEASE)
+    podcasts = Podcast.objects.filter(pk__in=pks).prefetch_related("urls")
+    urls = [podcast.url for podcast in podcasts if podcast.url]
 
-def _schedule_updates(podcasts):
-    """ Schedule updates for podcasts """
-    logger.info("Scheduling %d podcasts for update", len(podcasts))
+    logger.info("Scheduling %d podcasts for update", len(urls))
 
-    # queue all those podcast updates
-    for podcast in podcasts:
+    # the feeds of each batch are fetched concurrently by one task
+    batch_size = settings.FEED_UPDATE_WORKERS
+    for n in range(0, len(urls), batch_size):
         # update_podcasts.delay() seems to block other task execution,
         # therefore celery.send_task() is used instead
-        urls = [podcast.url]
-        celery.send_task("mygpo.data.tasks.update_podcasts", args=[urls])
+        batch = urls[n : n + batch_size]
+        celery.send_task("mygpo.data.tasks.update_podcasts", args=[batch])
+
+
+# pubsub notifications for a feed that arrive within this time after the
+# first one are handled by a single update
+PUSH_UPDATE_DELAY = timedelta(minutes=2)
+
+
+def schedule_push_update(podcast_url):
+    """Schedules an update after a notification from the podcast's hub
+
+    Returns False if an update for the URL is already scheduled; bursts of
+    notifications are thereby collapsed into one update."""
+
+    url_hash = hashlib.sha1(podcast_url.encode("utf-8")).hexdigest()
+    delay = PUSH_UPDATE_DELAY.total_seconds()
+
+    if not cache.add("push-update-{}".format(url_hash), True, delay):
+        logger.info("Update for %s already scheduled", podcast_url)
+        return False
+
+    celery.send_task(
+        "mygpo.data.tasks.update_podcasts", args=[[podcast_url]], countdown=delay
+    )
+    return True
@@ -1,9 +1,33 @@
 import re
+import uuid
 import json
+import time
+import threading
+import collections
+from unittest import mock
 
-from django.test import TestCase
+from datetime import datetime
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from . import flickr
+from .feeddownloader import (
+    update_podcasts,
+    fetch_feeds,
+    PodcastUpdater,
+    MultiEpisodeUpdater,
+)
+from .models import PodcastUpdateResult
+from .podcast import calc_similar_podcasts_batch, set_related_podcasts
+from .tasks import schedule_push_update, UPDATE_LEASE
+from mygpo.podcasts.models import Podcast, Episode, PUSH_UPDATE_INTERVAL_FACTOR
+from mygpo.pubsub.models import HubSubscription
+from mygpo.users.models import Client
+from mygpo.subscriptions.tasks import subscribe_many
+from mygpo.test import create_user
 
 import responses
 
@@ -64,3 +88,408 @@ class FlickrTests(TestCase):
             )
 
         self.assertEqual(disp_photo, MEDIUM_URL)
+
+
+FEEDSERVICE_URL = re.compile(r"http://feeds\.gpodder\.net/parse.*")
+
+
+def _parsed_feed(url, num_episodes=3):
+    """ a feed as returned by the feed-service """
+    return {
+        "title": "Podcast " + url,
+        "link": url,
+        "urls": [url],
+        "content_types": ["audio"],
+        "episodes": [
+            {
+                "title": "Episode %d" % n,
+                "guid": "%s#%d" % (url, n),
+                "released": 1500000000 + n * 86400,
+                "files": [
+                    {
+                        "urls": ["%s/episode-%d.mp3" % (url, n)],
+                        "filesize": 1000,
+                        "mimetype": "audio/mpeg",
+                    }
+                ],
+            }
+            for n in range(num_episodes)
+        ],
+    }
+
+
+def _feedservice_callback(request):
+    """ responds to a feed-service request with a generated feed """
+    from urllib.parse import urlparse, parse_qs
+
+    url = parse_qs(urlparse(request.url).query)["url"][0]
+    if "broken" in url:
+        return (500, {}, "")
+
+    if "empty" in url:
+        return (200, {}, "[]")
+
+    return (200, {}, json.dumps([_parsed_feed(url)]))
+
+
+@override_settings(FEEDSERVICE_URL="http://feeds.gpodder.net/")
+class UpdatePodcastsTests(TestCase):
+    """ Test updating multiple podcasts concurrently """
+
+    def test_update_podcasts(self):
+        urls = ["http://example.com/feed%d.xml" % n for n in range(5)] + [
+            "http://example.org/feed.xml",
+            "",
+            "http://example.net/broken.xml",
+        ]
+
+        with responses.RequestsMock() as rsps:
+            rsps.add_callback(responses.GET, FEEDSERVICE_URL, _feedservice_callback)
+            podcasts = list(update_podcasts(urls, max_workers=3, max_per_host=2))
+
+        # the broken feed and the empty URL don't result in podcasts
+        self.assertEqual(len(podcasts), 6)
+        self.assertEqual({p.url for p in podcasts}, set(filter(None, urls[:6])))
+
+        for podcast in podcasts:
+            self.assertEqual(podcast.title, "Podcast " + podcast.url)
+            self.assertEqual(podcast.episode_count, 3)
+
+    def test_fetch_error_recorded(self):
+        """ exceptions raised while fetching are stored in the update result """
+        url = "http://example.com/empty.xml"
+
+        with responses.RequestsMock() as rsps:
+            rsps.add_callback(responses.GET, FEEDSERVICE_URL, _feedservice_callback)
+            with self.assertRaises(IndexError):
+                list(update_podcasts([url]))
+
+        result = PodcastUpdateResult.objects.get(podcast_url=url)
+        self.assertFalse(result.successful)
+        self.assertFalse(result.podcast_created)
+
+    def test_fetch_feeds_per_host_limit(self):
+        """ not more than max_per_host feeds of one host are fetched at once """
+        urls = ["http://example.com/feed%d.xml" % n for n in range(6)]
+
+        running = collections.Counter()
+        max_running = collections.Counter()
+        lock = threading.Lock()
+
+        def fetch(updater):
+            with lock:
+                running["example.com"] += 1
+                max_running["example.com"] = max(
+                    max_running["example.com"], running["example.com"]
+                )
+
+            time.sleep(0.01)
+
+            with lock:
+                running["example.com"] -= 1
+
+            return (None, None)
+
+        with mock.patch.object(PodcastUpdater, "fetch", fetch):
+            fetched = list(fetch_feeds(urls, max_workers=4, max_per_host=2))
+
+        self.assertEqual(len(fetched), len(urls))
+        self.assertEqual(max_running["example.com"], 2)
+
+
+@override_settings(FEEDSERVICE_URL="http://feeds.gpodder.net/")
+class UnchangedFeedTests(TestCase):
+    """ Test skipping updates of unchanged feeds """
+
+    def _update(self, url):
+        with responses.RequestsMock() as rsps:
+            rsps.add_callback(responses.GET, FEEDSERVICE_URL, _feedservice_callback)
+            return PodcastUpdater(url).update_podcast()
+
+    def test_unchanged_feed(self):
+        url = "http://example.com/unchanged.xml"
+        podcast = self._update(url)
+        self.assertIsNotNone(podcast.feed_hash)
+        self.assertEqual(podcast.episode_count, 3)
+
+        episodes = Episode.objects.filter(podcast=podcast)
+        self.assertFalse(episodes.filter(content_hash__isnull=True).exists())
+        modified = {e.id: e.modified for e in episodes}
+
+        last_update = podcast.last_update
+        factor = podcast.update_interval_factor
+
+        with CaptureQueriesContext(connection) as queries:
+            podcast = self._update(url)
+
+        # besides the update result, only the podcast is written
+        writes = [
+            q["sql"]
+            for q in queries
+            if q["sql"].startswith(("UPDATE", "INSERT", "DELETE"))
+            and "data_podcastupdateresult" not in q["sql"]
+        ]
+        self.assertEqual(len(writes), 1, writes)
+
+        podcast.refresh_from_db()
+        self.assertGreater(podcast.last_update, last_update)
+        self.assertGreater(podcast.update_interval_factor, factor)
+        self.assertEqual({e.id: e.modified for e in episodes}, modified)
+
+    def test_failed_update(self):
+        """ A feed is updated completely again if its last update failed """
+        url = "http://example.com/failed.xml"
+
+        with mock.patch.object(
+            PodcastUpdater, "_update_podcast", side_effect=ValueError
+        ), self.assertRaises(ValueError):
+            self._update(url)
+
+        podcast = Podcast.objects.get(urls__url=url)
+        self.assertIsNone(podcast.feed_hash)
+
+        podcast = self._update(url)
+        self.assertEqual(podcast.title, "Podcast " + url)
+        self.assertIsNotNone(podcast.feed_hash)
+
+    def test_update_lease(self):
+        """ The lease of a claimed podcast is kept until its update is done """
+        url = "http://example.com/lease.xml"
+        podcast = self._update(url)
+        Podcast.objects.filter(pk=podcast.pk).update(
+            next_update=datetime(2000, 1, 1), feed_hash=None
+        )
+        Podcast.objects.claim_next_updates(1, UPDATE_LEASE)
+
+        podcast.refresh_from_db()
+        leased = podcast.next_update
+        self.assertGreater(leased, datetime.utcnow())
+
+        with mock.patch.object(
+            PodcastUpdater, "_update_podcast", side_effect=ValueError
+        ), self.assertRaises(ValueError):
+            self._update(url)
+
+        podcast.refresh_from_db()
+        self.assertEqual(podcast.next_update, leased)
+
+        podcast = self._update(url)
+        podcast.refresh_from_db()
+        self.assertEqual(podcast.next_update, podcast.calc_next_update())
+
+
+class PushUpdateTests(TestCase):
+    """ Test updates triggered by notifications from hubs """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_collapse_notifications(self):
+        url = "http://example.com/push.xml"
+
+        with mock.patch("mygpo.data.tasks.celery.send_task") as send_task:
+            self.assertTrue(schedule_push_update(url))
+            self.assertFalse(schedule_push_update(url))
+            self.assertTrue(schedule_push_update(url + "?other"))
+
+        self.assertEqual(send_task.call_count, 2)
+        self.assertEqual(send_task.call_args_list[0][1]["args"], [[url]])
+
+    def test_backoff_polling(self):
+        """ podcasts with a verified hub subscription are polled less often """
+        podcast = Podcast.objects.get_or_create_for_url(
+            "http://example.com/hub.xml",
+            defaults={
+                "hub": "http://hub.example.com/",
+                "last_update": datetime(2020, 1, 1),
+            },
+        ).object
+        interval = podcast.next_update - podcast.last_update
+
+        HubSubscription.objects.create(
+            podcast=podcast,
+            topic_url=podcast.url,
+            hub_url=podcast.hub,
+            mode="subscribe",
+            verified=True,
+        )
+        podcast.reschedule()
+
+        self.assertEqual(
+            podcast.next_update - podcast.last_update,
+            interval * PUSH_UPDATE_INTERVAL_FACTOR,
+        )
+
+
+class MultiEpisodeUpdaterTests(TestCase):
+    """ Test creating and updating episodes in bulk """
+
+    def _update_episodes(self, podcast, parsed_episodes):
+        result = PodcastUpdateResult(podcast=podcast, podcast_url=podcast.url)
+        result.episodes_added = 0
+        updater = MultiEpisodeUpdater(podcast, result)
+
+        with CaptureQueriesContext(connection) as queries:
+            updater.update_episodes(parsed_episodes)
+
+        return result, len(queries)
+
+    def test_constant_queries(self):
+        """ the number of queries doesn't depend on the number of episodes """
+        url1 = "http://example.com/few.xml"
+        url2 = "http://example.com/many.xml"
+        podcast1 = Podcast.objects.get_or_create_for_url(url1).object
+        podcast2 = Podcast.objects.get_or_create_for_url(url2).object
+
+        few = _parsed_feed(url1, 2)["episodes"]
+        many = _parsed_feed(url2, 50)["episodes"]
+
+        result1, queries1 = self._update_episodes(podcast1, few)
+        result2, queries2 = self._update_episodes(podcast2, many)
+
+        self.assertEqual(result1.episodes_added, 2)
+        self.assertEqual(result2.episodes_added, 50)
+        self.assertEqual(queries1, queries2)
+
+        podcast2.refresh_from_db()
+        self.assertEqual(podcast2.episode_count, 50)
+
+    def test_update_existing(self):
+        """ existing episodes are updated, missing ones marked outdated """
+        url = "http://example.com/update.xml"
+        podcast = Podcast.objects.get_or_create_for_url(url).object
+        parsed_episodes = _parsed_feed(url, 5)["episodes"]
+        self._update_episodes(podcast, parsed_episodes)
+
+        # the first episode disappears, the second one changes and gets an
+        # additional URL
+        parsed_episodes = parsed_episodes[1:]
+        parsed_episodes[0]["title"] = "New Title"
+        parsed_episodes[0]["files"][0]["urls"].append(url + "/mirror.mp3")
+
+        changed_modified = Episode.objects.get(title="Episode 2").modified
+        result, _queries = self._update_episodes(podcast, parsed_episodes)
+        self.assertEqual(result.episodes_added, 0)
+
+        episodes = Episode.objects.filter(podcast=podcast)
+        self.assertEqual(episodes.count(), 5)
+        self.assertEqual(episodes.filter(outdated=True).count(), 1)
+
+        # only the changed episode has been written
+        self.assertEqual(
+            episodes.exclude(modified=changed_modified).count(),
+            1,
+        )
+
+        changed = episodes.get(title="New Title")
+        self.assertEqual(
+            [u.url for u in changed.urls.all()],
+            [url + "/episode-1.mp3", url + "/mirror.mp3"],
+        )
+
+
+class OrderEpisodesTests(TestCase):
+    """ Test ordering episodes by their release timestamp """
+
+    def _update(self, podcast, parsed_episodes):
+        result = PodcastUpdateResult(podcast=podcast, podcast_url=podcast.url)
+        result.episodes_added = 0
+        updater = MultiEpisodeUpdater(podcast, result)
+        updater.update_episodes(parsed_episodes)
+        podcast.refresh_from_db()
+        updater.order_episodes()
+        return updater
+
+    def _titles_by_order(self, podcast):
+        episodes = Episode.objects.filter(podcast=podcast).order_by("order")
+        return [(e.order, e.title) for e in episodes]
+
+    def test_order_episodes(self):
+        url = "http://example.com/order.xml"
+        podcast = Podcast.objects.get_or_create_for_url(url).object
+        parsed_episodes = _parsed_feed(url, 3)["episodes"]
+        del parsed_episodes[1]["released"]
+
+        updater = self._update(podcast, parsed_episodes)
+        self.assertEqual(updater.max_episode_order, 2)
+        self.assertEqual(
+            self._titles_by_order(podcast),
+            [(0, "Episode 1"), (1, "Episode 0"), (2, "Episode 2")],
+        )
+
+        # the release timestamp of an existing episode changes
+        parsed_episodes[0]["released"] = 1600000000
+        with mock.patch.object(
+            MultiEpisodeUpdater,
+            "_order_new_episodes",
+            side_effect=AssertionError("all episodes should be reordered"),
+        ):
+            self._update(podcast, parsed_episodes)
+
+        self.assertEqual(
+            self._titles_by_order(podcast),
+            [(0, "Episode 1"), (1, "Episode 2"), (2, "Episode 0")],
+        )
+
+    def test_order_new_episodes(self):
+        """ only new episodes are updated if they're the most recent ones """
+        url = "http://example.com/order-new.xml"
+        podcast = Podcast.objects.get_or_create_for_url(url).object
+        parsed_episodes = _parsed_feed(url, 5)["episodes"]
+
+        self._update(podcast, parsed_episodes[:3])
+
+        with mock.patch.object(
+            MultiEpisodeUpdater,
+            "_order_all_episodes",
+            side_effect=AssertionError("only new episodes should be ordered"),
+        ):
+            updater = self._update(podcast, parsed_episodes)
+
+        self.assertEqual(updater.max_episode_order, 4)
+        self.assertEqual(
+            self._titles_by_order(podcast),
+            [(n, "Episode %d" % n) for n in range(5)],
+        )
+
+
+class SimilarPodcastsTests(TestCase):
+    """ Test calculating similar podcasts from co-subscriptions """
+
+    def setUp(self):
+        self.podcasts = [
+            Podcast.objects.get_or_create_for_url(
+                "http://example.com/similar-%d.rss" % n
+            ).object
+            for n in range(4)
+        ]
+
+        # podcast 0 is subscribed together with 1 by three users, and
+        # together with 2 by one user
+        subscriptions = [[0, 1], [0, 1], [0, 1, 2], [3]]
+        for podcast_nums in subscriptions:
+            user, _pwd = create_user()
+            client = Client.objects.create(user=user, uid="dev", id=uuid.uuid1())
+            podcasts = [self.podcasts[n] for n in podcast_nums]
+            subscribe_many([(p, p.url) for p in podcasts], user, client)
+
+    def test_calc_similar_podcasts(self):
+        p = self.podcasts
+        with self.assertNumQueries(1):
+            similar = calc_similar_podcasts_batch([p[0].pk, p[2].pk, p[3].pk])
+
+        self.assertEqual(similar[p[0].pk], [(p[1].pk, 3), (p[2].pk, 1)])
+        self.assertEqual(similar[p[2].pk], [(p[0].pk, 1), (p[1].pk, 1)])
+        self.assertNotIn(p[3].pk, similar)
+
+        # only one subscriber is sampled
+        similar = calc_similar_podcasts_batch([p[1].pk], user_sample=1)
+        self.assertEqual({score for pk, score in similar[p[1].pk]}, {1})
+
+    def test_set_related_podcasts(self):
+        p = self.podcasts
+        set_related_podcasts(calc_similar_podcasts_batch([p[0].pk], num=1))
+        self.assertEqual(list(p[0].related_podcasts.all()), [p[1]])
+
+        set_related_podcasts(calc_similar_podcasts_batch([p[0].pk]))
+        self.assertEqual(set(p[0].related_podcasts.all()), {p[1], p[2]})
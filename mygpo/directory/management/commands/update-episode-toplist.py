@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+
+from mygpo.podcasts.models import Episode
+from mygpo.history.models import EpisodeListenerDelta
+from mygpo.utils import progress
+
+
+class Command(BaseCommand):
+    """Recalculates the listeners of all episodes from the episode history
+
+    New listeners are added regularly by a periodic task; this is only
+    required for existing history, or to correct the counts. Episodes are
+    processed in batches so that each is only locked briefly."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            dest="batch_size",
+            default=1000,
+            help="Number of episodes to update at once",
+        )
+
+        parser.add_argument(
+            "--silent",
+            action="store_true",
+            dest="silent",
+            default=False,
+            help="Don't show any output",
+        ),
+
+    def handle(self, *args, **options):
+
+        silent = options.get("silent")
+        batch_size = options.get("batch_size")
+
+        episode_ids = Episode.objects.order_by("pk").values_list("pk", flat=True)
+        total = Episode.objects.count_fast()
+
+        last_id = None
+        n = 0
+        while True:
+            batch = episode_ids
+            if last_id is not None:
+                batch = batch.filter(pk__gt=last_id)
+            batch = list(batch[:batch_size])
+
+            if not batch:
+                break
+
+            EpisodeListenerDelta.objects.recalculate(batch)
+            last_id = batch[-1]
+            n += len(batch)
+
+            if not silent:
+                progress(n, total)
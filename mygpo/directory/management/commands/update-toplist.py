@@ -1,16 +1,23 @@
-from optparse import make_option
-
 from django.core.management.base import BaseCommand
 
-from mygpo.podcasts.models import Podcast
-from mygpo.utils import progress
-from mygpo.directory.tasks import update_podcast_subscribers
+from mygpo.directory.tasks import recalc_subscriber_counts
 
 
 class Command(BaseCommand):
-    """ For each podcast a task is scheduled to update its subscriber count """
+    """Recalculates the subscriber counts of podcasts
+
+    By default only podcasts whose subscriptions have changed since the last
+    run are updated"""
 
     def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            dest="all",
+            default=False,
+            help="Recalculate the subscriber counts of all podcasts",
+        )
+
         parser.add_argument(
             "--silent",
             action="store_true",
@@ -21,13 +28,7 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
 
-        silent = options.get("silent")
-
-        podcasts = Podcast.objects.all()
-        total = podcasts.count_fast()
-
-        for n, podcast in enumerate(podcasts):
-            update_podcast_subscribers.delay(podcast.get_id())
+        num = recalc_subscriber_counts(all_podcasts=options.get("all"))
 
-            if not silent:
-                progress(n, total)
+        if not options.get("silent"):
+            self.stdout.write("Updated {num} podcasts".format(num=num))
@@ -1,27 +1,125 @@
+from datetime import timedelta
+
+from django.db import connection
+from celery.decorators import periodic_task
+from celery.utils.log import get_task_logger
 from django_db_geventpool.utils import close_connection
 
 from mygpo.podcasts.models import Podcast
-from mygpo.subscriptions.models import Subscription
+from mygpo.subscriptions.models import Subscription, SubscriberCountDelta
+from mygpo.directory.toplist import update_toplists
 from mygpo.celery import celery
 
+logger = get_task_logger(__name__)
+
 
-@celery.task(max_retries=5)
+@celery.task
 @close_connection
 def update_podcast_subscribers(podcast_id):
     """ Updates the subscriber count of a podcast """
 
-    try:
-        podcast = Podcast.objects.get(id=podcast_id)
+    # subscriber counts are now maintained by flush_subscriber_counts; as
+    # there can still be tasks like this in the queue, we should still be
+    # able to handle them
+    recalc_subscriber_counts([podcast_id])
+
+
+@periodic_task(run_every=timedelta(minutes=5))
+@close_connection
+def flush_subscriber_counts():
+    """ Adds pending subscriber count deltas to the podcasts """
+    num = apply_subscriber_count_deltas()
+    logger.info("Updated subscriber counts of {num} podcasts".format(num=num))
+
+    if num:
+        update_toplists()
+
+
+@periodic_task(run_every=timedelta(hours=6))
+@close_connection
+def reconcile_subscriber_counts():
+    """ Recalculates the subscriber counts of recently changed podcasts """
+    num = recalc_subscriber_counts()
+    logger.info("Reconciled subscriber counts of {num} podcasts".format(num=num))
+
+    if num:
+        update_toplists()
+
+
+def apply_subscriber_count_deltas():
+    """Adds the pending deltas to the subscriber counts in one statement
+
+    Returns the number of updated podcasts"""
+    query = """
+        WITH applied AS (
+            UPDATE {delta_table} SET applied = true
+            WHERE NOT applied
+            RETURNING podcast_id, delta
+        ), totals AS (
+            SELECT podcast_id, SUM(delta) AS delta
+            FROM applied
+            GROUP BY podcast_id
+        )
+        UPDATE {podcast_table} p
+        SET subscribers = GREATEST(p.subscribers + totals.delta, 0)
+        FROM totals
+        WHERE p.id = totals.podcast_id AND totals.delta <> 0
+    """.format(
+        delta_table=SubscriberCountDelta._meta.db_table,
+        podcast_table=Podcast._meta.db_table,
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        return cursor.rowcount
+
+
+def recalc_subscriber_counts(podcast_ids=None, all_podcasts=False):
+    """Recalculates subscriber counts from the subscriptions
+
+    Only podcasts with (applied or pending) deltas are recalculated, and their
+    deltas are removed. If ``podcast_ids`` are given, only these podcasts are
+    recalculated; if ``all_podcasts`` is set, the counts of all podcasts are
+    recalculated. Returns the number of corrected podcasts"""
+
+    params = []
+    reconciled = ""
+
+    if podcast_ids is not None:
+        podcast_ids = [str(podcast_id) for podcast_id in podcast_ids]
+        reconciled = "WHERE podcast_id = ANY(%s::uuid[])"
+        changed = "SELECT unnest(%s::uuid[])"
+        params = [podcast_ids, podcast_ids]
+    elif all_podcasts:
+        changed = "SELECT id FROM {podcast_table}"
+    else:
+        changed = "SELECT DISTINCT podcast_id FROM reconciled"
 
-        # calculate current number of subscribers
-        podcast.subscribers = (
-            Subscription.objects.filter(podcast=podcast)
-            .order_by("user")
-            .distinct("user")
-            .count()
+    query = """
+        WITH reconciled AS (
+            DELETE FROM {delta_table}
+            {reconciled}
+            RETURNING podcast_id
+        ), changed (podcast_id) AS (
+            {changed}
+        ), counts AS (
+            SELECT changed.podcast_id, COUNT(DISTINCT s.user_id) AS subscribers
+            FROM changed
+            LEFT JOIN {subscription_table} s ON s.podcast_id = changed.podcast_id
+            GROUP BY changed.podcast_id
         )
-        podcast.save()
+        UPDATE {podcast_table} p
+        SET subscribers = counts.subscribers
+        FROM counts
+        WHERE p.id = counts.podcast_id AND p.subscribers <> counts.subscribers
+    """.format(
+        changed=changed.format(podcast_table=Podcast._meta.db_table),
+        reconciled=reconciled,
+        delta_table=SubscriberCountDelta._meta.db_table,
+        subscription_table=Subscription._meta.db_table,
+        podcast_table=Podcast._meta.db_table,
+    )
 
-    # TODO: which exceptions?
-    except Exception as ex:
-        raise update_podcast_subscribers.retry(exc=ex)
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        return cursor.rowcount
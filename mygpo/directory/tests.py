@@ -3,10 +3,20 @@ import doctest
 import uuid
 from datetime import datetime
 
+from django.core.cache import cache
 from django.test import TestCase
 
 from mygpo.podcasts.models import Podcast
+from mygpo.users.models import Client
+from mygpo.subscriptions.models import SubscriberCountDelta
+from mygpo.subscriptions.tasks import subscribe_many, unsubscribe_many
+from mygpo.directory.tasks import (
+    apply_subscriber_count_deltas,
+    recalc_subscriber_counts,
+)
+from mygpo.directory.toplist import get_toplist, update_toplists
 from mygpo.directory.views import ToplistView
+from mygpo.test import create_user
 
 
 class ToplistTests(unittest.TestCase):
@@ -23,3 +33,95 @@ class ToplistTests(unittest.TestCase):
         view = ToplistView()
         all_langs = view.all_languages()
         self.assertEqual(all_langs, {"de": "Deutsch", "en": "English"})
+
+
+class PodcastToplistTests(TestCase):
+    """ Test the precomputed podcast toplists """
+
+    def setUp(self):
+        cache.clear()
+        self.podcasts = [
+            Podcast.objects.create(
+                id=uuid.uuid1(), subscribers=n, language="de" if n % 2 else "en"
+            )
+            for n in range(1, 6)
+        ]
+
+    def test_toplist(self):
+        p = self.podcasts
+        self.assertEqual(get_toplist(), [p[4], p[3], p[2], p[1], p[0]])
+        self.assertEqual(get_toplist("de", num=2), [p[4], p[2]])
+
+        # stored toplists are only sliced
+        with self.assertNumQueries(1):
+            self.assertEqual(get_toplist(num=1), [p[4]])
+
+    def test_update_toplists(self):
+        p = self.podcasts
+        get_toplist("en")
+        Podcast.objects.filter(pk=p[1].pk).update(subscribers=10)
+
+        # not yet refreshed
+        self.assertEqual(get_toplist("en"), [p[3], p[1]])
+
+        update_toplists()
+        self.assertEqual(get_toplist("en"), [p[1], p[3]])
+        self.assertEqual(get_toplist()[0], p[1])
+
+
+class SubscriberCountTests(TestCase):
+    """ Test the incremental maintenance of subscriber counts """
+
+    def setUp(self):
+        self.user, _pwd = create_user()
+        self.client = Client.objects.create(user=self.user, uid="dev1", id=uuid.uuid1())
+        self.other_client = Client.objects.create(
+            user=self.user, uid="dev2", id=uuid.uuid1()
+        )
+        self.url = "http://example.com/subscriber-count.rss"
+        self.podcast = Podcast.objects.get_or_create_for_url(self.url).object
+
+    def _subscribers(self):
+        self.podcast.refresh_from_db()
+        return self.podcast.subscribers
+
+    def test_deltas(self):
+        """ Subscribing on multiple clients counts the user once """
+        subscribe_many([(self.podcast, self.url)], self.user, self.client)
+        subscribe_many([(self.podcast, self.url)], self.user, self.other_client)
+
+        apply_subscriber_count_deltas()
+        self.assertEqual(self._subscribers(), 1)
+
+        unsubscribe_many([self.podcast], self.user, self.client)
+        apply_subscriber_count_deltas()
+        self.assertEqual(self._subscribers(), 1)
+
+        unsubscribe_many([self.podcast], self.user, self.other_client)
+        apply_subscriber_count_deltas()
+        self.assertEqual(self._subscribers(), 0)
+
+    def test_reconcile(self):
+        """ Reconciling corrects the counts of changed podcasts """
+        subscribe_many([(self.podcast, self.url)], self.user, self.client)
+
+        # a wrong count is corrected, even if the deltas are still pending
+        Podcast.objects.filter(pk=self.podcast.pk).update(subscribers=10)
+        recalc_subscriber_counts()
+        self.assertEqual(self._subscribers(), 1)
+        self.assertFalse(SubscriberCountDelta.objects.exists())
+
+        # without deltas, the podcast is not recalculated
+        Podcast.objects.filter(pk=self.podcast.pk).update(subscribers=10)
+        recalc_subscriber_counts()
+        self.assertEqual(self._subscribers(), 10)
+
+        recalc_subscriber_counts(all_podcasts=True)
+        self.assertEqual(self._subscribers(), 1)
+
+        # only the given podcasts are recalculated
+        Podcast.objects.filter(pk=self.podcast.pk).update(subscribers=10)
+        recalc_subscriber_counts([])
+        self.assertEqual(self._subscribers(), 10)
+        recalc_subscriber_counts([self.podcast.pk])
+        self.assertEqual(self._subscribers(), 1)
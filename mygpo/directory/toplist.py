@@ -0,0 +1,63 @@
+"""Precomputed podcast toplists
+
+The toplists are kept in the cache as ranked lists of podcast IDs per
+language, so that toplists of any length and format can be served by
+slicing them. They are refreshed when subscriber counts change."""
+
+from django.core.cache import cache
+
+from mygpo.podcasts.models import Podcast
+
+# number of podcasts that are stored per toplist
+TOPLIST_SIZE = 100
+
+# toplists are refreshed when subscriber counts change; the timeout only
+# limits how long the toplists of languages that are not used are kept
+TOPLIST_TIMEOUT = 60 * 60 * 24
+
+# key under which the languages of the stored toplists are kept
+LANGUAGES_KEY = "podcast-toplist-languages"
+
+
+def _toplist_key(language):
+    return "podcast-toplist-{lang}".format(lang=language or "")
+
+
+def get_toplist_ids(language=None):
+    """ IDs of the most subscribed podcasts, optionally of one language """
+    ids = cache.get(_toplist_key(language))
+    if ids is None:
+        ids = update_toplist(language)
+    return ids
+
+
+def get_toplist(language=None, num=TOPLIST_SIZE, queryset=None):
+    """The ``num`` most subscribed podcasts, optionally of one language
+
+    ``queryset`` can be used to eg prefetch related objects"""
+    ids = get_toplist_ids(language)[:num]
+
+    if queryset is None:
+        queryset = Podcast.objects.all()
+
+    podcasts = queryset.in_bulk(ids)
+    return [podcasts[pk] for pk in ids if pk in podcasts]
+
+
+def update_toplist(language=None):
+    """ Recalculates and stores the toplist of the given language """
+    toplist = Podcast.objects.all().toplist(language)
+    ids = list(toplist.values_list("pk", flat=True)[:TOPLIST_SIZE])
+    cache.set(_toplist_key(language), ids, TOPLIST_TIMEOUT)
+
+    languages = cache.get(LANGUAGES_KEY, set())
+    if (language or "") not in languages:
+        cache.set(LANGUAGES_KEY, languages | {language or ""}, TOPLIST_TIMEOUT)
+
+    return ids
+
+
+def update_toplists():
+    """ Recalculates all stored toplists """
+    for language in cache.get(LANGUAGES_KEY, set()) | {""}:
+        update_toplist(language)
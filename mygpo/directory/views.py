@@ -20,6 +20,7 @@ from django.contrib.auth import get_user_model
 
 from mygpo.podcasts.models import Podcast, Episode
 from mygpo.directory.search import search_podcasts
+from mygpo.directory.toplist import get_toplist
 from mygpo.web.utils import (
     process_lang_params,
     get_language_names,
@@ -78,10 +79,8 @@ class PodcastToplistView(ToplistView):
     def get_context_data(self, num=100):
         context = super(PodcastToplistView, self).get_context_data()
 
-        entries = (
-            Podcast.objects.all()
-            .prefetch_related("slugs")
-            .toplist(self.language())[:num]
+        entries = get_toplist(
+            self.language(), num, Podcast.objects.prefetch_related("slugs")
         )
         context["entries"] = entries
 
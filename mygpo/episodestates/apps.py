@@ -1,18 +1,34 @@
 from django.apps import AppConfig, apps
+from django.db import transaction
 from django.db.models.signals import post_save
 
+from mygpo.history.signals import episode_history_created
+
 
 def set_episode_state(sender, **kwargs):
     """ Updates the episode state with the saved EpisodeHistoryEntry """
 
-    from mygpo.episodestates.tasks import update_episode_state
-
     historyentry = kwargs.get("instance", None)
 
     if not historyentry:
         return
 
-    update_episode_state.delay(historyentry.pk)
+    _update_episode_states([historyentry.pk])
+
+
+def set_episode_states(sender, entries, **kwargs):
+    """ Updates the episode states with EpisodeHistoryEntries created in bulk """
+    _update_episode_states([entry.pk for entry in entries])
+
+
+def _update_episode_states(historyentry_pks):
+    from mygpo.episodestates.tasks import schedule_episode_state_updates
+
+    if not historyentry_pks:
+        return
+
+    # the task can only see the entries once they are committed
+    transaction.on_commit(lambda: schedule_episode_state_updates(historyentry_pks))
 
 
 class EpisodeStatesConfig(AppConfig):
@@ -22,3 +38,4 @@ class EpisodeStatesConfig(AppConfig):
     def ready(self):
         EpisodeHistoryEntry = apps.get_model("history.EpisodeHistoryEntry")
         post_save.connect(set_episode_state, sender=EpisodeHistoryEntry)
+        episode_history_created.connect(set_episode_states, sender=EpisodeHistoryEntry)
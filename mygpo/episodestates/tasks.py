@@ -1,4 +1,5 @@
 from celery.utils.log import get_task_logger
+from django.db import connection
 from django_db_geventpool.utils import close_connection
 
 from mygpo.celery import celery
@@ -8,6 +9,10 @@ from mygpo.episodestates.models import EpisodeState
 logger = get_task_logger(__name__)
 
 
+# maximum number of history entries that are processed in one task
+BATCH_SIZE = 1000
+
+
 @celery.task
 @close_connection
 def update_episode_state(historyentry_pk):
@@ -17,21 +22,58 @@ def update_episode_state(historyentry_pk):
     # as there can still be tasks like this in the queue, we should still
     # be able to handle it
     if isinstance(historyentry_pk, EpisodeHistoryEntry):
-        historyentry = historyentry_pk
-    else:
-        historyentry = EpisodeHistoryEntry.objects.get(pk=historyentry_pk)
+        historyentry_pk = historyentry_pk.pk
+
+    update_episode_states_from_history([historyentry_pk])
 
-    user = historyentry.user
-    episode = historyentry.episode
 
+@celery.task
+@close_connection
+def update_episode_states(historyentry_pks):
+    """ Updates the episode states with the saved EpisodeHistoryEntries """
+    num_states = update_episode_states_from_history(historyentry_pks)
     logger.info(
-        "Updating Episode State for {user} / {episode}".format(
-            user=user, episode=episode
+        "Updated {num_states} Episode States from {num_entries} "
+        "history entries".format(
+            num_states=num_states, num_entries=len(historyentry_pks)
         )
     )
 
-    state = EpisodeState.objects.update_or_create(
-        user=user,
-        episode=episode,
-        defaults={"action": historyentry.action, "timestamp": historyentry.timestamp},
+
+def schedule_episode_state_updates(historyentry_pks):
+    """ Queues the update of the episode states, one task per batch """
+    historyentry_pks = list(historyentry_pks)
+    for n in range(0, len(historyentry_pks), BATCH_SIZE):
+        update_episode_states.delay(historyentry_pks[n : n + BATCH_SIZE])
+
+
+def update_episode_states_from_history(historyentry_pks):
+    """Sets the episode states to the latest of the given history entries
+
+    The entries are reduced to the latest one per (user, episode), which is
+    then written with a single upsert. States that are already newer than
+    the given entries are kept, so that the order in which the entries are
+    processed does not matter. Returns the number of written states."""
+
+    historyentry_pks = list(historyentry_pks)
+    if not historyentry_pks:
+        return 0
+
+    query = """
+        INSERT INTO {state_table} (user_id, episode_id, action, timestamp)
+        SELECT DISTINCT ON (user_id, episode_id)
+            user_id, episode_id, action, timestamp
+        FROM {history_table}
+        WHERE id = ANY(%s)
+        ORDER BY user_id, episode_id, timestamp DESC, id DESC
+        ON CONFLICT (user_id, episode_id) DO UPDATE
+            SET action = EXCLUDED.action, timestamp = EXCLUDED.timestamp
+            WHERE {state_table}.timestamp <= EXCLUDED.timestamp
+    """.format(
+        state_table=EpisodeState._meta.db_table,
+        history_table=EpisodeHistoryEntry._meta.db_table,
     )
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, [historyentry_pks])
+        return cursor.rowcount
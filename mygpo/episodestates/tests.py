@@ -1,3 +1,63 @@
+import uuid
+from datetime import datetime, timedelta
+
 from django.test import TestCase
 
-# Create your tests here.
+from mygpo.podcasts.models import Podcast, Episode
+from mygpo.history.models import EpisodeHistoryEntry
+from mygpo.episodestates.models import EpisodeState
+from mygpo.episodestates.tasks import update_episode_states_from_history
+from mygpo.test import create_user
+
+
+class UpdateEpisodeStatesTests(TestCase):
+    """ Test updating episode states from history entries """
+
+    def setUp(self):
+        self.user, _pwd = create_user()
+        self.podcast = Podcast.objects.create(id=uuid.uuid1())
+        self.episodes = [
+            Episode.objects.create(id=uuid.uuid1(), podcast=self.podcast, order=n)
+            for n in range(2)
+        ]
+        self.now = datetime(2020, 1, 1)
+
+    def _entry(self, episode, action, minutes):
+        return EpisodeHistoryEntry.objects.create(
+            user=self.user,
+            episode=episode,
+            action=action,
+            timestamp=self.now + timedelta(minutes=minutes),
+        )
+
+    def test_latest_action(self):
+        """ Only the latest action per episode is stored """
+        entries = [
+            self._entry(self.episodes[0], EpisodeHistoryEntry.PLAY, 2),
+            self._entry(self.episodes[0], EpisodeHistoryEntry.DOWNLOAD, 1),
+            self._entry(self.episodes[1], EpisodeHistoryEntry.DOWNLOAD, 1),
+            self._entry(self.episodes[1], EpisodeHistoryEntry.DELETE, 3),
+        ]
+
+        num = update_episode_states_from_history(e.pk for e in entries)
+
+        self.assertEqual(num, 2)
+        self.assertEqual(
+            EpisodeState.dict_for_user(self.user),
+            {
+                self.episodes[0].pk: EpisodeHistoryEntry.PLAY,
+                self.episodes[1].pk: EpisodeHistoryEntry.DELETE,
+            },
+        )
+
+    def test_keep_newer_state(self):
+        """ States are not overwritten by older history entries """
+        newer = self._entry(self.episodes[0], EpisodeHistoryEntry.PLAY, 2)
+        older = self._entry(self.episodes[0], EpisodeHistoryEntry.DOWNLOAD, 1)
+
+        update_episode_states_from_history([newer.pk])
+        update_episode_states_from_history([older.pk])
+
+        state = EpisodeState.objects.get(user=self.user, episode=self.episodes[0])
+        self.assertEqual(state.action, EpisodeHistoryEntry.PLAY)
+        self.assertEqual(state.timestamp, newer.timestamp)
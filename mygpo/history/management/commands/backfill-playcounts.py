@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from mygpo.history.models import EpisodePlayCount
+
+
+class Command(BaseCommand):
+    """Calculates the daily play counts from the full episode history
+
+    New history entries are counted as they are stored; this is only required
+    once for existing history, or to correct the counts. Entries that are
+    stored while the command is running might not be counted."""
+
+    def handle(self, *args, **options):
+        EpisodePlayCount.objects.recalculate()
@@ -0,0 +1,67 @@
+# Generated by Django 3.0.14 on 2026-10-18 02:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('podcasts', '0046_podcast_toplist_index'),
+        ('history', '0010_episode_history_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PodcastPlayCount',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('date', models.DateField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                (
+                    'podcast',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to='podcasts.Podcast',
+                    ),
+                ),
+            ],
+            options={
+                'unique_together': {('podcast', 'date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='EpisodePlayCount',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('date', models.DateField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                (
+                    'episode',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to='podcasts.Episode',
+                    ),
+                ),
+            ],
+            options={
+                'unique_together': {('episode', 'date')},
+            },
+        ),
+    ]
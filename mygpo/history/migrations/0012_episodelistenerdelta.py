@@ -0,0 +1,37 @@
+# Generated by Django 3.0.14 on 2026-10-18 02:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('podcasts', '0046_podcast_toplist_index'),
+        ('history', '0011_playcounts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EpisodeListenerDelta',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('delta', models.SmallIntegerField()),
+                (
+                    'episode',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to='podcasts.Episode',
+                    ),
+                ),
+            ],
+        ),
+    ]
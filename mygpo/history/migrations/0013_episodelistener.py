@@ -0,0 +1,48 @@
+# Generated by Django 3.0.14 on 2026-10-18 03:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('podcasts', '0049_podcast_next_update'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('history', '0012_episodelistenerdelta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EpisodeListener',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                (
+                    'episode',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to='podcasts.Episode',
+                    ),
+                ),
+                (
+                    'user',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                'unique_together': {('user', 'episode')},
+            },
+        ),
+    ]
@@ -1,12 +1,13 @@
 from collections import Counter
 from datetime import datetime
 
-from django.db import models
+from django.db import models, connection, transaction
 from django.conf import settings
 from django.core.exceptions import ValidationError
 
 from mygpo.podcasts.models import Podcast, Episode
 from mygpo.users.models import Client
+from mygpo.history.signals import episode_history_created
 
 import logging
 
@@ -204,6 +205,8 @@ class EpisodeHistoryEntry(models.Model):
         try:
             entry.full_clean()
             entry.save()
+            EpisodePlayCount.objects.add_entries([entry.pk])
+            EpisodeListenerDelta.objects.add_entries([entry.pk])
             return entry
 
         except ValidationError as e:
@@ -213,3 +216,316 @@ class EpisodeHistoryEntry(models.Model):
                 )
             )
             return None
+
+    @classmethod
+    def create_entries(cls, entries):
+        """Stores multiple (unsaved) entries in bulk
+
+        As in :meth:`create_entry`, entries that already exist or fail
+        validation are skipped. Returns the list of stored entries."""
+
+        entries = list(entries)
+        if not entries:
+            return []
+
+        def _key(entry):
+            return (
+                entry.user_id,
+                entry.episode_id,
+                entry.client_id,
+                entry.action,
+                entry.started,
+                entry.stopped,
+            )
+
+        existing = set(
+            cls.objects.filter(
+                user__in={entry.user_id for entry in entries},
+                episode__in={entry.episode_id for entry in entries},
+            ).values_list("user", "episode", "client", "action", "started", "stopped")
+        )
+
+        new_entries = []
+        for entry in entries:
+            if entry.timestamp is None:
+                entry.timestamp = datetime.utcnow()
+
+            try:
+                # foreign keys are not validated, as this would require one
+                # query per entry and field
+                entry.clean_fields(exclude=["user", "episode", "client"])
+                entry.clean()
+
+            except ValidationError as e:
+                logger.warning(
+                    "Validation of {cls} failed for {user}: {err}".format(
+                        cls=cls, user=entry.user, err=e
+                    )
+                )
+                continue
+
+            key = _key(entry)
+            if key in existing:
+                logger.warning(
+                    "Trying to save duplicate {cls} for {user} "
+                    "/ {episode}".format(
+                        cls=cls, user=entry.user, episode=entry.episode
+                    )
+                )
+                continue
+
+            existing.add(key)
+            new_entries.append(entry)
+
+        cls.objects.bulk_create(new_entries, batch_size=1000)
+
+        new_ids = [entry.pk for entry in new_entries]
+        EpisodePlayCount.objects.add_entries(new_ids)
+        EpisodeListenerDelta.objects.add_entries(new_ids)
+        episode_history_created.send(sender=cls, entries=new_entries)
+
+        return new_entries
+
+
+class PlayCountManager(models.Manager):
+    """ Manager for the daily play counts """
+
+    def add_entries(self, entry_ids):
+        """Adds the given history entries to the daily counts
+
+        Both the episode and the podcast counts are updated in one statement"""
+        entry_ids = [entry_id for entry_id in entry_ids if entry_id is not None]
+        if not entry_ids:
+            return
+
+        query = """
+            WITH new AS (
+                SELECT h.episode_id, e.podcast_id,
+                    date_trunc('day', h.timestamp)::date AS date,
+                    COUNT(*) AS count
+                FROM {history_table} h
+                JOIN {episode_table} e ON e.id = h.episode_id
+                WHERE h.id = ANY(%s)
+                GROUP BY h.episode_id, e.podcast_id, date
+            ), episode_counts AS (
+                INSERT INTO {episode_count_table} (episode_id, date, count)
+                SELECT episode_id, date, count FROM new
+                ON CONFLICT (episode_id, date) DO UPDATE
+                    SET count = {episode_count_table}.count + EXCLUDED.count
+            )
+            INSERT INTO {podcast_count_table} (podcast_id, date, count)
+            SELECT podcast_id, date, SUM(count) FROM new
+            GROUP BY podcast_id, date
+            ON CONFLICT (podcast_id, date) DO UPDATE
+                SET count = {podcast_count_table}.count + EXCLUDED.count
+        """.format(
+            history_table=EpisodeHistoryEntry._meta.db_table,
+            episode_table=Episode._meta.db_table,
+            episode_count_table=EpisodePlayCount._meta.db_table,
+            podcast_count_table=PodcastPlayCount._meta.db_table,
+        )
+
+        with connection.cursor() as cursor:
+            cursor.execute(query, [entry_ids])
+
+    def recalculate(self):
+        """ Recalculates all daily counts from the episode history """
+        episode_query = """
+            INSERT INTO {episode_count_table} (episode_id, date, count)
+            SELECT episode_id, date_trunc('day', timestamp)::date AS date, COUNT(*)
+            FROM {history_table}
+            WHERE episode_id IS NOT NULL
+            GROUP BY episode_id, date
+            ON CONFLICT (episode_id, date) DO UPDATE SET count = EXCLUDED.count
+        """.format(
+            history_table=EpisodeHistoryEntry._meta.db_table,
+            episode_count_table=EpisodePlayCount._meta.db_table,
+        )
+
+        podcast_query = """
+            INSERT INTO {podcast_count_table} (podcast_id, date, count)
+            SELECT e.podcast_id, c.date, SUM(c.count)
+            FROM {episode_count_table} c
+            JOIN {episode_table} e ON e.id = c.episode_id
+            GROUP BY e.podcast_id, c.date
+            ON CONFLICT (podcast_id, date) DO UPDATE SET count = EXCLUDED.count
+        """.format(
+            episode_table=Episode._meta.db_table,
+            episode_count_table=EpisodePlayCount._meta.db_table,
+            podcast_count_table=PodcastPlayCount._meta.db_table,
+        )
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(episode_query)
+            cursor.execute(podcast_query)
+
+
+class PlayCount(models.Model):
+    """Number of episode history events per day
+
+    These are the play counts shown in the listener timelines"""
+
+    date = models.DateField()
+
+    count = models.PositiveIntegerField(default=0)
+
+    objects = PlayCountManager()
+
+    class Meta:
+        abstract = True
+
+
+class EpisodePlayCount(PlayCount):
+    """ Daily play count of an episode """
+
+    episode = models.ForeignKey(Episode, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = [["episode", "date"]]
+
+
+class PodcastPlayCount(PlayCount):
+    """ Daily play count of (all episodes of) a podcast """
+
+    podcast = models.ForeignKey(Podcast, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = [["podcast", "date"]]
+
+
+class EpisodeListenerDeltaManager(models.Manager):
+    """ Manager for the EpisodeListenerDelta model """
+
+    def add_entries(self, entry_ids):
+        """Records new listeners for the given history entries
+
+        A user is a new listener of an episode if none of their earlier
+        history entries for the episode is a play action. As concurrent
+        uploads don't see each other's entries, a delta is only recorded
+        if the user could also be added to EpisodeListener"""
+        entry_ids = [entry_id for entry_id in entry_ids if entry_id is not None]
+        if not entry_ids:
+            return
+
+        query = """
+            WITH listeners AS (
+                INSERT INTO {listener_table} (user_id, episode_id)
+                SELECT h.user_id, h.episode_id
+                FROM (
+                    SELECT DISTINCT ON (user_id, episode_id)
+                        id, user_id, episode_id
+                    FROM {history_table}
+                    WHERE id = ANY(%s) AND action = %s AND episode_id IS NOT NULL
+                    ORDER BY user_id, episode_id, id
+                ) AS h
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {history_table} o
+                    WHERE o.user_id = h.user_id
+                      AND o.episode_id = h.episode_id
+                      AND o.action = %s
+                      AND o.id < h.id
+                )
+                ON CONFLICT (user_id, episode_id) DO NOTHING
+                RETURNING episode_id
+            )
+            INSERT INTO {delta_table} (episode_id, delta)
+            SELECT episode_id, 1 FROM listeners
+        """.format(
+            listener_table=EpisodeListener._meta.db_table,
+            delta_table=self.model._meta.db_table,
+            history_table=EpisodeHistoryEntry._meta.db_table,
+        )
+
+        play = EpisodeHistoryEntry.PLAY
+        with connection.cursor() as cursor:
+            cursor.execute(query, [entry_ids, play, play])
+
+    def apply_batch(self, batch_size):
+        """Adds a batch of deltas to Episode.listeners
+
+        Each batch is a separate short statement, so that episodes are only
+        locked briefly. Returns the number of applied deltas"""
+        query = """
+            WITH batch AS (
+                DELETE FROM {delta_table}
+                WHERE id IN (
+                    SELECT id FROM {delta_table}
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING episode_id, delta
+            ), totals AS (
+                SELECT episode_id, SUM(delta) AS delta, COUNT(*) AS num
+                FROM batch
+                GROUP BY episode_id
+            ), updated AS (
+                UPDATE {episode_table} e
+                SET listeners = GREATEST(COALESCE(e.listeners, 0) + totals.delta, 0)
+                FROM totals
+                WHERE e.id = totals.episode_id
+            )
+            SELECT COALESCE(SUM(num), 0) FROM totals
+        """.format(
+            delta_table=self.model._meta.db_table,
+            episode_table=Episode._meta.db_table,
+        )
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(query, [batch_size])
+            return cursor.fetchone()[0]
+
+    def recalculate(self, episode_ids):
+        """Recalculates the listeners of the given episodes from the history
+
+        Returns the number of corrected episodes"""
+        query = """
+            WITH counts AS (
+                SELECT e.id, (
+                    SELECT COUNT(DISTINCT h.user_id)
+                    FROM {history_table} h
+                    WHERE h.episode_id = e.id AND h.action = %s
+                ) AS listeners
+                FROM {episode_table} e
+                WHERE e.id = ANY(%s::uuid[])
+            )
+            UPDATE {episode_table} e
+            SET listeners = counts.listeners
+            FROM counts
+            WHERE e.id = counts.id AND e.listeners IS DISTINCT FROM counts.listeners
+        """.format(
+            history_table=EpisodeHistoryEntry._meta.db_table,
+            episode_table=Episode._meta.db_table,
+        )
+
+        episode_ids = [str(episode_id) for episode_id in episode_ids]
+        with transaction.atomic(), connection.cursor() as cursor:
+            # pending deltas are included in the recalculated counts
+            self.filter(episode__in=episode_ids).delete()
+            cursor.execute(query, [EpisodeHistoryEntry.PLAY, episode_ids])
+            return cursor.rowcount
+
+
+class EpisodeListener(models.Model):
+    """A user who has played an episode
+
+    Users are added on their first play since this model was introduced;
+    the unique constraint keeps concurrent uploads from recording the same
+    new listener twice"""
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+
+    episode = models.ForeignKey(Episode, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = [["user", "episode"]]
+
+
+class EpisodeListenerDelta(models.Model):
+    """ A new listener of an episode that is not yet in Episode.listeners """
+
+    episode = models.ForeignKey(Episode, on_delete=models.CASCADE)
+
+    delta = models.SmallIntegerField()
+
+    objects = EpisodeListenerDeltaManager()
@@ -0,0 +1,6 @@
+import django.dispatch
+
+# indicates that episode history entries have been created in bulk (bulk
+# inserts do not send post_save). ``sender`` will equal the model class.
+# Additionally the parameter ``entries`` will contain the created entries
+episode_history_created = django.dispatch.Signal()
@@ -1,9 +1,13 @@
 from collections import Counter
 
-from django.db.models import Count
+from django.db.models import Sum
 
 from mygpo.podcasts.models import Episode
-from mygpo.history.models import EpisodeHistoryEntry
+from mygpo.history.models import (
+    EpisodeHistoryEntry,
+    EpisodePlayCount,
+    PodcastPlayCount,
+)
 
 
 def played_episode_counts(user):
@@ -67,13 +71,22 @@ def seconds_played(user, since=None):
     return sum([0] + list(seconds))
 
 
-def playcounts_timerange(historyentries):
+def podcast_playcounts(podcasts, since=None):
     """ returns {date: play-count} containing all days w/ play events"""
-    listeners = (
-        historyentries.extra({"date": "date_trunc('day', timestamp)"})
-        .values("date")
-        .order_by("date")
-        .annotate(count=Count("pk"))
-    )
+    counts = PodcastPlayCount.objects.filter(podcast__in=podcasts)
+
+    if since is not None:
+        counts = counts.filter(date__gte=since)
+
+    counts = counts.values("date").order_by("date").annotate(total=Sum("count"))
+    return {x["date"]: x["total"] for x in counts}
+
+
+def episode_playcounts(episode, since=None):
+    """ returns {date: play-count} containing all days w/ play events"""
+    counts = EpisodePlayCount.objects.filter(episode=episode)
+
+    if since is not None:
+        counts = counts.filter(date__gte=since)
 
-    return {x["date"].date(): x["count"] for x in listeners}
+    return dict(counts.order_by("date").values_list("date", "count"))
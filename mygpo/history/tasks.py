@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from celery.decorators import periodic_task
+from celery.utils.log import get_task_logger
+from django_db_geventpool.utils import close_connection
+
+from mygpo.history.models import EpisodeListenerDelta
+
+logger = get_task_logger(__name__)
+
+
+# number of listener deltas that are applied in one statement
+LISTENER_BATCH_SIZE = 1000
+
+
+@periodic_task(run_every=timedelta(minutes=10))
+@close_connection
+def update_episode_listeners(batch_size=LISTENER_BATCH_SIZE):
+    """ Adds new listeners to Episode.listeners in batches """
+    total = 0
+    while True:
+        num = EpisodeListenerDelta.objects.apply_batch(batch_size)
+        total += num
+
+        if num < batch_size:
+            break
+
+    logger.info("Applied {num} new episode listeners".format(num=total))
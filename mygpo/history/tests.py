@@ -1,3 +1,126 @@
+import uuid
+from datetime import date, datetime
+
 from django.test import TestCase
 
-# Create your tests here.
+from mygpo.podcasts.models import Podcast, Episode
+from mygpo.history.models import (
+    EpisodeHistoryEntry,
+    EpisodePlayCount,
+    EpisodeListenerDelta,
+)
+from mygpo.history.stats import podcast_playcounts, episode_playcounts
+from mygpo.test import create_user
+
+
+class PlayCountTests(TestCase):
+    """ Test the daily play counts """
+
+    def setUp(self):
+        self.user, _pwd = create_user()
+        self.podcast = Podcast.objects.create(id=uuid.uuid1())
+        self.episodes = [
+            Episode.objects.create(id=uuid.uuid1(), podcast=self.podcast, order=n)
+            for n in range(2)
+        ]
+
+    def _entry(self, episode, day, action=EpisodeHistoryEntry.PLAY):
+        return EpisodeHistoryEntry(
+            user=self.user,
+            episode=episode,
+            action=action,
+            timestamp=datetime(2020, 1, day, 12),
+        )
+
+    def test_incremental_counts(self):
+        e = self.episodes
+        EpisodeHistoryEntry.create_entries(
+            [
+                self._entry(e[0], 1),
+                self._entry(e[0], 1, EpisodeHistoryEntry.DOWNLOAD),
+                self._entry(e[1], 2),
+            ]
+        )
+        EpisodeHistoryEntry.create_entry(
+            self.user, e[1], EpisodeHistoryEntry.DELETE, timestamp=datetime(2020, 1, 1)
+        )
+
+        self.assertEqual(episode_playcounts(e[0]), {date(2020, 1, 1): 2})
+        self.assertEqual(
+            episode_playcounts(e[1], since=date(2020, 1, 2)), {date(2020, 1, 2): 1}
+        )
+        self.assertEqual(
+            podcast_playcounts([self.podcast]),
+            {date(2020, 1, 1): 3, date(2020, 1, 2): 1},
+        )
+
+    def test_recalculate(self):
+        e = self.episodes
+        EpisodeHistoryEntry.create_entries([self._entry(e[0], 1), self._entry(e[1], 1)])
+        EpisodePlayCount.objects.update(count=0)
+
+        EpisodePlayCount.objects.recalculate()
+
+        self.assertEqual(podcast_playcounts([self.podcast]), {date(2020, 1, 1): 2})
+        self.assertEqual(episode_playcounts(e[1]), {date(2020, 1, 1): 1})
+
+
+class EpisodeListenerTests(TestCase):
+    """ Test maintaining the listeners of episodes """
+
+    def setUp(self):
+        self.users = [create_user()[0] for n in range(2)]
+        self.podcast = Podcast.objects.create(id=uuid.uuid1())
+        self.episodes = [
+            Episode.objects.create(id=uuid.uuid1(), podcast=self.podcast, order=n)
+            for n in range(2)
+        ]
+
+    def _play(self, user, episode, position, action=EpisodeHistoryEntry.PLAY):
+        return EpisodeHistoryEntry(
+            user=user,
+            episode=episode,
+            action=action,
+            timestamp=datetime(2020, 1, 1),
+            stopped=position,
+        )
+
+    def _listeners(self):
+        return [
+            Episode.objects.get(pk=episode.pk).listeners for episode in self.episodes
+        ]
+
+    def test_listeners(self):
+        u, e = self.users, self.episodes
+        EpisodeHistoryEntry.create_entries(
+            [self._play(u[0], e[0], 10), self._play(u[0], e[0], 20)]
+        )
+        EpisodeHistoryEntry.create_entries(
+            [
+                self._play(u[0], e[0], 30),
+                self._play(u[1], e[0], 10),
+                self._play(u[1], e[1], None, EpisodeHistoryEntry.DOWNLOAD),
+            ]
+        )
+
+        self.assertEqual(EpisodeListenerDelta.objects.apply_batch(1), 1)
+        self.assertEqual(self._listeners(), [1, None])
+        self.assertEqual(EpisodeListenerDelta.objects.apply_batch(10), 1)
+        self.assertEqual(self._listeners(), [2, None])
+        self.assertEqual(list(Episode.objects.all().toplist()), [e[0]])
+
+        Episode.objects.update(listeners=5)
+        EpisodeListenerDelta.objects.recalculate([e[0].pk, e[1].pk])
+        self.assertEqual(self._listeners(), [2, 0])
+
+    def test_concurrent_first_play(self):
+        """ A first play is counted once, even if seen by two uploads """
+        u, e = self.users, self.episodes
+        entries = EpisodeHistoryEntry.create_entries([self._play(u[0], e[0], 10)])
+
+        # a concurrent upload also considers this the first play, as it
+        # can not see the uncommitted entries of the other upload
+        EpisodeListenerDelta.objects.add_entries([entries[0].pk])
+
+        self.assertEqual(EpisodeListenerDelta.objects.apply_batch(10), 1)
+        self.assertEqual(self._listeners(), [1, None])
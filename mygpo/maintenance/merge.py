@@ -1,33 +1,48 @@
 import collections
+import itertools
 
-from django.db import transaction, IntegrityError
+from django.db import transaction, connection
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import Model
 from django.apps import apps
 from django.contrib.contenttypes.fields import GenericForeignKey
 
-from mygpo.podcasts.models import (
-    MergedUUID,
-    ScopedModel,
-    OrderedModel,
-    Slug,
-    Tag,
-    URL,
-    MergedUUID,
-    Podcast,
-    Episode,
-)
-from mygpo import utils
-from mygpo.history.models import HistoryEntry, EpisodeHistoryEntry
-from mygpo.publisher.models import PublishedPodcast
-from mygpo.subscriptions.models import Subscription
+from mygpo.podcasts.models import MergedUUID, Slug, URL, Podcast, Episode
+from mygpo.history.models import EpisodePlayCount, PodcastPlayCount
+from mygpo.episodestates.models import EpisodeState
+from mygpo.subscriptions.models import SubscriptionChange
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-PG_UNIQUE_VIOLATION = 23505
+# Conflicting rows of these models are combined into the row of the primary
+# object before the rows of the alias object are deleted. The SET clauses
+# refer to the primary's row as "p" and to the alias' row as "a".
+COMBINE_COLUMNS = {
+    # there can only be one change per client and podcast; keep the latest
+    SubscriptionChange: """
+        ref_url = CASE WHEN a.modified > p.modified
+                       THEN a.ref_url ELSE p.ref_url END,
+        subscribed = CASE WHEN a.modified > p.modified
+                          THEN a.subscribed ELSE p.subscribed END,
+        modified = GREATEST(a.modified, p.modified),
+        created = LEAST(a.created, p.created)
+    """,
+    # there can only be one count per day; sum them up
+    EpisodePlayCount: "count = p.count + a.count",
+    PodcastPlayCount: "count = p.count + a.count",
+    # there can only be one state per user and episode; keep the latest
+    EpisodeState: """
+        action = CASE WHEN a.timestamp > p.timestamp
+                      THEN a.action ELSE p.action END,
+        timestamp = GREATEST(a.timestamp, p.timestamp)
+    """,
+}
+
+# Ordered, scoped models and the column that is unique within a scope
+SCOPED_VALUES = {URL: "url", Slug: "slug"}
 
 
 class IncorrectMergeException(Exception):
@@ -37,8 +52,11 @@ class IncorrectMergeException(Exception):
 class PodcastMerger(object):
     """ Merges podcasts and their related objects """
 
-    def __init__(self, podcasts, actions, groups):
-        """ Prepares to merge podcasts[1:] into podcasts[0]  """
+    def __init__(self, podcasts, actions, groups, progress=None):
+        """Prepares to merge podcasts[1:] into podcasts[0]
+
+        progress is called with the actions whenever a relation has been
+        reassigned"""
 
         for n, podcast1 in enumerate(podcasts):
             for m, podcast2 in enumerate(podcasts):
@@ -51,6 +69,7 @@ class PodcastMerger(object):
         self.podcasts = podcasts
         self.actions = actions
         self.groups = groups
+        self.progress = progress
 
     def merge(self):
         """ Carries out the actual merging """
@@ -61,65 +80,36 @@ class PodcastMerger(object):
         logger.info("Merge target: %r", podcast1)
 
         self.merge_episodes()
-        merge_model_objects(podcast1, self.podcasts)
+        merge_model_objects(
+            podcast1, self.podcasts, actions=self.actions, progress=self.progress
+        )
 
         return podcast1
 
     def merge_episodes(self):
         """ Merges the episodes according to the groups """
 
-        for n, episodes in self.groups:
-            if not episodes:
-                continue
-
-            episode_id = episodes.pop(0)
-            episode = Episode.objects.get(pk=episode_id)
-            logger.info("Merging %d episodes", len(episodes))
-
-            eps = [Episode.objects.get(pk=eid) for eid in episodes]
-            merge_model_objects(episode, eps)
-
-
-def reassign_urls(obj1, obj2):
-    # Reassign all URLs of obj2 to obj1
-    max_order = max([0] + [u.order for u in obj1.urls.all()])
+        groups = [episodes for n, episodes in self.groups if len(episodes) > 1]
+        if not groups:
+            return
 
-    for n, url in enumerate(obj2.urls.all(), max_order + 1):
-        url.content_object = obj1
-        url.order = n
-        url.scope = obj1.scope
-        try:
-            url.save()
-        except IntegrityError as ie:
-            logger.warning("Moving URL failed: %s. Deleting.", str(ie))
-            url.delete()
+        # IDs might have been serialized when passed to a task
+        episode_ids = [str(eid) for eid in itertools.chain.from_iterable(groups)]
+        episodes = Episode.objects.filter(pk__in=episode_ids).select_related("podcast")
+        episodes = {str(episode.pk): episode for episode in episodes}
 
+        merges = []
+        for group in groups:
+            primary, *aliases = [episodes[str(eid)] for eid in group]
+            merges.append((primary, aliases))
 
-def reassign_merged_uuids(obj1, obj2):
-    # Reassign all IDs of obj2 to obj1
-    MergedUUID.objects.create(uuid=obj2.id, content_object=obj1)
-    for m in obj2.merged_uuids.all():
-        m.content_object = obj1
-        m.save()
+        logger.info("Merging %d groups of episodes", len(merges))
+        merge_objects(merges, actions=self.actions, progress=self.progress)
 
 
-def reassign_slugs(obj1, obj2):
-    # Reassign all Slugs of obj2 to obj1
-    max_order = max([0] + [s.order for s in obj1.slugs.all()])
-    for n, slug in enumerate(obj2.slugs.all(), max_order + 1):
-        slug.content_object = obj1
-        slug.order = n
-        slug.scope = obj1.scope
-        try:
-            slug.save()
-        except IntegrityError as ie:
-            logger.warning("Moving Slug failed: %s. Deleting", str(ie))
-            slug.delete()
-
-
-# based on https://djangosnippets.org/snippets/2283/
-@transaction.atomic
-def merge_model_objects(primary_object, alias_objects=[], keep_old=False):
+def merge_model_objects(
+    primary_object, alias_objects=[], keep_old=False, actions=None, progress=None
+):
     """
     Use this function to merge model objects (i.e. Users, Organizations, Polls,
     etc.) and migrate all of the related fields from the alias objects to the
@@ -134,181 +124,360 @@ def merge_model_objects(primary_object, alias_objects=[], keep_old=False):
     if not isinstance(alias_objects, list):
         alias_objects = [alias_objects]
 
+    merge_objects([(primary_object, alias_objects)], keep_old, actions, progress)
+    return primary_object
+
+
+@transaction.atomic
+def merge_objects(merges, keep_old=False, actions=None, progress=None):
+    """Merges several (primary_object, alias_objects) pairs of one model
+
+    References to the alias objects are reassigned with one UPDATE per
+    relation; rows that would violate a unique constraint after being
+    reassigned are combined with or replaced by the primary's rows."""
+
+    if actions is None:
+        actions = collections.Counter()
+
+    merges = [(primary, aliases) for primary, aliases in merges if aliases]
+    if not merges:
+        return actions
+
     # check that all aliases are the same class as primary one and that
     # they are subclass of model
-    primary_class = primary_object.__class__
+    model = merges[0][0].__class__
 
-    if not issubclass(primary_class, Model):
+    if not issubclass(model, Model):
         raise TypeError("Only django.db.models.Model subclasses can be merged")
 
-    for alias_object in alias_objects:
-        if not isinstance(alias_object, primary_class):
-            raise TypeError("Only models of same class can be merged")
+    if model not in (Podcast, Episode):
+        raise TypeError("unknown type for merging: {objtype}".format(objtype=model))
 
-    # Get a list of all GenericForeignKeys in all models
-    # TODO: this is a bit of a hack, since the generics framework should
-    # provide a similar method to the ForeignKey field for accessing the
-    # generic related fields.
-    generic_fields = []
-    for model in apps.get_models():
-        fields = filter(
-            lambda x: isinstance(x[1], GenericForeignKey), model.__dict__.items()
-        )
-        for field_name, field in fields:
-            generic_fields.append(field)
+    for primary_object, alias_objects in merges:
+        for obj in [primary_object] + alias_objects:
+            if not isinstance(obj, model):
+                raise TypeError("Only models of same class can be merged")
 
-    blank_local_fields = set(
-        [
-            field.attname
-            for field in primary_object._meta.local_fields
-            if getattr(primary_object, field.attname) in [None, ""]
-        ]
+    # Each round maps at most one alias to every primary object, so that
+    # aliases of the same object can't conflict with each other
+    rounds = itertools.zip_longest(
+        *[[(alias, primary) for alias in aliases] for primary, aliases in merges]
     )
+    for pairs in rounds:
+        mapping = _Mapping([pair for pair in pairs if pair is not None])
+        _reassign_all(model, mapping, actions, progress)
+
+    if not keep_old:
+        content_type = ContentType.objects.get_for_model(model)
+        MergedUUID.objects.bulk_create(
+            [
+                MergedUUID(
+                    content_type=content_type, object_id=primary.pk, uuid=alias.pk
+                )
+                for primary, aliases in merges
+                for alias in aliases
+            ]
+        )
 
-    # Loop through all alias objects and migrate their data to
-    # the primary object.
-    for alias_object in alias_objects:
-        # Migrate all foreign key references from alias object to
-        # primary object.
-        for related_object in _get_all_related_objects(alias_object):
-            # The variable name on the alias_object model.
-            alias_varname = related_object.get_accessor_name()
-            # The variable name on the related model.
-            obj_varname = related_object.field.name
-            related_objects = getattr(alias_object, alias_varname)
-            for obj in related_objects.all():
-                setattr(obj, obj_varname, primary_object)
-                reassigned(obj, primary_object)
-                obj.save()
-
-        # Migrate all many to many references from alias object to
-        # primary object.
-        related = _get_all_related_many_to_many_objects(alias_object)
-        for related_many_object in related:
-            alias_varname = related_many_object.get_accessor_name()
-            obj_varname = related_many_object.field.name
-
-            if alias_varname is not None:
-                # standard case
-                related_many_objects = getattr(alias_object, alias_varname).all()
-            else:
-                # special case, symmetrical relation, no reverse accessor
-                related_many_objects = getattr(alias_object, obj_varname).all()
-            for obj in related_many_objects.all():
-                getattr(obj, obj_varname).remove(alias_object)
-                reassigned(obj, primary_object)
-                getattr(obj, obj_varname).add(primary_object)
-
-        # Migrate all generic foreign key references from alias
-        # object to primary object.
-        for field in generic_fields:
-            filter_kwargs = {}
-            filter_kwargs[field.fk_field] = alias_object._get_pk_val()
-            filter_kwargs[field.ct_field] = field.get_content_type(alias_object)
-            related = field.model.objects.filter(**filter_kwargs)
-            for generic_related_object in related:
-                setattr(generic_related_object, field.name, primary_object)
-                reassigned(generic_related_object, primary_object)
-                try:
-                    # execute save in a savepoint, so we can resume in the
-                    # transaction
-                    with transaction.atomic():
-                        generic_related_object.save()
-                except IntegrityError as ie:
-                    if ie.__cause__.pgcode == PG_UNIQUE_VIOLATION:
-                        merge(generic_related_object, primary_object)
-
-        # Try to fill all missing values in primary object by
-        # values of duplicates
-        filled_up = set()
-        for field_name in blank_local_fields:
-            val = getattr(alias_object, field_name)
-            if val not in [None, ""]:
-                setattr(primary_object, field_name, val)
-                filled_up.add(field_name)
-        blank_local_fields -= filled_up
-
-        if not keep_old:
-            before_delete(alias_object, primary_object)
-            alias_object.delete()
-    primary_object.save()
-    return primary_object
+        alias_ids = [alias.pk for primary, aliases in merges for alias in aliases]
+        model.objects.filter(pk__in=alias_ids).delete()
+        actions["{} merged".format(model._meta.verbose_name_plural)] += len(alias_ids)
+
+    # Try to fill all missing values in primary object by
+    # values of duplicates
+    for primary_object, alias_objects in merges:
+        blank_local_fields = set(
+            [
+                field.attname
+                for field in primary_object._meta.local_fields
+                if getattr(primary_object, field.attname) in [None, ""]
+            ]
+        )
 
+        for alias_object in alias_objects:
+            filled_up = set()
+            for field_name in blank_local_fields:
+                val = getattr(alias_object, field_name)
+                if val not in [None, ""]:
+                    setattr(primary_object, field_name, val)
+                    filled_up.add(field_name)
+            blank_local_fields -= filled_up
 
-def _get_all_related_objects(obj):
-    return [
-        f
-        for f in obj._meta.get_fields()
-        if (f.one_to_many or f.one_to_one) and f.auto_created and not f.concrete
-    ]
+        primary_object.save()
 
+    return actions
 
-def _get_all_related_many_to_many_objects(obj):
-    return [
-        f
-        for f in obj._meta.get_fields(include_hidden=True)
-        if f.many_to_many and f.auto_created
-    ]
 
+class _Mapping(object):
+    """ A table of (alias_id, primary_id, scope) rows, usable as CTE "m" """
+
+    def __init__(self, pairs):
+        self.rows = [(alias.pk, primary.pk, primary.scope) for alias, primary in pairs]
+
+    def execute(self, sql, params=[]):
+        """ Executes sql with the mapping as CTE and returns the rowcount """
+        values = ", ".join(["(%s::uuid, %s::uuid, %s)"] * len(self.rows))
+        sql = "WITH m (alias_id, primary_id, scope) AS (VALUES {values}) {sql}".format(
+            values=values, sql=sql
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, list(itertools.chain(*self.rows)) + params)
+            return cursor.rowcount
+
+
+def _reassign_all(model, mapping, actions, progress):
+    """ Reassigns all references to the aliases in mapping """
+
+    for related_object in _get_all_related_objects(model):
+        num = _reassign_foreign_keys(
+            related_object.related_model, related_object.field, mapping
+        )
+        _count(actions, related_object.related_model, num, progress)
 
-def reassigned(obj, new):
-    if isinstance(obj, URL):
-        # a URL has its parent's scope
-        obj.scope = new.scope
+    content_type = ContentType.objects.get_for_model(model)
+    for field in _get_generic_fields():
+        if field.model in SCOPED_VALUES:
+            num = _reassign_scoped(field.model, content_type, mapping)
+        else:
+            num = _reassign_generic(field, content_type, mapping)
+        _count(actions, field.model, num, progress)
 
-        existing_urls = new.urls.all()
-        max_order = max([-1] + [u.order for u in existing_urls])
-        obj.order = max_order + 1
 
-    elif isinstance(obj, Episode):
-        # obj is an Episode, new is a podcast
-        for url in obj.urls.all():
-            url.scope = new.as_scope
-            url.save()
+def _count(actions, model, num, progress):
+    if not num:
+        return
 
-    elif isinstance(obj, Subscription):
-        pass
+    actions["{} reassigned".format(model._meta.verbose_name_plural)] += num
 
-    elif isinstance(obj, EpisodeHistoryEntry):
-        pass
+    if progress is not None:
+        progress(actions)
 
-    elif isinstance(obj, HistoryEntry):
-        pass
 
+def _reassign_foreign_keys(model, field, mapping):
+    """ Points the foreign key field of model from the aliases to the primaries """
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    column = qn(field.column)
+
+    if field.unique:
+        unique_columns = [[]]
     else:
-        raise TypeError(
-            "unknown type for reassigning: {objtype}".format(objtype=type(obj))
+        unique_columns = [
+            [
+                qn(model._meta.get_field(name).column)
+                for name in names
+                if name != field.name
+            ]
+            for names in model._meta.unique_together
+            if field.name in names
+        ]
+
+    for others in unique_columns:
+        conflict = " ".join(
+            "AND a.{col} = p.{col}".format(col=other) for other in others
+        )
+        _resolve_conflicts(
+            model,
+            table,
+            "a.{col} = m.alias_id AND p.{col} = m.primary_id {conflict}".format(
+                col=column, conflict=conflict
+            ),
+            mapping,
         )
 
+    num = mapping.execute(
+        "UPDATE {table} SET {col} = m.primary_id FROM m "
+        "WHERE {table}.{col} = m.alias_id".format(table=table, col=column)
+    )
 
-def before_delete(old, new):
+    if model._meta.auto_created:
+        # the intermediary table of a many-to-many relation to itself
+        # must not link an object to itself
+        columns = [
+            qn(f.column)
+            for f in model._meta.concrete_fields
+            if f.is_relation and f.related_model is field.related_model
+        ]
+        if len(columns) == 2:
+            mapping.execute(
+                "DELETE FROM {table} USING m WHERE {table}.{col1} = m.primary_id "
+                "AND {table}.{col2} = m.primary_id".format(
+                    table=table, col1=columns[0], col2=columns[1]
+                )
+            )
+
+    if model is Episode:
+        # the episodes' URLs and slugs are scoped by their podcast
+        for scoped_model, value in SCOPED_VALUES.items():
+            _move_scope(scoped_model, value, mapping)
+
+    return num
+
+
+def _resolve_conflicts(model, table, join, mapping):
+    """Deletes alias rows that would conflict with primary rows
+
+    Conflicting rows are joined as "a" (alias) and "p" (primary)"""
+    combine = COMBINE_COLUMNS.get(model)
+    if combine:
+        mapping.execute(
+            "UPDATE {table} AS p SET {combine} FROM m, {table} AS a "
+            "WHERE {join}".format(table=table, combine=combine, join=join)
+        )
 
-    if isinstance(old, Episode):
-        MergedUUID.objects.create(
-            content_type=ContentType.objects.get_for_model(new),
-            object_id=new.pk,
-            uuid=old.pk,
+    mapping.execute(
+        "DELETE FROM {table} AS a USING m, {table} AS p WHERE {join}".format(
+            table=table, join=join
         )
+    )
+
 
-    elif isinstance(old, Podcast):
-        MergedUUID.objects.create(
-            content_type=ContentType.objects.get_for_model(new),
-            object_id=new.pk,
-            uuid=old.pk,
+def _reassign_generic(field, content_type, mapping):
+    """ Points a GenericForeignKey from the aliases to the primaries """
+    model = field.model
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    ct_column = qn(model._meta.get_field(field.ct_field).column)
+    fk_column = qn(model._meta.get_field(field.fk_field).column)
+    generic = set([field.ct_field, field.fk_field])
+
+    for names in model._meta.unique_together:
+        if not generic.issubset(names):
+            continue
+
+        conflict = " ".join(
+            "AND a.{col} = p.{col}".format(col=qn(model._meta.get_field(name).column))
+            for name in names
+            if name not in generic
+        )
+        _resolve_conflicts(
+            model,
+            table,
+            "a.{ct} = {ct_id} AND p.{ct} = {ct_id} AND a.{fk} = m.alias_id "
+            "AND p.{fk} = m.primary_id {conflict}".format(
+                ct=ct_column,
+                ct_id=int(content_type.pk),
+                fk=fk_column,
+                conflict=conflict,
+            ),
+            mapping,
         )
 
-    else:
-        raise TypeError(
-            "unknown type for deleting: {objtype}".format(objtype=type(old))
+    return mapping.execute(
+        "UPDATE {table} SET {fk} = m.primary_id FROM m "
+        "WHERE {table}.{ct} = %s AND {table}.{fk} = m.alias_id".format(
+            table=table, ct=ct_column, fk=fk_column
+        ),
+        [content_type.pk],
+    )
+
+
+def _reassign_scoped(model, content_type, mapping):
+    """Moves URLs or Slugs from the aliases to the primaries
+
+    They are appended to the primary's ones and take over its scope. Those
+    that already exist in that scope are deleted."""
+    value = SCOPED_VALUES[model]
+    table = model._meta.db_table
+    params = [content_type.pk]
+
+    # values that already exist in the target scope
+    mapping.execute(
+        """
+        DELETE FROM {table} AS a USING m, {table} AS p
+        WHERE a.content_type_id = %s AND a.object_id = m.alias_id
+          AND p.{value} = a.{value} AND p.scope = m.scope AND p.id <> a.id
+        """.format(
+            table=table, value=value
+        ),
+        params,
+    )
+
+    # values that several aliases would move into the same scope
+    mapping.execute(
+        """
+        DELETE FROM {table} AS a USING m, m AS mb, {table} AS b
+        WHERE a.content_type_id = %s AND a.object_id = m.alias_id
+          AND b.content_type_id = a.content_type_id AND b.object_id = mb.alias_id
+          AND mb.scope = m.scope AND b.{value} = a.{value} AND b.id < a.id
+        """.format(
+            table=table, value=value
+        ),
+        params,
+    )
+
+    return mapping.execute(
+        """
+        , moved AS (
+            SELECT a.id, m.primary_id, m.scope,
+                   ROW_NUMBER() OVER (PARTITION BY m.primary_id ORDER BY a."order")
+                   + COALESCE(
+                       (SELECT MAX(p."order") FROM {table} AS p
+                        WHERE p.content_type_id = a.content_type_id
+                          AND p.object_id = m.primary_id),
+                       -1) AS new_order
+            FROM {table} AS a
+            JOIN m ON a.object_id = m.alias_id
+            WHERE a.content_type_id = %s
         )
+        UPDATE {table}
+        SET object_id = moved.primary_id, scope = moved.scope,
+            "order" = moved.new_order
+        FROM moved
+        WHERE {table}.id = moved.id
+        """.format(
+            table=table
+        ),
+        params,
+    )
 
 
-def merge(moved_obj, new_target):
-    if isinstance(moved_obj, URL):
-        # if we have two conflicting URLs, don't save the second one
-        # URLs don't have any interesting properties (except the URL) that
-        # we could merge
-        pass
+def _move_scope(model, value, mapping):
+    """ Moves URLs or Slugs from the scope of the aliases to the primaries' """
+    table = model._meta.db_table
+    alias_scope = "REPLACE(m.alias_id::text, '-', '')"
+    primary_scope = "REPLACE(m.primary_id::text, '-', '')"
+
+    mapping.execute(
+        """
+        DELETE FROM {table} AS a USING m, {table} AS p
+        WHERE a.scope = {alias_scope} AND p.scope = {primary_scope}
+          AND p.{value} = a.{value}
+        """.format(
+            table=table,
+            value=value,
+            alias_scope=alias_scope,
+            primary_scope=primary_scope,
+        )
+    )
 
-    else:
-        raise TypeError("unknown type for merging: {objtype}".format(objtype=type(old)))
+    mapping.execute(
+        "UPDATE {table} SET scope = {primary_scope} FROM m "
+        "WHERE {table}.scope = {alias_scope}".format(
+            table=table, alias_scope=alias_scope, primary_scope=primary_scope
+        )
+    )
+
+
+def _get_all_related_objects(model):
+    # hidden relations include those of many-to-many intermediary tables
+    return [
+        f
+        for f in model._meta.get_fields(include_hidden=True)
+        if (f.one_to_many or f.one_to_one) and f.auto_created and not f.concrete
+    ]
+
+
+def _get_generic_fields():
+    # Get a list of all GenericForeignKeys in all models
+    # TODO: this is a bit of a hack, since the generics framework should
+    # provide a similar method to the ForeignKey field for accessing the
+    # generic related fields.
+    generic_fields = []
+    for model in apps.get_models():
+        fields = filter(
+            lambda x: isinstance(x[1], GenericForeignKey), model.__dict__.items()
+        )
+        for field_name, field in fields:
+            generic_fields.append(field)
+    return generic_fields
@@ -8,7 +8,12 @@ from django.test.utils import override_settings
 from django.contrib.auth import get_user_model
 
 from mygpo.podcasts.models import Podcast, Episode
-from mygpo.history.models import EpisodeHistoryEntry
+from mygpo.history.models import (
+    EpisodeHistoryEntry,
+    EpisodePlayCount,
+    PodcastPlayCount,
+)
+from mygpo.episodestates.models import EpisodeState
 from mygpo.maintenance.merge import PodcastMerger
 
 
@@ -105,6 +110,92 @@ class MergeTests(TransactionTestCase):
         self.user.delete()
 
 
+class ConflictMergeTests(TestCase):
+    """ Tests merging of rows that would violate unique constraints """
+
+    def setUp(self):
+        self.podcast1 = Podcast.objects.get_or_create_for_url(
+            "http://example.com/conflict-merge-feed.rss",
+            defaults={"title": "Podcast 1"},
+        ).object
+        self.podcast2 = Podcast.objects.get_or_create_for_url(
+            "http://conflict-merge.org/podcast/", defaults={"title": "Podcast 2"}
+        ).object
+
+        self.episode1 = Episode.objects.get_or_create_for_url(
+            self.podcast1,
+            "http://example.com/conflict-merge-episode1.mp3",
+            defaults={"title": "Episode 1 A"},
+        ).object
+        self.episode2 = Episode.objects.get_or_create_for_url(
+            self.podcast2,
+            "http://example.com/conflict-merge-episode1.mp3",
+            defaults={"title": "Episode 1 B"},
+        ).object
+
+        User = get_user_model()
+        self.user = User(username="test-conflict-merge")
+        self.user.email = "test-conflict-merge-tests@example.com"
+        self.user.set_password("secret!")
+        self.user.save()
+
+    def test_merge_conflicts(self):
+        day = datetime(2020, 1, 1).date()
+        PodcastPlayCount.objects.create(podcast=self.podcast1, date=day, count=2)
+        PodcastPlayCount.objects.create(podcast=self.podcast2, date=day, count=3)
+        EpisodePlayCount.objects.create(episode=self.episode1, date=day, count=1)
+        EpisodePlayCount.objects.create(episode=self.episode2, date=day, count=4)
+        EpisodeState.objects.create(
+            user=self.user,
+            episode=self.episode1,
+            action=EpisodeHistoryEntry.DOWNLOAD,
+            timestamp=datetime(2020, 1, 1),
+        )
+        EpisodeState.objects.create(
+            user=self.user,
+            episode=self.episode2,
+            action=EpisodeHistoryEntry.PLAY,
+            timestamp=datetime(2020, 1, 2),
+        )
+
+        groups = [(0, [self.episode1.id, self.episode2.id])]
+        counter = Counter()
+        pm = PodcastMerger([self.podcast1, self.podcast2], counter, groups)
+        pm.merge()
+
+        self.assertFalse(Podcast.objects.filter(pk=self.podcast2.pk).exists())
+        self.assertFalse(Episode.objects.filter(pk=self.episode2.pk).exists())
+
+        # play counts of the same day are summed up
+        count = PodcastPlayCount.objects.get(podcast=self.podcast1, date=day)
+        self.assertEqual(count.count, 5)
+        count = EpisodePlayCount.objects.get(episode=self.episode1, date=day)
+        self.assertEqual(count.count, 5)
+
+        # the latest state wins
+        state = EpisodeState.objects.get(user=self.user, episode=self.episode1)
+        self.assertEqual(state.action, EpisodeHistoryEntry.PLAY)
+
+        # URLs are appended; the merged episode keeps a single URL
+        podcast = Podcast.objects.get(pk=self.podcast1.pk)
+        self.assertEqual(
+            [url.url for url in podcast.urls.all()],
+            [
+                "http://example.com/conflict-merge-feed.rss",
+                "http://conflict-merge.org/podcast/",
+            ],
+        )
+        episode = Episode.objects.get(pk=self.episode1.pk)
+        self.assertEqual(episode.urls.count(), 1)
+
+        # the merged objects can still be found by their IDs
+        self.assertEqual(Podcast.objects.all().get_by_any_id(self.podcast2.id), podcast)
+        self.assertEqual(Episode.objects.all().get_by_any_id(self.episode2.id), episode)
+
+        self.assertEqual(counter["podcasts merged"], 1)
+        self.assertEqual(counter["episodes merged"], 1)
+
+
 class MergeGroupTests(TransactionTestCase):
     """ Tests merging of two podcasts, one of which is part of a group """
 
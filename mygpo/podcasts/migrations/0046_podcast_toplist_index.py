@@ -0,0 +1,21 @@
+# Generated by Django 3.0.14 on 2026-10-18 02:19
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('podcasts', '0045_auto_20191230_2330'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='podcast',
+            index_together={
+                ('subscribers',),
+                ('language', 'subscribers'),
+                ('last_update',),
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.14 on 2026-10-18 03:02
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('podcasts', '0046_podcast_toplist_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='podcast',
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=['search_vector'], name='podcasts_search_vector_gin'
+            ),
+        ),
+        # index for case-insensitive prefix matches on the title, as used by
+        # autocomplete
+        migrations.RunSQL(
+            sql=(
+                'CREATE INDEX podcasts_title_upper_prefix ON podcasts_podcast '
+                '(UPPER(title) text_pattern_ops);'
+            ),
+            reverse_sql='DROP INDEX IF EXISTS podcasts_title_upper_prefix;',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.14 on 2026-10-18 02:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('podcasts', '0047_podcast_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='episode',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='podcast',
+            name='feed_hash',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
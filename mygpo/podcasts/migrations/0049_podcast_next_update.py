@@ -0,0 +1,29 @@
+# Generated by Django 3.0.14 on 2026-10-18 02:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('podcasts', '0048_content_hashes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='podcast',
+            name='next_update',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunSQL(
+            sql="""
+            UPDATE podcasts_podcast
+            SET next_update = COALESCE(
+                last_update + (update_interval * update_interval_factor
+                               || ' hours')::INTERVAL,
+                created
+            );
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -1,16 +1,19 @@
 import collections
 import uuid
 import re
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 from django.core.cache import cache
 from django.conf import settings
-from django.db import models, transaction, IntegrityError, DataError
-from django.db.models import F
+from django.db import models, transaction, connection, IntegrityError, DataError
+from django.db.models import F, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
 from django.utils.translation import gettext as _
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericRelation, GenericForeignKey
 from django.contrib.postgres.search import SearchVectorField
+from django.contrib.postgres.indexes import GinIndex
 
 from mygpo import utils
 from mygpo.core.models import (
@@ -39,6 +42,13 @@ MIN_UPDATE_INTERVAL = 5
 # every podcast should be updated at least once a month
 MAX_UPDATE_INTERVAL = 24 * 30
 
+# factor by which polling is backed off for podcasts that are updated when
+# their hub sends a notification
+PUSH_UPDATE_INTERVAL_FACTOR = 4
+
+# fields of a podcast from which its next_update is calculated
+SCHEDULE_FIELDS = ("last_update", "update_interval", "update_interval_factor")
+
 
 class TitleModel(models.Model):
     """ Model that has a title """
@@ -332,25 +342,10 @@ class PodcastQuerySet(MergedUUIDQuerySet):
 
     def order_by_next_update(self):
         """ Sort podcasts by next scheduled update """
-        NEXTUPDATE = (
-            "last_update + (update_interval * "
-            "update_interval_factor || ' hours')::INTERVAL"
-        )
-        q = self.extra(select={"_next_update": NEXTUPDATE})
-        return q.order_by("_next_update")
-
-    @property
-    def next_update(self):
-        interval = timedelta(hours=self.update_interval) * self.update_interval_factor
-        return self.last_update + interval
+        return self.order_by("next_update")
 
     def next_update_between(self, start, end):
-        NEXTUPDATE_BETWEEN = (
-            "(last_update + (update_interval * "
-            " update_interval_factor || "
-            "' hours')::INTERVAL) BETWEEN %s AND %s"
-        )
-        return self.extra(where=[NEXTUPDATE_BETWEEN], params=[start, end])
+        return self.filter(next_update__range=(start, end))
 
     def toplist(self, language=None):
         toplist = self
@@ -378,6 +373,34 @@ class PodcastManager(GenericManager):
             cache.set("pocdast_ad", podcast)
             return podcast
 
+    def claim_next_updates(self, num, lease):
+        """Returns the IDs of the ``num`` podcasts that are next to be updated
+
+        Their next_update is moved ``lease`` into the future, so that they
+        are not claimed again while their update is running. The update
+        then sets the actual time of the next update."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                WITH claimed AS (
+                    SELECT id FROM {table}
+                    WHERE next_update IS NOT NULL
+                    ORDER BY next_update
+                    LIMIT %(num)s
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE {table} AS p
+                SET next_update = %(until)s
+                FROM claimed
+                WHERE p.id = claimed.id
+                RETURNING p.id
+                """.format(
+                    table=self.model._meta.db_table
+                ),
+                {"num": num, "until": datetime.utcnow() + lease},
+            )
+            return [row[0] for row in cursor.fetchall()]
+
     @transaction.atomic
     def get_or_create_for_url(self, url, defaults={}):
 
@@ -410,6 +433,77 @@ class PodcastManager(GenericManager):
                 podcast = Podcast.objects.get(urls__url=url, urls__scope="")
                 return GetCreateResult(podcast, False)
 
+    def get_or_create_for_urls(self, urls):
+        """Get or create Podcasts for multiple URLs
+
+        Returns a dict that maps each of the given URLs to a GetCreateResult.
+        Unlike :meth:`get_or_create_for_url`, the number of queries does not
+        depend on the number of URLs."""
+
+        import uuid
+
+        urls = [url for url in urls if url]
+        maxlength_urls = {url: utils.to_maxlength(URL, "url", url) for url in urls}
+
+        existing_urls = {
+            u.url: u
+            for u in URL.objects.filter(url__in=set(maxlength_urls.values()), scope="")
+        }
+
+        podcasts = self.filter(
+            id__in=[u.object_id for u in existing_urls.values()]
+        ).in_bulk()
+
+        results = {}
+        for u in existing_urls.values():
+            if u.object_id in podcasts:
+                results[u.url] = GetCreateResult(podcasts[u.object_id], False)
+
+        # URLs that don't exist yet, and URLs that don't point to a podcast
+        missing = [
+            u for u in dict.fromkeys(maxlength_urls.values()) if u not in results
+        ]
+        dangling = [existing_urls[u] for u in missing if u in existing_urls]
+
+        if missing:
+            try:
+                with transaction.atomic():
+                    # bulk_create() doesn't call save(), so the stubs are
+                    # scheduled for an update explicitly
+                    now = datetime.utcnow()
+                    new_podcasts = {
+                        url: Podcast(id=uuid.uuid1(), next_update=now)
+                        for url in missing
+                    }
+                    Podcast.objects.bulk_create(new_podcasts.values())
+
+                    URL.objects.bulk_create(
+                        URL(
+                            url=url,
+                            order=0,
+                            scope="",
+                            content_object=new_podcasts[url],
+                        )
+                        for url in missing
+                        if url not in existing_urls
+                    )
+
+                    for url in dangling:
+                        url.content_object = new_podcasts[url.url]
+                    URL.objects.bulk_update(dangling, ["content_type", "object_id"])
+
+                for url, podcast in new_podcasts.items():
+                    results[url] = GetCreateResult(podcast, True)
+
+            # some URLs have been created since the first query, so we fall
+            # back to processing the missing ones individually
+            except IntegrityError:
+                logger.info("Conflict while creating podcasts in bulk")
+                for url in missing:
+                    results[url] = self.get_or_create_for_url(url)
+
+        return {url: results[maxlength_urls[url]] for url in urls}
+
 
 class URL(OrderedModel, ScopedModel):
     """Podcasts and Episodes can have multiple URLs
@@ -584,10 +678,26 @@ class Podcast(
     # search vector for full-text search
     search_vector = SearchVectorField(null=True)
 
+    # time at which the podcast should be updated next; see calc_next_update()
+    next_update = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    # hash of the parsed feed of the last update, used to skip unchanged feeds
+    feed_hash = models.CharField(max_length=32, null=True, blank=True)
+
     objects = PodcastManager()
 
     class Meta:
-        index_together = [("last_update",)]
+        index_together = [
+            ("last_update",),
+            # indexes for toplist queries
+            ("subscribers",),
+            ("language", "subscribers"),
+        ]
+
+        indexes = [
+            # index for full-text search
+            GinIndex(fields=["search_vector"], name="podcasts_search_vector_gin")
+        ]
 
     def subscriber_count(self):
         # TODO: implement
@@ -700,14 +810,67 @@ class Podcast(
             "Unknown Podcast from {domain}".format(domain=utils.get_domain(self.url))
         )
 
-    @property
-    def next_update(self):
+    def calc_next_update(self):
+        """Calculates the time of the next update from the last one
+
+        Stubs that have never been updated are due immediately."""
         if not self.last_update:
-            return None
+            return self.created or datetime.utcnow()
 
         interval = timedelta(hours=self.update_interval) * self.update_interval_factor
+
+        if self.has_push_updates():
+            interval *= PUSH_UPDATE_INTERVAL_FACTOR
+
         return self.last_update + interval
 
+    def has_push_updates(self):
+        """ Returns True if the podcast's hub notifies us about updates """
+        if not self.hub or self._state.adding:
+            return False
+
+        return self.hubsubscription_set.filter(mode="subscribe", verified=True).exists()
+
+    def reschedule(self):
+        """ Recalculates next_update, eg when push updates become available """
+        self.next_update = self.calc_next_update()
+        self.save(update_fields=["next_update"])
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        podcast = super().from_db(db, field_names, values)
+        podcast._saved_schedule = podcast._get_schedule()
+        return podcast
+
+    def _get_schedule(self):
+        # deferred fields are not loaded
+        return {field: self.__dict__.get(field) for field in SCHEDULE_FIELDS}
+
+    def _schedule_changed(self, update_fields):
+        saved = getattr(self, "_saved_schedule", None)
+        if saved is None or self.next_update is None:
+            return True
+
+        fields = SCHEDULE_FIELDS
+        if update_fields is not None:
+            fields = [field for field in fields if field in update_fields]
+
+        return any(self.__dict__.get(field) != saved[field] for field in fields)
+
+    def save(self, *args, **kwargs):
+        # next_update is kept in sync with the fields it is calculated from.
+        # It is only recalculated when they are changed, so that saving a
+        # podcast during its update keeps the lease of claim_next_updates()
+        update_fields = kwargs.get("update_fields")
+        if self._schedule_changed(update_fields):
+            self.next_update = self.calc_next_update()
+
+            if update_fields is not None:
+                kwargs["update_fields"] = set(update_fields) | {"next_update"}
+
+        super().save(*args, **kwargs)
+        self._saved_schedule = self._get_schedule()
+
 
 class EpisodeQuerySet(MergedUUIDQuerySet):
     """ QuerySet for Episodes """
@@ -717,7 +880,24 @@ class EpisodeQuerySet(MergedUUIDQuerySet):
         if language:
             toplist = toplist.filter(language=language)
 
-        return toplist.order_by("-listeners")
+        # episodes without (calculated) listeners are not part of the toplist
+        return toplist.filter(listeners__gt=0).order_by("-listeners")
+
+    def latest_per_podcast(self, num):
+        """ Restricts the episodes to the latest num of each podcast """
+        ranked = self.order_by().annotate(
+            rank=Window(
+                expression=RowNumber(),
+                partition_by=[F("podcast")],
+                order_by=[F("order").desc(), F("released").desc()],
+            )
+        )
+        sql, params = ranked.values("id", "rank").query.sql_with_params()
+        latest = RawSQL(
+            "SELECT id FROM ({sql}) AS ranked WHERE rank <= %s".format(sql=sql),
+            params + (num,),
+        )
+        return self.filter(id__in=latest)
 
 
 class EpisodeManager(GenericManager):
@@ -729,7 +909,8 @@ class EpisodeManager(GenericManager):
     def get_or_create_for_url(self, podcast, url, defaults={}):
         """Create an Episode for a given URL
 
-        This is the only place where new episodes are created"""
+        This and :meth:`get_or_create_for_urls` are the only places where new
+        episodes are created"""
 
         if not url:
             raise ValueError("The URL must not be empty")
@@ -785,6 +966,118 @@ class EpisodeManager(GenericManager):
                 )
                 return GetCreateResult(episode, False)
 
+    def get_or_create_for_urls(self, podcast, urls):
+        """Get or create Episodes for multiple URLs of the same podcast
+
+        Returns a dict that maps each of the given URLs to a GetCreateResult.
+        Unlike :meth:`get_or_create_for_url`, the number of queries does not
+        depend on the number of URLs."""
+        results = self.get_or_create_for_podcast_urls(
+            (podcast, url) for url in urls if url
+        )
+        return {url: result for (_podcast, url), result in results.items()}
+
+    def get_or_create_for_podcast_urls(self, podcast_urls):
+        """Get or create Episodes for (podcast, URL) pairs
+
+        The podcasts of the pairs can differ. Returns a dict that maps each of
+        the given pairs to a GetCreateResult. See
+        :meth:`get_or_create_for_urls`"""
+
+        import uuid
+
+        podcast_urls = [(podcast, url) for podcast, url in podcast_urls if url]
+        podcasts = {podcast.as_scope: podcast for podcast, _url in podcast_urls}
+
+        # maps the given pairs to (scope, URL) keys
+        keys = {
+            (podcast, url): (podcast.as_scope, utils.to_maxlength(URL, "url", url))
+            for podcast, url in podcast_urls
+        }
+
+        # the query can return URLs of other scopes, which are ignored below
+        existing_urls = {
+            (u.scope, u.url): u
+            for u in URL.objects.filter(
+                scope__in=podcasts.keys(), url__in={url for _s, url in keys.values()}
+            )
+        }
+        existing_urls = {
+            key: url for key, url in existing_urls.items() if key in keys.values()
+        }
+
+        episodes = self.filter(
+            id__in=[u.object_id for u in existing_urls.values()]
+        ).in_bulk()
+
+        results = {}
+        for key, u in existing_urls.items():
+            if u.object_id in episodes:
+                episode = episodes[u.object_id]
+                # avoid fetching the podcast for every episode
+                episode.podcast = podcasts[u.scope]
+                results[key] = GetCreateResult(episode, False)
+
+        # URLs that don't exist yet, and URLs that don't point to an episode
+        missing = [key for key in dict.fromkeys(keys.values()) if key not in results]
+        dangling = [existing_urls[key] for key in missing if key in existing_urls]
+
+        if missing:
+            try:
+                with transaction.atomic():
+                    new_episodes = {
+                        key: Episode(podcast=podcasts[key[0]], id=uuid.uuid1())
+                        for key in missing
+                    }
+                    Episode.objects.bulk_create(new_episodes.values())
+
+                    URL.objects.bulk_create(
+                        URL(
+                            url=key[1],
+                            order=0,
+                            scope=key[0],
+                            content_object=new_episodes[key],
+                        )
+                        for key in missing
+                        if key not in existing_urls
+                    )
+
+                    for url in dangling:
+                        url.content_object = new_episodes[(url.scope, url.url)]
+                    URL.objects.bulk_update(dangling, ["content_type", "object_id"])
+
+                    # see get_or_create_for_url
+                    num_created = collections.Counter(scope for scope, _url in missing)
+                    num_created.subtract(url.scope for url in dangling)
+                    self._increment_episode_counts(podcasts, num_created)
+
+                for key, episode in new_episodes.items():
+                    results[key] = GetCreateResult(episode, True)
+
+            # some URLs have been created since the first query, so we fall
+            # back to processing the missing ones individually
+            except IntegrityError:
+                logger.info("Conflict while creating episodes in bulk")
+                for scope, url in missing:
+                    results[(scope, url)] = self.get_or_create_for_url(
+                        podcasts[scope], url
+                    )
+
+        return {pair: results[key] for pair, key in keys.items()}
+
+    @staticmethod
+    def _increment_episode_counts(podcasts, num_created):
+        """ Increments the episode_count of podcasts with one query per count """
+        scopes_by_count = collections.defaultdict(list)
+        for scope, count in num_created.items():
+            if count > 0:
+                scopes_by_count[count].append(scope)
+
+        for count, scopes in scopes_by_count.items():
+            Podcast.objects.filter(
+                pk__in=[podcasts[scope].pk for scope in scopes]
+            ).update(episode_count=F("episode_count") + count)
+
 
 class Episode(
     UUIDModel,
@@ -816,6 +1109,9 @@ class Episode(
     podcast = models.ForeignKey(Podcast, on_delete=models.PROTECT)
     listeners = models.PositiveIntegerField(null=True, db_index=True)
 
+    # hash of the parsed episode of the last update
+    content_hash = models.CharField(max_length=32, null=True, blank=True)
+
     objects = EpisodeManager()
 
     class Meta:
@@ -28,6 +28,35 @@ class PodcastTests(unittest.TestCase):
         # assert that the next_update property is calculated correctly
         self.assertEqual(p.next_update, last_update + timedelta(hours=update_interval))
 
+    def test_claim_next_updates(self):
+        """ Podcasts are claimed for updates in the order of next_update """
+        now = datetime.utcnow()
+        p1 = create_podcast(last_update=datetime(1900, 1, 1))
+        p2 = create_podcast(last_update=datetime(1900, 1, 2))
+        self.assertEqual(p1.next_update, p1.calc_next_update())
+
+        lease = timedelta(hours=1)
+        self.assertEqual(Podcast.objects.claim_next_updates(1, lease), [p1.pk])
+
+        # p1 has been leased, and is not claimed again
+        self.assertEqual(Podcast.objects.claim_next_updates(1, lease), [p2.pk])
+
+        p1.refresh_from_db()
+        self.assertGreater(p1.next_update, now)
+
+        # saving the podcast during its update keeps the lease
+        leased = p1.next_update
+        p1.episode_count = 5
+        p1.save()
+        p1.refresh_from_db()
+        self.assertEqual(p1.next_update, leased)
+
+        # saving the podcast after its update sets its next_update again
+        p1.last_update = now
+        p1.save(update_fields=["last_update"])
+        p1.refresh_from_db()
+        self.assertEqual(p1.next_update, p1.calc_next_update())
+
     def test_get_or_create_for_url(self):
         """ Test that get_or_create_for_url returns existing Podcast """
         URL = "http://example.com/get_or_create.rss"
@@ -58,6 +87,31 @@ class PodcastTests(unittest.TestCase):
         real_count = Episode.objects.filter(podcast=p).count()
         self.assertEqual(real_count, NUM_EPISODES)
 
+    def test_get_or_create_for_urls(self):
+        """ Test creating episodes in bulk """
+        PODCAST_URL = "http://example.com/bulk-podcast.rss"
+        EPISODE_URL = "http://example.com/bulk-episode%d.mp3"
+
+        p = Podcast.objects.get_or_create_for_url(PODCAST_URL).object
+        existing = Episode.objects.get_or_create_for_url(p, EPISODE_URL % (0,))
+
+        urls = [EPISODE_URL % (n,) for n in range(4)]
+        results = Episode.objects.get_or_create_for_urls(p, urls)
+
+        self.assertEqual(set(results), set(urls))
+        self.assertEqual(results[urls[0]], (existing.object, False))
+        self.assertTrue(all(results[url].created for url in urls[1:]))
+
+        p = Podcast.objects.get(pk=p.pk)
+        self.assertEqual(p.episode_count, 4)
+
+        # all episodes exist now
+        results2 = Episode.objects.get_or_create_for_urls(p, urls)
+        self.assertFalse(any(r.created for r in results2.values()))
+        for url in urls:
+            self.assertEqual(results[url].object.pk, results2[url].object.pk)
+            self.assertEqual(results2[url].object.url, url)
+
 
 class PodcastGroupTests(unittest.TestCase):
     """ Test grouping of podcasts """
@@ -3,8 +3,7 @@ from datetime import timedelta, datetime, time
 
 from mygpo.podcasts.models import Episode
 from mygpo.utils import daterange
-from mygpo.history.models import EpisodeHistoryEntry
-from mygpo.history.stats import playcounts_timerange
+from mygpo.history.stats import podcast_playcounts, episode_playcounts
 from mygpo.publisher.models import PublishedPodcast
 
 
@@ -21,11 +20,8 @@ def listener_data(podcasts, start_date=datetime(2010, 1, 1), leap=timedelta(days
     episodes = Episode.objects.filter(podcast__in=podcasts, released__gt=start_date)
     episodes = {e.released.date(): e for e in episodes}
 
-    history = EpisodeHistoryEntry.objects.filter(
-        episode__podcast__in=podcasts, timestamp__gte=start_date
-    )
     # contains play-counts, indexed by date {date: play-count}
-    play_counts = playcounts_timerange(history)
+    play_counts = podcast_playcounts(podcasts, start_date.date())
 
     # we start either at the first episode-release or the first listen-event
     events = list(episodes.keys()) + list(play_counts.keys())
@@ -48,11 +44,8 @@ def episode_listener_data(
 
     An iterator with data for each day (starting from the first event
     is returned, where each day is represented by a ListenerData tuple"""
-    history = EpisodeHistoryEntry.objects.filter(
-        episode=episode, timestamp__gte=start_date
-    )
     # contains play-counts, indexed by date {date: play-count}
-    play_counts = playcounts_timerange(history)
+    play_counts = episode_playcounts(episode, start_date.date())
 
     # we start either at the episode-release or the first listen-event
     events = (
@@ -69,6 +69,9 @@ class SubscribeView(View):
         subscription.verified = True
         subscription.save()
 
+        # podcasts with verified subscriptions are polled less often
+        subscription.podcast.reschedule()
+
         logger.info("subscription confirmed")
         return HttpResponse(challenge)
 
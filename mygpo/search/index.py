@@ -3,12 +3,16 @@
 Uses django.contrib.postgres.search for searching. See docs at
 https://docs.djangoproject.com/en/1.11/ref/contrib/postgres/search/
 
+Ranked search results are cached as lists of podcast IDs. The cache is
+invalidated whenever the search index is updated.
 """
 
-from django.conf import settings
+import hashlib
+import uuid
 
 from mygpo.podcasts.models import Podcast
 
+from django.core.cache import cache
 from django.db.models import F, FloatField, ExpressionWrapper
 from django.contrib.postgres.search import SearchQuery, SearchRank
 from django.conf import settings
@@ -20,34 +24,128 @@ logger = logging.getLogger(__name__)
 
 SEARCH_CUTOFF = settings.SEARCH_CUTOFF
 
+# Maximum number of results for a search query
+MAX_RESULTS = 100
+
+# Maximum number of autocomplete suggestions
+MAX_SUGGESTIONS = 10
+
+# cache key of the current version of the search index
+VERSION_KEY = "search-index-version"
+
 
 def search_podcasts(query):
     """ Search for podcasts according to 'query' """
     if is_query_too_short(query):
-        logger.debug('Found no podcasts for "{query}". Query is too short', query=query)
-        return Podcast.objects.none()
+        logger.debug(
+            'Found no podcasts for "{query}". Query is too short'.format(query=query)
+        )
+        return SearchResults([])
+
+    query = normalize_query(query)
+    pks = _cached(
+        "search",
+        query,
+        lambda: search_podcast_ids(query),
+        settings.SEARCH_CACHE_TIMEOUT,
+    )
+
+    logger.debug(
+        'Found {count} podcasts for "{query}"'.format(count=len(pks), query=query)
+    )
 
-    logger.debug('Searching for "{query}" podcasts"', query=query)
+    return SearchResults(pks)
+
+
+def search_podcast_ids(query):
+    """ Returns the IDs of the podcasts matching 'query', ordered by rank """
+
+    logger.debug('Searching for "{query}" podcasts"'.format(query=query))
 
     query = SearchQuery(query)
 
     results = (
-        Podcast.objects.annotate(rank=SearchRank(F("search_vector"), query))
+        Podcast.objects.filter(search_vector=query)
+        .annotate(rank=SearchRank(F("search_vector"), query))
         .annotate(
             order=ExpressionWrapper(
                 F("rank") * F("subscribers"), output_field=FloatField()
             )
         )
         .filter(rank__gte=SEARCH_CUTOFF)
-        .order_by("-order")[:100]
+        .order_by("-order")
+        .values_list("pk", flat=True)[:MAX_RESULTS]
     )
 
-    logger.debug(
-        'Found {count} podcasts for "{query}"', count=len(results), query=query
-    )
+    return list(results)
+
+
+def autocomplete_podcasts(query, num=MAX_SUGGESTIONS):
+    """ Returns the most popular podcasts whose title starts with 'query' """
+    if is_query_too_short(query):
+        return []
+
+    query = normalize_query(query)
 
-    return results
+    def _suggest():
+        # uses the prefix index on the title
+        podcasts = Podcast.objects.filter(title__istartswith=query)
+        podcasts = podcasts.order_by("-subscribers")
+        return list(podcasts.values_list("pk", flat=True)[:MAX_SUGGESTIONS])
+
+    pks = _cached("autocomplete", query, _suggest, settings.SEARCH_CACHE_TIMEOUT)
+    return SearchResults(pks[:num])
+
+
+def invalidate_search_cache():
+    """ Discards all cached search results """
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def normalize_query(query):
+    """ Normalizes case and whitespace of a query """
+    return " ".join(query.lower().split())
 
 
 def is_query_too_short(query):
     return len(query.replace(" ", "")) <= settings.QUERY_LENGTH_CUTOFF
+
+
+def _cached(prefix, query, func, timeout):
+    """Returns the cached result of func() for the query
+
+    func() has to compute its result from the normalized query, as all
+    queries that normalize to the same one share their cache entry."""
+    version = cache.get_or_set(VERSION_KEY, lambda: uuid.uuid4().hex, None)
+    query = normalize_query(query).encode("utf-8")
+    key = "{prefix}-{version}-{query}".format(
+        prefix=prefix, version=version, query=hashlib.sha1(query).hexdigest()
+    )
+    return cache.get_or_set(key, func, timeout)
+
+
+class SearchResults(object):
+    """ Podcasts for a ranked list of IDs; podcasts are fetched when sliced """
+
+    def __init__(self, pks):
+        self.pks = pks
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __bool__(self):
+        return bool(self.pks)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            pks = self.pks[index]
+            podcasts = Podcast.objects.filter(pk__in=pks).prefetch_related(
+                "slugs", "urls"
+            )
+            podcasts = {podcast.pk: podcast for podcast in podcasts}
+            return [podcasts[pk] for pk in pks if pk in podcasts]
+
+        return Podcast.objects.get(pk=self.pks[index])
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from mygpo.search.tasks import index_outdated_podcasts, BATCH_SIZE
+
+
+class Command(BaseCommand):
+    """Indexes all podcasts with outdated search index
+
+    Multiple instances of this command can run in parallel."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            dest="batch_size",
+            default=BATCH_SIZE,
+            help="Number of podcasts to index at once",
+        )
+
+        parser.add_argument(
+            "--silent",
+            action="store_true",
+            dest="silent",
+            default=False,
+            help="Don't show any output",
+        ),
+
+    def handle(self, *args, **options):
+
+        num = 0
+        for count in index_outdated_podcasts(options.get("batch_size")):
+            num += count
+
+            if not options.get("silent"):
+                self.stdout.write("Indexed {num} podcasts".format(num=num))
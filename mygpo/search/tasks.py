@@ -1,6 +1,6 @@
 import functools
 import operator
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 from celery.decorators import periodic_task
 from django_db_geventpool.utils import close_connection
@@ -11,45 +11,72 @@ from django.contrib.postgres.search import SearchVector
 from mygpo.podcasts.models import Podcast
 
 from . import INDEX_FIELDS
+from .index import invalidate_search_cache
 
 from celery.utils.log import get_task_logger
 
 logger = get_task_logger(__name__)
 
 
-# interval in which podcast updates are scheduled
-UPDATE_INTERVAL = timedelta(hours=1)
+# interval in which the search index is updated
+UPDATE_INTERVAL = timedelta(minutes=10)
 
-# Maximum number of podcasts to update in one job run
-MAX_INDEX = 1000
+# Number of podcasts that are indexed in one statement
+BATCH_SIZE = 5000
 
 
 @periodic_task(run_every=UPDATE_INTERVAL)
 @close_connection
 def update_search_index(run_every=UPDATE_INTERVAL):
-    """ Schedules podcast updates that are due within ``interval`` """
+    """ Indexes podcasts with outdated search index for up to ``run_every`` """
 
     logger.info("Updating search index")
 
-    # We avoid an UPDATE, because it cannot be LIMITed, the thus might
-    # be to expensive in a single statement.
-    # We could use select_for_update(), but there is no need for consistency
-    # between multiple podcasts.
-    to_update = Podcast.objects.filter(search_index_uptodate=False).only("pk")[
-        :MAX_INDEX
-    ]
+    until = datetime.utcnow() + run_every
+    num = 0
+    for count in index_outdated_podcasts():
+        num += count
+        if datetime.utcnow() >= until:
+            break
 
-    count = to_update.count()
-    logger.info("Updating search index for {} podcasts".format(count))
+    logger.info("Finished indexing {} podcasts".format(num))
 
-    vectors = _get_search_vectors()
 
-    for podcast in to_update:
-        Podcast.objects.filter(pk=podcast.pk).update(
-            search_vector=vectors, search_index_uptodate=True
-        )
+def index_outdated_podcasts(batch_size=BATCH_SIZE):
+    """Indexes all podcasts with outdated search index in batches
+
+    Walks over the outdated podcasts in the order of their IDs and updates
+    ``batch_size`` podcasts per statement; yields the size of each batch.
+    Podcasts that are locked by a concurrent indexer are skipped, so that
+    multiple indexers can run in parallel."""
 
-    logger.info("Finished indexing podcasts")
+    vectors = _get_search_vectors()
+    outdated = Podcast.objects.filter(search_index_uptodate=False).order_by("pk")
+
+    last_pk = None
+    while True:
+        batch = outdated
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+
+        with transaction.atomic():
+            pks = list(
+                batch.select_for_update(skip_locked=True).values_list("pk", flat=True)[
+                    :batch_size
+                ]
+            )
+
+            if not pks:
+                return
+
+            Podcast.objects.filter(pk__in=pks).update(
+                search_vector=vectors, search_index_uptodate=True
+            )
+
+        invalidate_search_cache()
+        logger.info("Indexed {} podcasts".format(len(pks)))
+        last_pk = pks[-1]
+        yield len(pks)
 
 
 def _get_search_vectors():
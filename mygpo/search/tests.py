@@ -2,16 +2,20 @@ import uuid
 
 from mygpo.podcasts.models import Podcast
 from django.contrib.postgres.search import SearchVector
+from django.core.cache import cache
 from django.test import TransactionTestCase
 from django.test.utils import override_settings
 
-from .index import search_podcasts
-from .tasks import update_search_index
+from .index import search_podcasts, autocomplete_podcasts
+from .tasks import update_search_index, index_outdated_podcasts
 
 
 class SearchTests(TransactionTestCase):
     """ Tests podcast search """
 
+    def setUp(self):
+        cache.clear()
+
     def test_search_podcast(self):
         """ Search if a podcast is found in the search results """
 
@@ -54,3 +58,64 @@ class SearchTests(TransactionTestCase):
 
         results = search_podcasts("The Tricky")
         self.assertEqual(results[0].id, podcast.id)
+
+    def test_index_in_batches(self):
+        """ Outdated podcasts are indexed in batches """
+
+        podcasts = [
+            Podcast.objects.create(id=uuid.uuid1(), title="Batch Podcast %d" % n)
+            for n in range(5)
+        ]
+
+        counts = list(index_outdated_podcasts(batch_size=2))
+        self.assertEqual(counts, [2, 2, 1])
+
+        outdated = Podcast.objects.filter(search_index_uptodate=False)
+        self.assertFalse(outdated.exists())
+
+        results = search_podcasts("batch")
+        self.assertEqual({p.id for p in results}, {podcast.id for podcast in podcasts})
+
+    def test_cached_results(self):
+        """ Results are cached per normalized query until the next reindex """
+
+        podcast = Podcast.objects.create(id=uuid.uuid1(), title="Cached Podcast")
+        update_search_index()
+
+        results = search_podcasts("Cached  podcast")
+        self.assertEqual([p.id for p in results], [podcast.id])
+
+        other = Podcast.objects.create(
+            id=uuid.uuid1(), title="Another Cached Podcast", subscribers=10
+        )
+
+        # the new podcast is not yet indexed, and the results come from cache
+        with self.assertNumQueries(0):
+            self.assertEqual(len(search_podcasts("cached podcast")), 1)
+
+        # indexing the new podcast invalidates the cache
+        update_search_index()
+        results = search_podcasts("cached podcast")
+        self.assertEqual([p.id for p in results], [other.id, podcast.id])
+
+    def test_autocomplete(self):
+        """ Podcasts starting with the query are suggested by popularity """
+
+        Podcast.objects.create(id=uuid.uuid1(), title="The Linux Show")
+        p1 = Podcast.objects.create(
+            id=uuid.uuid1(), title="Linux Outlaws", subscribers=5
+        )
+        p2 = Podcast.objects.create(
+            id=uuid.uuid1(), title="Linux Action Show", subscribers=10
+        )
+
+        results = autocomplete_podcasts("linu")
+        self.assertEqual([p.id for p in results], [p2.id, p1.id])
+
+        self.assertEqual(len(autocomplete_podcasts("lin")), 0)
+
+        # queries that differ in case and whitespace get the same suggestions
+        results = autocomplete_podcasts(" Linux  act")
+        self.assertEqual([p.id for p in results], [p2.id])
+        results = autocomplete_podcasts("linux act")
+        self.assertEqual([p.id for p in results], [p2.id])
@@ -362,6 +362,17 @@ SUPPORT_URL = os.getenv("SUPPORT_URL", "")
 
 FEEDSERVICE_URL = os.getenv("FEEDSERVICE_URL", "http://feeds.gpodder.net/")
 
+# number of feeds that are fetched from the feed-service concurrently when
+# updating multiple podcasts
+FEED_UPDATE_WORKERS = int(os.getenv("FEED_UPDATE_WORKERS", 8))
+
+# maximum number of concurrently fetched feeds that are hosted on the same
+# domain
+FEED_UPDATE_MAX_PER_HOST = int(os.getenv("FEED_UPDATE_MAX_PER_HOST", 2))
+
+# number of podcasts for which an update is dispatched per minute
+FEED_UPDATE_RATE = int(os.getenv("FEED_UPDATE_RATE", 12))
+
 
 # time for how long an activation is valid; after that, an unactivated user
 # will be deleted
@@ -387,6 +398,14 @@ PODCAST_AD_ID = os.getenv("PODCAST_AD_ID")
 
 MAX_EPISODE_ACTIONS = int(os.getenv("MAX_EPISODE_ACTIONS", 1000))
 
+# Number of seconds for which verified API credentials are cached; 0 disables
+API_AUTH_CACHE_TIMEOUT = int(os.getenv("API_AUTH_CACHE_TIMEOUT", 60 * 5))
+
+# Backend for serializing JSON API responses
+JSON_SERIALIZER = os.getenv(
+    "JSON_SERIALIZER", "mygpo.api.serialization.StdlibSerializer"
+)
+
 SEARCH_CUTOFF = float(os.getenv("SEARCH_CUTOFF", 0.3))
 
 # Maximum non-whitespace length of search query
@@ -395,6 +414,9 @@ SEARCH_CUTOFF = float(os.getenv("SEARCH_CUTOFF", 0.3))
 # responses
 QUERY_LENGTH_CUTOFF = int(os.getenv("QUERY_LENGTH_CUTOFF", 3))
 
+# Number of seconds for which search results are cached
+SEARCH_CACHE_TIMEOUT = int(os.getenv("SEARCH_CACHE_TIMEOUT", 60 * 60))
+
 ### Sentry
 
 try:
@@ -0,0 +1,51 @@
+# Generated by Django 3.0.14 on 2026-10-18 02:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('podcasts', '0045_auto_20191230_2330'),
+        ('users', '0015_case_insensitive_username'),
+        ('subscriptions', '0004_subscription_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionChange',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('ref_url', models.URLField(max_length=2048)),
+                ('subscribed', models.BooleanField()),
+                ('created', models.DateTimeField()),
+                ('modified', models.DateTimeField()),
+                (
+                    'client',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to='users.Client'
+                    ),
+                ),
+                (
+                    'podcast',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to='podcasts.Podcast',
+                    ),
+                ),
+            ],
+            options={
+                'unique_together': {('client', 'podcast')},
+                'index_together': {('client', 'modified')},
+            },
+        ),
+    ]
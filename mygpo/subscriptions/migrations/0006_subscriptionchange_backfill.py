@@ -0,0 +1,40 @@
+from django.db import migrations
+
+
+# current subscriptions
+BACKFILL_SUBSCRIBED = """
+INSERT INTO subscriptions_subscriptionchange
+    (client_id, podcast_id, ref_url, subscribed, created, modified)
+SELECT client_id, podcast_id, ref_url, true, created, modified
+FROM subscriptions_subscription;
+"""
+
+# podcasts that have been unsubscribed, referenced by their main URL
+BACKFILL_UNSUBSCRIBED = """
+INSERT INTO subscriptions_subscriptionchange
+    (client_id, podcast_id, ref_url, subscribed, created, modified)
+SELECT h.client_id, h.podcast_id,
+    COALESCE((SELECT u.url FROM podcasts_url u
+              WHERE u.object_id = h.podcast_id AND u.scope = ''
+              ORDER BY u."order" LIMIT 1), ''),
+    false, MIN(h.timestamp), MAX(h.timestamp)
+FROM history_historyentry h
+WHERE h.client_id IS NOT NULL AND h.action IN ('subscribe', 'unsubscribe')
+GROUP BY h.client_id, h.podcast_id
+ON CONFLICT (client_id, podcast_id) DO NOTHING;
+"""
+
+
+class Migration(migrations.Migration):
+    """ Fill the subscription change log from the existing subscriptions """
+
+    dependencies = [
+        ('history', '0010_episode_history_index'),
+        ('subscriptions', '0005_subscriptionchange'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            [BACKFILL_SUBSCRIBED, BACKFILL_UNSUBSCRIBED], migrations.RunSQL.noop
+        )
+    ]
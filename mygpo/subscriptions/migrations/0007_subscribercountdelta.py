@@ -0,0 +1,38 @@
+# Generated by Django 3.0.14 on 2026-10-18 02:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('podcasts', '0045_auto_20191230_2330'),
+        ('subscriptions', '0006_subscriptionchange_backfill'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriberCountDelta',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('delta', models.SmallIntegerField()),
+                ('applied', models.BooleanField(db_index=True, default=False)),
+                (
+                    'podcast',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to='podcasts.Podcast',
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -1,12 +1,66 @@
 import collections
+from datetime import timedelta
 
-from django.db import models
+from django.db import models, connection
 from django.conf import settings
 
 from mygpo.core.models import UpdateInfoModel, DeleteableModel
 from mygpo.users.models import Client
 from mygpo.users.settings import PUBLIC_SUB_PODCAST
 from mygpo.podcasts.models import Podcast
+from mygpo.utils import to_maxlength
+
+
+class SubscriptionManager(models.Manager):
+    """ Manager for the Subscription model """
+
+    def create_missing(self, user, subscriptions, timestamp):
+        """Creates the (client, podcast, ref_url) subscriptions of the user
+
+        Subscriptions that already exist, also those created concurrently,
+        are skipped. Returns the (client, podcast, ref_url) tuples of the
+        subscriptions that have actually been created."""
+        by_key = {
+            (str(client.pk), str(podcast.pk)): (client, podcast, ref_url)
+            for client, podcast, ref_url in subscriptions
+        }
+        if not by_key:
+            return []
+
+        query = """
+            INSERT INTO {table}
+                (user_id, client_id, podcast_id, ref_url, created, modified,
+                 deleted)
+            SELECT %s, client_id, podcast_id, ref_url, %s, %s, false
+            FROM unnest(%s::uuid[], %s::uuid[], %s::text[])
+                AS subscriptions (client_id, podcast_id, ref_url)
+            ON CONFLICT (user_id, client_id, podcast_id) DO NOTHING
+            RETURNING client_id, podcast_id
+        """.format(
+            table=self.model._meta.db_table
+        )
+
+        values = list(by_key.values())
+        params = [
+            user.pk,
+            timestamp,
+            timestamp,
+            [str(client.pk) for client, _podcast, _ref_url in values],
+            [str(podcast.pk) for _client, podcast, _ref_url in values],
+            [
+                to_maxlength(Subscription, "ref_url", ref_url)
+                for _client, _podcast, ref_url in values
+            ],
+        ]
+
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            created = cursor.fetchall()
+
+        return [
+            by_key[(str(client_id), str(podcast_id))]
+            for client_id, podcast_id in created
+        ]
 
 
 class Subscription(DeleteableModel):
@@ -33,6 +87,8 @@ class Subscription(DeleteableModel):
     created = models.DateTimeField()
     modified = models.DateTimeField()
 
+    objects = SubscriptionManager()
+
     class Meta:
         unique_together = [["user", "client", "podcast"]]
 
@@ -44,6 +100,132 @@ class Subscription(DeleteableModel):
         )
 
 
+class SubscriptionChangeManager(models.Manager):
+    """ Manager for the SubscriptionChange model """
+
+    def log_change(self, client, podcast, ref_url, subscribed, timestamp):
+        """ Records that a podcast was (un)subscribed on a client """
+        self.log_changes([(client, podcast, ref_url)], subscribed, timestamp)
+
+    def log_changes(self, changes, subscribed, timestamp):
+        """Records many (client, podcast, ref_url) subscription changes
+
+        All changes are written with a single upsert"""
+        changes = list(changes)
+        if not changes:
+            return
+
+        query = """
+            INSERT INTO {table}
+                (client_id, podcast_id, ref_url, subscribed, created, modified)
+            SELECT client_id, podcast_id, ref_url, %s, %s, %s
+            FROM unnest(%s::uuid[], %s::uuid[], %s::text[])
+                AS changes (client_id, podcast_id, ref_url)
+            ON CONFLICT (client_id, podcast_id) DO UPDATE
+                SET ref_url = EXCLUDED.ref_url,
+                    subscribed = EXCLUDED.subscribed,
+                    modified = EXCLUDED.modified
+        """.format(
+            table=self.model._meta.db_table
+        )
+
+        params = [
+            subscribed,
+            timestamp,
+            timestamp,
+            [str(client.pk) for client, _podcast, _ref_url in changes],
+            [str(podcast.pk) for _client, podcast, _ref_url in changes],
+            [
+                to_maxlength(SubscriptionChange, "ref_url", ref_url)
+                for _client, _podcast, ref_url in changes
+            ],
+        ]
+
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+
+    def changes_since(self, client, since, until):
+        """Subscription changes of a client in the given time range
+
+        Returns a list of (ref_url, subscribed) pairs, read with a single
+        range scan over the (client, modified) index"""
+        changes = (
+            self.filter(client=client, modified__gt=since, modified__lte=until)
+            # podcasts that have been both subscribed and unsubscribed
+            # after ``since`` have never been known to the client; as clients
+            # receive timestamps in full seconds, those subscribed in the
+            # same second might have been
+            .exclude(
+                subscribed=False, created__gte=since + timedelta(seconds=1)
+            ).order_by("modified")
+        )
+        return list(changes.values_list("ref_url", "subscribed"))
+
+
+class SubscriptionChange(models.Model):
+    """The latest subscription change of a podcast on a client
+
+    Serves as a change log for synchronizing subscriptions with clients, so
+    that the full subscription history doesn't need to be replayed"""
+
+    client = models.ForeignKey(Client, on_delete=models.CASCADE)
+
+    podcast = models.ForeignKey(Podcast, on_delete=models.CASCADE)
+
+    # the URL that was used when (un)subscribing
+    ref_url = models.URLField(max_length=2048)
+
+    # if the podcast is subscribed after the change
+    subscribed = models.BooleanField()
+
+    # when the podcast was first subscribed on the client
+    created = models.DateTimeField()
+
+    # when the subscription was last changed
+    modified = models.DateTimeField()
+
+    objects = SubscriptionChangeManager()
+
+    class Meta:
+        unique_together = [["client", "podcast"]]
+
+        index_together = [["client", "modified"]]
+
+    def __str__(self):
+        return "{podcast} {action} on {client}".format(
+            podcast=self.podcast,
+            action="subscribed" if self.subscribed else "unsubscribed",
+            client=self.client,
+        )
+
+
+class SubscriberCountDeltaManager(models.Manager):
+    """ Manager for the SubscriberCountDelta model """
+
+    def add(self, podcasts, delta):
+        """ Records a change of the subscriber count of the given podcasts """
+        self.bulk_create(
+            [self.model(podcast=podcast, delta=delta) for podcast in podcasts]
+        )
+
+
+class SubscriberCountDelta(models.Model):
+    """A pending change of the subscriber count of a podcast
+
+    Deltas are applied to Podcast.subscribers in batches; podcasts with deltas
+    are periodically reconciled with their actual subscriptions"""
+
+    podcast = models.ForeignKey(Podcast, on_delete=models.CASCADE)
+
+    # the change of the number of subscribers (+1 / -1)
+    delta = models.SmallIntegerField()
+
+    # if the delta has been added to Podcast.subscribers
+    applied = models.BooleanField(default=False, db_index=True)
+
+    objects = SubscriberCountDeltaManager()
+
+
 SubscribedPodcast = collections.namedtuple(
     "SubscribedPodcast", "podcast public ref_url"
 )
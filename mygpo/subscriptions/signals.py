@@ -2,5 +2,7 @@ import django.dispatch
 
 # indicates that a podcast was subscribed or unsubscribed
 # ``sender`` will equal the user. Additionally the parameters ``user`` and
-# ``subscribed`` will be provided
+# ``subscribed`` will be provided; ``instance`` and ``client`` are the
+# podcast and client. Bulk changes fire a single event, where ``instance``
+# and ``client`` are None and ``changes`` is a list of (client, podcast) pairs
 subscription_changed = django.dispatch.Signal()
@@ -3,7 +3,11 @@ from datetime import datetime
 from django.contrib.auth import get_user_model
 from django.db import transaction
 
-from mygpo.subscriptions.models import Subscription
+from mygpo.subscriptions.models import (
+    Subscription,
+    SubscriptionChange,
+    SubscriberCountDelta,
+)
 from mygpo.subscriptions.signals import subscription_changed
 from mygpo.history.models import HistoryEntry
 from mygpo.podcasts.models import Podcast
@@ -90,6 +94,29 @@ def unsubscribe_all(podcast_pk, user_pk):
     _fire_events(podcast, user, changed, False)
 
 
+def subscribe_many(podcasts, user, client):
+    """subscribes user to many podcasts on one client
+
+    ``podcasts`` is a list of (podcast, ref_url) pairs. Takes synced devices
+    into account. The subscriptions are stored in bulk and a single
+    aggregated subscription_changed event is fired."""
+    now = datetime.utcnow()
+    clients = _affected_clients(client)
+    changed = _perform_bulk_subscribe(podcasts, user, clients, now)
+    _fire_bulk_event(user, changed, True)
+
+
+def unsubscribe_many(podcasts, user, client):
+    """unsubscribes user from many podcasts on one client
+
+    Takes synced devices into account. The subscriptions are removed in bulk
+    and a single aggregated subscription_changed event is fired."""
+    now = datetime.utcnow()
+    clients = _affected_clients(client)
+    changed = _perform_bulk_unsubscribe(podcasts, user, clients, now)
+    _fire_bulk_event(user, changed, False)
+
+
 @transaction.atomic
 def _perform_subscribe(podcast, user, clients, timestamp, ref_url):
     """Subscribes to a podcast on multiple clients
@@ -97,6 +124,8 @@ def _perform_subscribe(podcast, user, clients, timestamp, ref_url):
     Yields the clients on which a subscription was added, ie not those where
     the subscription already existed."""
 
+    was_subscribed = Subscription.objects.filter(user=user, podcast=podcast).exists()
+
     for client in clients:
         subscription, created = Subscription.objects.get_or_create(
             user=user,
@@ -126,6 +155,15 @@ def _perform_subscribe(podcast, user, clients, timestamp, ref_url):
             action=HistoryEntry.SUBSCRIBE,
         )
 
+        SubscriptionChange.objects.log_change(
+            client, podcast, subscription.ref_url, True, timestamp
+        )
+
+        if not was_subscribed:
+            # the user is a new subscriber of the podcast
+            SubscriberCountDelta.objects.add([podcast], +1)
+            was_subscribed = True
+
         yield client
 
 
@@ -161,9 +199,134 @@ def _perform_unsubscribe(podcast, user, clients, timestamp):
             action=HistoryEntry.UNSUBSCRIBE,
         )
 
+        SubscriptionChange.objects.log_change(
+            client, podcast, subscription.ref_url, False, timestamp
+        )
+
+        if not Subscription.objects.filter(user=user, podcast=podcast).exists():
+            # the user is no longer a subscriber of the podcast
+            SubscriberCountDelta.objects.add([podcast], -1)
+
         yield client
 
 
+@transaction.atomic
+def _perform_bulk_subscribe(podcasts, user, clients, timestamp):
+    """Subscribes to many (podcast, ref_url) pairs on multiple clients
+
+    Returns the (client, podcast) pairs for which a subscription was added"""
+
+    # the first URL of each podcast is used as its ref_url
+    ref_urls = {}
+    for podcast, ref_url in podcasts:
+        ref_urls.setdefault(podcast, ref_url or podcast.url)
+
+    clients = list(clients)
+    existing = set(
+        Subscription.objects.filter(user=user, podcast__in=ref_urls.keys()).values_list(
+            "client", "podcast"
+        )
+    )
+    subscribed_podcasts = {podcast_pk for _client_pk, podcast_pk in existing}
+
+    # only the subscriptions that are actually created are recorded, as
+    # others might have been added concurrently after the check above
+    subscriptions = Subscription.objects.create_missing(
+        user,
+        [
+            (client, podcast, ref_url)
+            for client in clients
+            for podcast, ref_url in ref_urls.items()
+            if (client.pk, podcast.pk) not in existing
+        ],
+        timestamp,
+    )
+
+    if not subscriptions:
+        return []
+
+    logger.info(
+        "{user} added {num} subscriptions".format(user=user, num=len(subscriptions))
+    )
+
+    HistoryEntry.objects.bulk_create(
+        [
+            HistoryEntry(
+                timestamp=timestamp,
+                podcast=podcast,
+                user=user,
+                client=client,
+                action=HistoryEntry.SUBSCRIBE,
+            )
+            for client, podcast, _ref_url in subscriptions
+        ]
+    )
+
+    SubscriptionChange.objects.log_changes(subscriptions, True, timestamp)
+
+    # podcasts of which the user is a new subscriber
+    new_podcasts = {
+        podcast.pk: podcast
+        for _client, podcast, _ref_url in subscriptions
+        if podcast.pk not in subscribed_podcasts
+    }
+    SubscriberCountDelta.objects.add(new_podcasts.values(), +1)
+
+    return [(client, podcast) for client, podcast, _ref_url in subscriptions]
+
+
+@transaction.atomic
+def _perform_bulk_unsubscribe(podcasts, user, clients, timestamp):
+    """Unsubscribes from many podcasts on multiple clients
+
+    Returns the (client, podcast) pairs for which a subscription was removed"""
+
+    subscriptions = list(
+        Subscription.objects.filter(
+            user=user, client__in=list(clients), podcast__in=list(podcasts)
+        ).select_related("client", "podcast")
+    )
+
+    if not subscriptions:
+        return []
+
+    Subscription.objects.filter(pk__in=[s.pk for s in subscriptions]).delete()
+
+    logger.info(
+        "{user} removed {num} subscriptions".format(user=user, num=len(subscriptions))
+    )
+
+    HistoryEntry.objects.bulk_create(
+        [
+            HistoryEntry(
+                timestamp=timestamp,
+                podcast=subscription.podcast,
+                user=user,
+                client=subscription.client,
+                action=HistoryEntry.UNSUBSCRIBE,
+            )
+            for subscription in subscriptions
+        ]
+    )
+
+    SubscriptionChange.objects.log_changes(
+        [(s.client, s.podcast, s.ref_url) for s in subscriptions], False, timestamp
+    )
+
+    # podcasts of which the user is no longer a subscriber
+    remaining = set(
+        Subscription.objects.filter(
+            user=user, podcast__in=[s.podcast for s in subscriptions]
+        ).values_list("podcast", flat=True)
+    )
+    removed_podcasts = {
+        s.podcast.pk: s.podcast for s in subscriptions if s.podcast.pk not in remaining
+    }
+    SubscriberCountDelta.objects.add(removed_podcasts.values(), -1)
+
+    return [(s.client, s.podcast) for s in subscriptions]
+
+
 def _affected_clients(client):
     """ the clients that are affected if the given one is to be changed """
     if client.sync_group:
@@ -185,3 +348,18 @@ def _fire_events(podcast, user, clients, subscribed):
             client=client,
             subscribed=subscribed,
         )
+
+
+def _fire_bulk_event(user, changed, subscribed):
+    """ Fire one aggregated event for many (client, podcast) changes """
+    if not changed:
+        return
+
+    subscription_changed.send(
+        sender=Podcast,
+        instance=None,
+        user=user,
+        client=None,
+        subscribed=subscribed,
+        changes=changed,
+    )
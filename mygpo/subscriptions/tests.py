@@ -1,5 +1,6 @@
 import uuid
 import unittest
+import unittest.mock
 from datetime import datetime
 
 from django.contrib.auth import get_user_model
@@ -47,6 +48,74 @@ class TestSubscribe(TestCase):
         self.assertEqual(subscriptions.count(), 1)
         subscriptions[0].delete()
 
+    def test_bulk_subscribe(self):
+        """ Test subscribing to and unsubscribing from many podcasts """
+        from mygpo.subscriptions.tasks import subscribe_many, unsubscribe_many
+        from mygpo.subscriptions.signals import subscription_changed
+
+        urls = ["http://example.com/bulk-%d.rss" % n for n in range(3)]
+        podcasts = [Podcast.objects.get_or_create_for_url(url).object for url in urls]
+
+        events = []
+
+        def _receiver(sender, **kwargs):
+            events.append(kwargs)
+
+        subscription_changed.connect(_receiver)
+        try:
+            subscribe_many(list(zip(podcasts, urls)), self.user, self.client)
+            subscribe_many(list(zip(podcasts, urls)), self.user, self.client)
+            unsubscribe_many(podcasts[:1], self.user, self.client)
+        finally:
+            subscription_changed.disconnect(_receiver)
+
+        # the duplicate subscription does not fire an event
+        self.assertEqual(len(events), 2)
+        self.assertTrue(events[0]["subscribed"])
+        self.assertEqual(len(events[0]["changes"]), 3)
+        self.assertFalse(events[1]["subscribed"])
+        self.assertEqual(events[1]["changes"], [(self.client, podcasts[0])])
+
+        subscriptions = models.Subscription.objects.filter(user=self.user)
+        self.assertEqual(
+            set(subscriptions.values_list("ref_url", flat=True)), set(urls[1:])
+        )
+
+        changes = models.SubscriptionChange.objects.filter(client=self.client)
+        self.assertEqual(
+            dict(changes.values_list("ref_url", "subscribed")),
+            {urls[0]: False, urls[1]: True, urls[2]: True},
+        )
+
+    def test_bulk_subscribe_concurrent(self):
+        """ Subscriptions added concurrently are not recorded twice """
+        from mygpo.subscriptions.tasks import _perform_bulk_subscribe
+        from mygpo.history.models import HistoryEntry
+
+        now = datetime.utcnow()
+        podcasts = [(self.podcast, self.url)]
+        changed = _perform_bulk_subscribe(podcasts, self.user, [self.client], now)
+        self.assertEqual(changed, [(self.client, self.podcast)])
+
+        # the subscription is not visible when checking for existing ones
+        with unittest.mock.patch.object(
+            models.Subscription.objects,
+            "filter",
+            return_value=models.Subscription.objects.none(),
+        ):
+            changed = _perform_bulk_subscribe(
+                podcasts, self.user, [self.client, self.client], now
+            )
+
+        self.assertEqual(changed, [])
+        history = HistoryEntry.objects.filter(user=self.user, podcast=self.podcast)
+        self.assertEqual(history.count(), 1)
+        deltas = models.SubscriberCountDelta.objects.filter(podcast=self.podcast)
+        self.assertEqual(list(deltas.values_list("delta", flat=True)), [1])
+
+        models.Subscription.objects.filter(user=self.user).delete()
+        history.delete()
+
     def tearDown(self):
         self.podcast.delete()
         self.client.delete()
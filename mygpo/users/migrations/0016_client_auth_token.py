@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 03:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0015_case_insensitive_username'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='auth_token',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
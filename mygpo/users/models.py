@@ -1,5 +1,9 @@
 import re
 import collections
+import hashlib
+import hmac
+import secrets
+
 import dateutil.parser
 
 from django.core.validators import RegexValidator
@@ -210,6 +214,11 @@ class SyncGroup(models.Model):
         return ", ".join(client.display_name for client in clients)
 
 
+def hash_token(secret):
+    """ Hash under which the secret of an API token is stored """
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()
+
+
 class Client(UUIDModel, DeleteableModel):
     """ A client application """
 
@@ -250,6 +259,9 @@ class Client(UUIDModel, DeleteableModel):
         SyncGroup, null=True, blank=True, on_delete=models.PROTECT
     )
 
+    # SHA-256 hash of the secret part of the client's API token
+    auth_token = models.CharField(max_length=64, null=True, blank=True)
+
     class Meta:
         unique_together = (("user", "uid"),)
 
@@ -325,6 +337,22 @@ class Client(UUIDModel, DeleteableModel):
                     if not dev == self:
                         yield dev
 
+    def create_auth_token(self):
+        """Creates a new API token for the client and returns it
+
+        Only a hash of the token is stored, replacing any previous token."""
+        secret = secrets.token_urlsafe(32)
+        self.auth_token = hash_token(secret)
+        self.save(update_fields=["auth_token"])
+        return "{}.{}".format(self.id.hex, secret)
+
+    def check_auth_token(self, secret):
+        """ Verifies the secret part of an API token in constant time """
+        if not self.auth_token:
+            return False
+
+        return hmac.compare_digest(hash_token(secret), self.auth_token)
+
     def get_subscribed_podcasts(self):
         """Returns all subscribed podcasts for the device
 
@@ -12,11 +12,19 @@ from django.conf import settings
 from django.http import Http404, HttpResponseRedirect
 from django.views import View
 from django.utils.decorators import method_decorator
-from django.views.decorators.http import last_modified
+from django.views.decorators.http import condition
+from django.core.cache import cache
+from django.utils.cache import add_never_cache_headers
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.core.files.storage import FileSystemStorage
 
 from mygpo.utils import file_hash
+from mygpo.web.utils import reverse_fast
+from mygpo.constants import (
+    PODCAST_LOGO_SIZE,
+    PODCAST_LOGO_MEDIUM_SIZE,
+    PODCAST_LOGO_BIG_SIZE,
+)
 
 import logging
 
@@ -28,9 +36,32 @@ logger = logging.getLogger(__name__)
 LOGO_STORAGE = FileSystemStorage(location=settings.MEDIA_ROOT)
 
 
+# Thumbnail sizes that are rendered whenever a new logo is stored
+THUMBNAIL_SIZES = (PODCAST_LOGO_SIZE, PODCAST_LOGO_MEDIUM_SIZE, PODCAST_LOGO_BIG_SIZE)
+
+# timeout in seconds for downloading a logo
+LOGO_TIMEOUT = 30
+
+# seconds for which a scheduled thumbnail is not scheduled again
+THUMBNAIL_SCHEDULE_TIMEOUT = 60 * 10
+
+# seconds for which the storage names and hashes of logos are cached; the
+# default cache is local to each process, so entries must expire to see
+# changes made by other processes
+LOGO_CACHE_TIMEOUT = 60 * 60
+
+
 def _last_modified(request, size, prefix, filename):
 
-    target = os.path.join("logo", str(size), prefix, filename)
+    try:
+        key = resolve_logo(filename)
+    except IOError:
+        return None
+
+    if key is None:
+        return None
+
+    target = CoverArt.get_thumbnail_path(size, get_prefix(key), key)
 
     try:
         return LOGO_STORAGE.get_modified_time(target)
@@ -39,18 +70,60 @@ def _last_modified(request, size, prefix, filename):
         return None
 
 
+def _etag(request, size, prefix, filename):
+    """Thumbnails are identified by the content of the original and the size
+
+    Responses without a thumbnail get no ETag, so that they are not
+    revalidated once the thumbnail exists."""
+
+    try:
+        key = resolve_logo(filename)
+        if key is None:
+            return None
+
+        content_hash = get_logo_hash(get_prefix(key), key)
+    except IOError as ioe:
+        logger.warning("Cover file {} cannot be opened: {}".format(filename, ioe))
+        raise Http404("Cannot open cover file") from ioe
+
+    if content_hash is None:
+        return None
+
+    target = CoverArt.get_thumbnail_path(size, get_prefix(key), key)
+    if not LOGO_STORAGE.exists(target):
+        return None
+
+    return "{hash}-{size}".format(hash=content_hash, size=size)
+
+
 class CoverArt(View):
+    """Serves podcast logos
+
+    Logos are requested by the hash of their URL. Originals and thumbnails
+    are stored by the hash of their content (see save_podcast_logo), so that
+    identical images are stored only once."""
+
     def __init__(self):
         self.storage = LOGO_STORAGE
 
-    @method_decorator(last_modified(_last_modified))
+    @method_decorator(condition(etag_func=_etag, last_modified_func=_last_modified))
     def get(self, request, size, prefix, filename):
 
         size = int(size)
 
-        prefix = get_prefix(filename)
-        target = self.get_thumbnail_path(size, prefix, filename)
-        original = self.get_original_path(prefix, filename)
+        try:
+            key = resolve_logo(filename)
+        except IOError as ioe:
+            logger.warning("Cover file {} cannot be opened: {}".format(filename, ioe))
+            raise Http404("Cannot open cover file") from ioe
+
+        if key is None:
+            logger.warning("Cover {} not found".format(filename))
+            raise Http404("Cover Art not available " + filename)
+
+        prefix = get_prefix(key)
+        target = self.get_thumbnail_path(size, prefix, key)
+        original = self.get_original_path(prefix, key)
 
         if self.storage.exists(target):
             return self.send_file(target)
@@ -59,38 +132,57 @@ class CoverArt(View):
             logger.warning("Original cover {} not found".format(original))
             raise Http404("Cover Art not available" + original)
 
-        target_dir = self.get_dir(filename)
+        # Thumbnails are rendered in the background; until then the original
+        # is served, but must not be cached in place of the thumbnail
+        cache_key = "logo-thumbnail-scheduled-{}-{}".format(size, key)
+        if cache.add(cache_key, True, THUMBNAIL_SCHEDULE_TIMEOUT):
+            from mygpo.web.tasks import create_thumbnails
+
+            create_thumbnails.delay(prefix, key, [size])
+
+        response = self.send_file(original)
+        add_never_cache_headers(response)
+        return response
+
+    @classmethod
+    def create_thumbnails(cls, prefix, filename, sizes=THUMBNAIL_SIZES):
+        """ Renders the thumbnails of the given sizes from the original """
+
+        original = cls.get_original_path(prefix, filename)
+
         try:
-            fp = self.storage.open(original, "rb")
-            im = Image.open(fp)
-            if im.mode not in ("RGB", "RGBA"):
+            with LOGO_STORAGE.open(original, "rb") as fp:
+                im = Image.open(fp)
+                im.load()
+
+            if im.mode != "RGB":
+                # JPEG does not support transparency
                 im = im.convert("RGBA")
+                background = Image.new("RGB", im.size, (255, 255, 255))
+                background.paste(im, mask=im.split()[3])
+                im = background
+
         except IOError as ioe:
             logger.warning("Cover file {} cannot be opened: {}".format(original, ioe))
-            raise Http404("Cannot open cover file") from ioe
-
-        try:
-            im.thumbnail((size, size), Image.ANTIALIAS)
-            resized = im
-        except (struct.error, IOError, IndexError) as ex:
-            # raised when trying to read an interlaced PNG;
-            logger.warning("Could not create thumbnail: %s", str(ex))
+            return
 
-            # we use the original instead
-            return self.send_file(original)
+        for size in sorted(sizes, reverse=True):
+            target = cls.get_thumbnail_path(size, prefix, filename)
 
-        sio = io.BytesIO()
+            try:
+                resized = im.copy()
+                resized.thumbnail((size, size), Image.ANTIALIAS)
+                sio = io.BytesIO()
+                resized.save(sio, "JPEG", optimize=True, progression=True, quality=80)
 
-        try:
-            resized.save(sio, "JPEG", optimize=True, progression=True, quality=80)
-        except IOError as ex:
-            return self.send_file(original)
-        finally:
-            fp.close()
+            except (struct.error, IOError, IndexError) as ex:
+                # raised when trying to read an interlaced PNG;
+                # the original is served instead
+                logger.warning("Could not create thumbnail: %s", str(ex))
+                return
 
-        self.storage.save(target, sio)
-
-        return self.send_file(target)
+            LOGO_STORAGE.delete(target)
+            LOGO_STORAGE.save(target, sio)
 
     @staticmethod
     def get_thumbnail_path(size, prefix, filename):
@@ -104,7 +196,7 @@ class CoverArt(View):
     def remove_existing_thumbnails(prefix, filename):
         dirs, _files = LOGO_STORAGE.listdir("logo")  # TODO: cache list of sizes
         for size in dirs:
-            if size == "original":
+            if size in ("original", "url"):
                 continue
 
             path = os.path.join("logo", size, prefix, filename)
@@ -115,43 +207,61 @@ class CoverArt(View):
     def get_original_path(prefix, filename):
         return os.path.join("logo", "original", prefix, filename)
 
+    @staticmethod
+    def get_url_path(prefix, filename):
+        return os.path.join("logo", "url", prefix, filename)
+
     def send_file(self, filename):
         return HttpResponseRedirect(LOGO_STORAGE.url(filename))
 
     @classmethod
     def save_podcast_logo(cls, cover_art_url):
+        """Downloads the logo, if it has changed since the last download
+
+        The original is stored by the hash of its content, and the hash is
+        stored by the hash of the logo URL."""
         if not cover_art_url:
             return
 
         try:
-            image_sha1 = hashlib.sha1(cover_art_url.encode("utf-8")).hexdigest()
-            prefix = get_prefix(image_sha1)
+            url_hash = hashlib.sha1(cover_art_url.encode("utf-8")).hexdigest()
+            old_key = resolve_logo(url_hash)
+
+            # validators of the previous download
+            fetch_key = _logo_fetch_key(url_hash)
+            fetched = cache.get(fetch_key) or {}
 
-            filename = cls.get_original_path(prefix, image_sha1)
-            dirname = cls.get_dir(filename)
+            headers = {}
+            if old_key and fetched.get("etag"):
+                headers["If-None-Match"] = fetched["etag"]
+            if old_key and fetched.get("last_modified"):
+                headers["If-Modified-Since"] = fetched["last_modified"]
 
-            # get hash of existing file
-            if LOGO_STORAGE.exists(filename):
-                with LOGO_STORAGE.open(filename, "rb") as f:
-                    old_hash = file_hash(f).digest()
-            else:
-                old_hash = ""
+            r = requests.get(cover_art_url, headers=headers, timeout=LOGO_TIMEOUT)
 
-            logger.info("Logo {}, saving to {}".format(cover_art_url, filename))
+            if r.status_code == 304:
+                logger.info("Logo {} not modified".format(cover_art_url))
+                return cover_art_url
 
-            # save new cover art
-            LOGO_STORAGE.delete(filename)
-            source = io.BytesIO(requests.get(cover_art_url).content)
-            LOGO_STORAGE.save(filename, source)
+            r.raise_for_status()
 
-            # get hash of new file
-            with LOGO_STORAGE.open(filename, "rb") as f:
-                new_hash = file_hash(f).digest()
+            content = r.content
+            key = hashlib.sha1(content).hexdigest()
 
-            # remove thumbnails if cover changed
-            if old_hash != new_hash:
-                logger.info("Removing thumbnails")
-                thumbnails = cls.remove_existing_thumbnails(prefix, filename)
+            # only store the cover art and render thumbnails if it changed,
+            # and if the same image hasn't been stored for another URL
+            if key != old_key:
+                cls._save_original(key, content)
+                cls._save_url(url_hash, key)
+
+                if old_key == url_hash:
+                    cls._remove_legacy_logo(url_hash)
+
+            fetched = {
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+            }
+            cache.set(fetch_key, fetched, LOGO_CACHE_TIMEOUT)
 
             return cover_art_url
 
@@ -163,11 +273,115 @@ class CoverArt(View):
         ) as e:
             logger.warning("Exception while updating podcast logo: %s", str(e))
 
+    @classmethod
+    def _save_original(cls, key, content):
+        prefix = get_prefix(key)
+        filename = cls.get_original_path(prefix, key)
+        if LOGO_STORAGE.exists(filename):
+            return
+
+        logger.info("Saving logo to {}".format(filename))
+        name = LOGO_STORAGE.save(filename, io.BytesIO(content))
+
+        # the same image has been stored concurrently
+        if name != filename:
+            LOGO_STORAGE.delete(name)
+            return
+
+        from mygpo.web.tasks import create_thumbnails
+
+        create_thumbnails.delay(prefix, key)
+
+    @classmethod
+    def _save_url(cls, url_hash, key):
+        filename = cls.get_url_path(get_prefix(url_hash), url_hash)
+        LOGO_STORAGE.delete(filename)
+        LOGO_STORAGE.save(filename, io.BytesIO(key.encode("ascii")))
+        cache.set(_logo_url_key(url_hash), key, LOGO_CACHE_TIMEOUT)
+
+    @classmethod
+    def _remove_legacy_logo(cls, url_hash):
+        """ Removes a logo that has been stored by the hash of its URL """
+        prefix = get_prefix(url_hash)
+        logger.info("Removing logo {}".format(url_hash))
+        LOGO_STORAGE.delete(cls.get_original_path(prefix, url_hash))
+        cls.remove_existing_thumbnails(prefix, url_hash)
+        cache.delete(_logo_hash_key(url_hash))
+
 
 def get_prefix(filename):
     return filename[:3]
 
 
+def get_logo_hash(prefix, filename):
+    """Returns the hash of the content of an original logo
+
+    Returns None if the logo does not exist. Raises IOError if it can not
+    be read."""
+
+    key = _logo_hash_key(filename)
+    content_hash = cache.get(key)
+
+    if content_hash is None:
+        original = CoverArt.get_original_path(prefix, filename)
+        if not LOGO_STORAGE.exists(original):
+            return None
+
+        with LOGO_STORAGE.open(original, "rb") as f:
+            content_hash = file_hash(f).hexdigest()
+
+        cache.set(key, content_hash, LOGO_CACHE_TIMEOUT)
+
+    return content_hash
+
+
+def resolve_logo(filename):
+    """Returns the name under which the logo with the URL hash is stored
+
+    Logos that have been stored before originals were stored by their content
+    are still found by their URL hash. Returns None if the logo does not
+    exist. Raises IOError if it can not be read."""
+
+    key = _logo_url_key(filename)
+    content_key = cache.get(key)
+
+    # the logo might have been moved by another process
+    if content_key is not None and not LOGO_STORAGE.exists(
+        CoverArt.get_original_path(get_prefix(content_key), content_key)
+    ):
+        content_key = None
+
+    if content_key is None:
+        prefix = get_prefix(filename)
+        url_path = CoverArt.get_url_path(prefix, filename)
+
+        if LOGO_STORAGE.exists(url_path):
+            with LOGO_STORAGE.open(url_path, "rb") as f:
+                content_key = f.read().decode("ascii").strip()
+
+        elif LOGO_STORAGE.exists(CoverArt.get_original_path(prefix, filename)):
+            content_key = filename
+
+        else:
+            return None
+
+        cache.set(key, content_key, LOGO_CACHE_TIMEOUT)
+
+    return content_key
+
+
+def _logo_url_key(filename):
+    return "logo-url-{}".format(filename)
+
+
+def _logo_hash_key(filename):
+    return "logo-hash-{}".format(filename)
+
+
+def _logo_fetch_key(filename):
+    return "logo-fetch-{}".format(filename)
+
+
 def get_logo_url(podcast, size):
     """Return the logo URL for the podcast
 
@@ -177,7 +391,7 @@ def get_logo_url(podcast, size):
 
     if podcast.logo_url:
         filename = hashlib.sha1(podcast.logo_url.encode("utf-8")).hexdigest()
-        return reverse("logo", args=[size, get_prefix(filename), filename])
+        return reverse_fast("logo", [size, get_prefix(filename), filename])
 
     else:
         filename = "podcast-%d.png" % (hash(podcast.title) % 5,)
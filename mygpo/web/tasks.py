@@ -0,0 +1,13 @@
+from mygpo.celery import celery
+from mygpo.web.logo import CoverArt, THUMBNAIL_SIZES
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+
+@celery.task
+def create_thumbnails(prefix, filename, sizes=THUMBNAIL_SIZES):
+    """ Renders the thumbnails of a podcast logo """
+    logger.info("Creating thumbnails for {}".format(filename))
+    CoverArt.create_thumbnails(prefix, filename, sizes)
@@ -1,20 +1,30 @@
 import unittest
+import unittest.mock
 import doctest
 import uuid
 import os.path
+import hashlib
 
 import requests
 import responses
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
 from django.test import TestCase, Client, override_settings
-from django.urls import reverse
+from django.urls import reverse, NoReverseMatch
 from django.core.files.storage import FileSystemStorage
 from django.contrib.auth import get_user_model
 
 from mygpo.podcasts.models import Podcast, Episode, Slug
 import mygpo.web.utils
-from mygpo.web.logo import CoverArt, get_logo_url
+from mygpo.web.logo import (
+    CoverArt,
+    LOGO_STORAGE,
+    get_logo_url,
+    get_prefix,
+    resolve_logo,
+)
 from mygpo.test import create_auth_string, anon_request
 
 import logging
@@ -131,6 +141,15 @@ class PodcastLogoTests(TestCase):
         )
         self.client = Client()
 
+        # logos are stored by their content, which is the same in all tests
+        cache.clear()
+        for path in (IMG_PATH1, IMG_PATH2):
+            with open(path, "rb") as f:
+                key = hashlib.sha1(f.read()).hexdigest()
+            LOGO_STORAGE.delete(CoverArt.get_original_path(get_prefix(key), key))
+            if LOGO_STORAGE.exists("logo"):
+                CoverArt.remove_existing_thumbnails(get_prefix(key), key)
+
     def tearDown(self):
         self.podcast.delete()
 
@@ -221,6 +240,138 @@ class PodcastLogoTests(TestCase):
 
         logo.LOGO_STORAGE = _logo_storage
 
+    def test_prerendered_thumbnail(self):
+        """ Pre-rendered thumbnails are served instead of the original """
+        self._save_logo()
+
+        filename = get_logo_url(self.podcast, 32).rstrip("/").split("/")[-1]
+        key = resolve_logo(filename)
+        CoverArt.create_thumbnails(get_prefix(key), key)
+
+        response = self.client.get(get_logo_url(self.podcast, 32))
+        self.assertEqual(302, response.status_code)
+        self.assertIn("/logo/32/", response["Location"])
+
+    def test_etag(self):
+        """ Thumbnails can be requested conditionally """
+        self._save_logo()
+        logo_url = get_logo_url(self.podcast, 32)
+
+        # the original is served until the thumbnail has been rendered
+        response = self.client.get(logo_url)
+        self.assertEqual(302, response.status_code)
+        self.assertFalse(response.has_header("ETag"))
+        self.assertIn("no-cache", response["Cache-Control"])
+
+        key = resolve_logo(logo_url.rstrip("/").split("/")[-1])
+        CoverArt.create_thumbnails(get_prefix(key), key)
+
+        response = self.client.get(logo_url)
+        self.assertEqual(302, response.status_code)
+        etag = response["ETag"]
+
+        response = self.client.get(logo_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+        # the ETag depends on the size
+        response = self.client.get(get_logo_url(self.podcast, 64))
+        self.assertNotEqual(etag, response["ETag"])
+
+    def test_conditional_download(self):
+        """ Unchanged logos are not downloaded or stored again """
+
+        def _not_modified(request):
+            self.assertEqual(request.headers["If-None-Match"], '"abc"')
+            return (304, {}, "")
+
+        with responses.RequestsMock() as rsps, open(IMG_PATH1, "rb") as body:
+            rsps.add(
+                responses.GET,
+                self.URL,
+                status=200,
+                body=body.read(),
+                content_type="image/png",
+                headers={"ETag": '"abc"'},
+            )
+            rsps.add_callback(responses.GET, self.URL, callback=_not_modified)
+
+            with unittest.mock.patch(
+                "mygpo.web.tasks.create_thumbnails.delay"
+            ) as create_thumbnails:
+                self.assertEqual(CoverArt.save_podcast_logo(self.URL), self.URL)
+                self.assertEqual(create_thumbnails.call_count, 1)
+
+                self.assertEqual(CoverArt.save_podcast_logo(self.URL), self.URL)
+                self.assertEqual(create_thumbnails.call_count, 1)
+
+        self._fetch_cover(self.podcast)
+
+    def test_deduplicate_logos(self):
+        """ Identical images from different URLs are stored once """
+        other_url = "http://example.com/{}.png".format(uuid.uuid1().hex)
+        other = Podcast.objects.create(
+            id=uuid.uuid1(), title="Other Podcast", logo_url=other_url
+        )
+
+        with responses.RequestsMock() as rsps, open(IMG_PATH1, "rb") as body:
+            content = body.read()
+            for url in (self.URL, other_url):
+                rsps.add(responses.GET, url, body=content, content_type="image/png")
+
+            with unittest.mock.patch(
+                "mygpo.web.tasks.create_thumbnails.delay"
+            ) as create_thumbnails:
+                CoverArt.save_podcast_logo(self.URL)
+                CoverArt.save_podcast_logo(other_url)
+
+        self.assertEqual(create_thumbnails.call_count, 1)
+
+        redirects = [
+            self.client.get(get_logo_url(podcast, 32))["Location"]
+            for podcast in (self.podcast, other)
+        ]
+        self.assertEqual(redirects[0], redirects[1])
+        self._fetch_cover(other)
+        other.delete()
+
+    def test_legacy_logo(self):
+        """ Logos stored by the hash of their URL are still served """
+        url_hash = hashlib.sha1(self.URL.encode("utf-8")).hexdigest()
+        legacy = CoverArt.get_original_path(get_prefix(url_hash), url_hash)
+        with open(IMG_PATH1, "rb") as f:
+            LOGO_STORAGE.save(legacy, f)
+
+        self._fetch_cover(self.podcast)
+
+        # the logo is moved when it is downloaded again
+        self._save_logo()
+        self.assertFalse(LOGO_STORAGE.exists(legacy))
+        self.assertNotEqual(resolve_logo(url_hash), url_hash)
+        self._fetch_cover(self.podcast)
+
+    def test_moved_logo_cached(self):
+        """ A logo moved by another process is found despite a stale cache """
+        url_hash = hashlib.sha1(self.URL.encode("utf-8")).hexdigest()
+        legacy = CoverArt.get_original_path(get_prefix(url_hash), url_hash)
+        with open(IMG_PATH1, "rb") as f:
+            LOGO_STORAGE.save(legacy, f)
+        self.assertEqual(resolve_logo(url_hash), url_hash)
+
+        # the other process doesn't share this process' cache
+        other_cache = LocMemCache("other-process", {})
+        with unittest.mock.patch("mygpo.web.logo.cache", other_cache):
+            self._save_logo()
+
+        self.assertFalse(LOGO_STORAGE.exists(legacy))
+        self.assertNotEqual(resolve_logo(url_hash), url_hash)
+        self._fetch_cover(self.podcast)
+
+    def test_logo_http_error(self):
+        """ A logo that can not be downloaded is not stored """
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.GET, self.URL, status=404)
+            self.assertIsNone(CoverArt.save_podcast_logo(self.URL))
+
     def test_new_logo(self):
         with responses.RequestsMock() as rsps, open(IMG_PATH1, "rb") as body1, open(
             IMG_PATH1, "rb"
@@ -308,3 +459,30 @@ class PublisherPageTests(TestCase):
 
         response = self.client.get(url)
         self.assertEqual(200, response.status_code)
+
+
+class ReverseFastTests(unittest.TestCase):
+    def test_same_as_reverse(self):
+        podcast_id, episode_id = uuid.uuid4(), uuid.uuid4()
+        for view_name, args in [
+            ("podcast-slug", ["my-podcast"]),
+            ("podcast-id", [podcast_id]),
+            ("episode-slug", ["my-podcast", "my_episode-1"]),
+            ("episode-id", [podcast_id, episode_id]),
+            ("logo", [64, "ab", "ab" + "c" * 38]),
+        ]:
+            url = mygpo.web.utils.reverse_fast(view_name, args)
+            self.assertEqual(url, reverse(view_name, args=args))
+
+    def test_unsafe_args(self):
+        """ Arguments that need validation or quoting are passed to reverse() """
+        with self.assertRaises(NoReverseMatch):
+            mygpo.web.utils.reverse_fast("podcast-slug", ["not a slug"])
+
+        with self.assertRaises(NoReverseMatch):
+            mygpo.web.utils.reverse_fast("podcast-id", ["my-podcast"])
+
+        args = [64, "a b", "c?d"]
+        url = mygpo.web.utils.reverse_fast("logo", args)
+        self.assertEqual(url, reverse("logo", args=args))
+        self.assertIn("a%20b", url)
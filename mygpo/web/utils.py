@@ -1,5 +1,7 @@
 import re
 import math
+import uuid
+import functools
 import string
 import collections
 from datetime import datetime
@@ -7,7 +9,7 @@ from datetime import datetime
 from django.utils.translation import ngettext
 from django.views.decorators.cache import never_cache
 from django.utils.html import strip_tags
-from django.urls import reverse
+from django.urls import reverse, get_script_prefix, get_urlconf, NoReverseMatch
 from django.shortcuts import render
 from django.http import Http404
 
@@ -143,6 +145,73 @@ def maintenance(request, *args, **kwargs):
     return resp
 
 
+# URL arguments that are neither validated nor quoted by the URL converters
+RE_PLAIN_ARG = re.compile(r"^[-a-zA-Z0-9_]+$")
+
+
+def reverse_fast(view_name, args=()):
+    """reverse() for URLs that are built for many objects
+
+    The URL pattern is reversed once for each combination of argument types,
+    with sentinel values that are later replaced by the actual arguments.
+    Arguments that are not slugs, numbers or UUIDs are passed to reverse(),
+    which validates and quotes them."""
+    args = list(args)
+
+    if all(map(_is_plain_arg, args)):
+        types = tuple(type(arg) for arg in args)
+        template = _url_template(view_name, types, get_script_prefix(), get_urlconf())
+        if template is not None:
+            return template.format(*args)
+
+    return reverse(view_name, args=args)
+
+
+def _is_plain_arg(arg):
+    if isinstance(arg, bool):
+        return False
+
+    if isinstance(arg, int):
+        return arg >= 0
+
+    if isinstance(arg, uuid.UUID):
+        return True
+
+    return isinstance(arg, str) and bool(RE_PLAIN_ARG.match(arg))
+
+
+@functools.lru_cache(maxsize=None)
+def _url_template(view_name, types, script_prefix, urlconf):
+    """Returns the URL of the view as format string, or None
+
+    None is returned if the converters of the URL pattern don't accept
+    arguments of the given types."""
+    sentinels = [_sentinel(t, n) for n, t in enumerate(types)]
+
+    try:
+        url = reverse(view_name, args=sentinels, urlconf=urlconf)
+    except NoReverseMatch:
+        return None
+
+    url = url.replace("{", "{{").replace("}", "}}")
+
+    # longer sentinels first, as they can contain shorter ones
+    for n, sentinel in sorted(enumerate(sentinels), key=lambda s: -len(str(s[1]))):
+        url = url.replace(str(sentinel), "{%d}" % n)
+
+    return url
+
+
+def _sentinel(arg_type, n):
+    if issubclass(arg_type, int):
+        return 987654321000 + n
+
+    if issubclass(arg_type, uuid.UUID):
+        return uuid.UUID(int=n + 1)
+
+    return "mygpo-url-sentinel-%d" % n
+
+
 def get_podcast_link_target(podcast, view_name="podcast", add_args=[]):
     """ Returns the link-target for a Podcast, preferring slugs over Ids """
 
@@ -156,7 +225,7 @@ def get_podcast_link_target(podcast, view_name="podcast", add_args=[]):
         args = [podcast.id]
         view_name = "%s-id" % view_name
 
-    return reverse(view_name, args=args + add_args)
+    return reverse_fast(view_name, args + add_args)
 
 
 def get_podcast_group_link_target(group, view_name, add_args=[]):
@@ -180,7 +249,7 @@ def get_episode_link_target(episode, podcast, view_name="episode", add_args=[]):
         args = [podcast.id, episode.id]
         view_name = "%s-id" % view_name
 
-    return strip_tags(reverse(view_name, args=args + add_args))
+    return strip_tags(reverse_fast(view_name, args + add_args))
 
 
 # doesn't include the '@' because it's not stored as part of a twitter handle
@@ -17,6 +17,7 @@ from mygpo.podcasts.models import Podcast, Episode, Tag
 from mygpo.users.models import HistoryEntry, Client
 from mygpo.subscriptions import get_subscribed_podcasts
 from mygpo.web.utils import process_lang_params
+from mygpo.directory.toplist import get_toplist
 from mygpo.utils import parse_range
 from mygpo.podcastlists.models import PodcastList
 from mygpo.favorites.models import FavoriteEpisode
@@ -41,7 +42,7 @@ def welcome(request):
 
     lang = process_lang_params(request)
 
-    toplist = Podcast.objects.all().toplist(lang)
+    toplist = get_toplist(lang)
 
     return render(request, "home.html", {"url": current_site, "toplist": toplist})
 